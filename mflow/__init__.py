@@ -1,3 +1,4 @@
+import importlib
 
 from .mflow import *
 
@@ -21,7 +22,33 @@ class _DeprecationWrapper:
         return repr(self.deprecated)
 
 
-from . import utils
-tools = _DeprecationWrapper(utils, "the `mflow.tools` alias is deprecated; use `mflow.utils` instead")
+# Submodules and names that are only imported on first access, to keep "import mflow" fast.
+_LAZY_SUBMODULES = {"aio", "compression", "utils"}
 
+_LAZY_ATTRIBUTES = {
+    "AsyncStream": "aio",
+    "connect_async": "aio",
+    "ConnectionCountMonitor": "utils",
+    "SocketEventListener": "utils",
+    "StageTimings": "utils",
+    "no_clients_timeout_notifier": "utils",
+    "PrefetchStatistics": "prefetch",
+    "SendBufferPool": "pool",
+}
 
+
+def __getattr__(name):
+    if name in _LAZY_SUBMODULES:
+        return importlib.import_module("." + name, __name__)
+
+    if name in _LAZY_ATTRIBUTES:
+        module = importlib.import_module("." + _LAZY_ATTRIBUTES[name], __name__)
+        return getattr(module, name)
+
+    if name == "tools":
+        tools = _DeprecationWrapper(importlib.import_module(".utils", __name__),
+                                    "the `mflow.tools` alias is deprecated; use `mflow.utils` instead")
+        globals()["tools"] = tools
+        return tools
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
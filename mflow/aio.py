@@ -0,0 +1,312 @@
+import asyncio
+import threading
+from logging import getLogger
+
+import zmq
+import zmq.asyncio
+from zmq.utils.monitor import parse_monitor_message
+
+from . import jsonapi
+from .mflow import CONNECT, PULL, Stream, frame_handlers, receive_handlers
+from .utils import ConnectionCountMonitor, SocketEventListener, no_clients_timeout_notifier
+
+
+logger = getLogger(__name__)
+
+
+class AsyncStream(Stream):
+    """
+    Stream for asyncio applications, built on zmq.asyncio.
+    Messages are received and sent as a whole (recv_multipart/send_multipart), the same htype handlers as for
+    Stream are used to interpret them.
+    """
+
+    context_class = zmq.asyncio.Context
+
+    def connect(self, address, conn_type=CONNECT, mode=PULL, receive_timeout=None, queue_size=100, linger=1000,
+                context=None, copy=True, send_timeout=None, copy_threshold=None):
+        """
+        See Stream.connect - a context, if provided, must be a zmq.asyncio.Context.
+        Socket monitors are run as a task on the running event loop.
+        """
+        super().connect(address, conn_type=conn_type, mode=mode, receive_timeout=receive_timeout,
+                        queue_size=queue_size, linger=linger, context=context, copy=copy, send_timeout=send_timeout,
+                        copy_threshold=copy_threshold)
+
+        # The handlers always work on the frames of an already received message.
+        if self.receiver is not None:
+            self.receiver = self.batch_receiver
+
+
+    def _create_socket_event_listener(self):
+        return AsyncSocketEventListener(self._socket_monitors)
+
+
+    async def receive(self, handler=None, block=True):
+        """
+        :param handler:     Reference to a specific message handler function to use for interpreting
+                            the message to be received
+        :param block:       Blocking receive call
+        :return:            Message or None if no message was received
+        """
+        flags = 0 if block else zmq.NOBLOCK
+        try:
+            frames = await self.socket.recv_multipart(flags, copy=self.zmq_copy, track=self.zmq_track)
+        except zmq.Again:
+            return None
+
+        self.receiver.load(frames)
+        return self._receive_message(self.receiver, handler)
+
+
+    async def receive_raw(self, block=True):
+        return await self.receive(handler=receive_handlers["raw-1.0"], block=block)
+
+
+    async def receive_batch(self, max_messages=100, timeout=None, handler=None):
+        """
+        See Stream.receive_batch.
+        """
+        messages = []
+        if timeout is not None and not await self.socket.poll(timeout, zmq.POLLIN):
+            return messages
+
+        # Only wait for the first message, afterwards just drain what is already queued.
+        flags = 0
+        while len(messages) < max_messages:
+            try:
+                frames = await self.socket.recv_multipart(flags, copy=self.zmq_copy, track=self.zmq_track)
+            except zmq.Again:
+                break
+            flags = zmq.NOBLOCK
+
+            self.receiver.load(frames)
+            message = self._receive_message(self.receiver, handler)
+            if message:
+                messages.append(message)
+
+        return messages
+
+
+    async def send(self, message, send_more=False, block=True, as_json=False):
+        flags = 0
+        if send_more:
+            flags = zmq.SNDMORE
+        if not block:
+            flags = flags | zmq.NOBLOCK
+
+        if as_json:
+            message = jsonapi.dumps(message)
+
+        hooks = self.hooks
+        if hooks is not None and hooks.pre_send is not None:
+            hooks.pre_send(self, message)
+        try:
+            await self.socket.send(message, flags, copy=self.zmq_copy, track=self.zmq_track)
+        except zmq.Again:
+            if block:
+                raise
+        except zmq.ZMQError:
+            logger.exception("Error while sending")
+            raise
+        finally:
+            if hooks is not None and hooks.post_send is not None:
+                hooks.post_send(self, message)
+
+
+    async def send_multipart(self, frames, block=True, copy=None, track=None):
+        """
+        See Stream.send_multipart.
+        """
+        if copy is None:
+            copy = self.zmq_copy
+        if track is None:
+            track = not copy
+
+        hooks = self.hooks
+        if hooks is not None and hooks.pre_send is not None:
+            hooks.pre_send(self, frames)
+        try:
+            if not track:
+                return await self.socket.send_multipart(frames, 0 if block else zmq.NOBLOCK, copy=copy, track=False)
+
+            # A tracker covering all the frames - see Stream.send_multipart.
+            flags = 0 if block else zmq.NOBLOCK
+            trackers = []
+            for index, frame in enumerate(frames):
+                more = zmq.SNDMORE if index < len(frames) - 1 else 0
+                tracker = await self.socket.send(frame, flags | more, copy=copy, track=True)
+                if tracker is not None:
+                    trackers.append(tracker)
+            return zmq.MessageTracker(*trackers)
+        except zmq.Again:
+            if block:
+                raise
+            return False
+        except zmq.ZMQError:
+            logger.exception("Error while sending")
+            raise
+        finally:
+            if hooks is not None and hooks.post_send is not None:
+                hooks.post_send(self, frames)
+
+
+    async def forward(self, message, handler=None, block=True):
+        frames = []
+
+        def collect(data, send_more=False, block=True, as_json=False):
+            frames.append(jsonapi.dumps(data) if as_json else data)
+
+        try:
+            if self.stamps is not None:
+                message = self._stamp(message)
+
+            if handler:
+                # Let the handler build the frames, then send them as one multipart message.
+                handler(message, send=collect, block=block)
+            else:
+                htype = self._get_htype(message)
+                frames_handler = frame_handlers.get(htype)
+                if frames_handler is not None:
+                    frames = frames_handler(message)
+                else:
+                    self._get_send_handler(htype)(message, send=collect, block=block)
+
+            await self.send_multipart(frames, block=block)
+        except zmq.Again:
+            pass
+        except Exception:
+            msg = "Unable to send message - skipping"
+            logger.debug(msg, exc_info=True)
+            logger.warning(msg)
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self):
+        while self.socket is not None and not self.socket.closed:
+            try:
+                message = await self.receive()
+            except zmq.ZMQError:
+                # Socket closed while waiting
+                break
+            if message is not None:
+                return message
+
+        raise StopAsyncIteration
+
+
+
+class AsyncSocketEventListener:
+    """
+    Asyncio counterpart of SocketEventListener - the events are received by a task instead of a thread.
+    """
+
+    def __init__(self, callbacks, events=None, receive_timeout=None):
+        """
+        Monitor the socket, receive ZMQ events associated with it.
+        :param callbacks: List of callbacks to call.
+        :param events: Events to listen for.
+        :param receive_timeout: Time in seconds to wait for socket receive.
+        """
+        if not events:
+            events = zmq.EVENT_ALL
+
+        if receive_timeout is None:
+            receive_timeout = SocketEventListener.DEFAULT_SOCKET_RECEIVE_TIMEOUT
+        self.receive_timeout = receive_timeout
+
+        self.monitor_listening = threading.Event()
+        self.monitor_task = None
+        self._socket = None
+        self._monitor_socket = None
+
+        self.callbacks = callbacks
+        self.events = events
+
+
+    def start(self, socket):
+        """
+        Start the monitoring task and socket - requires a running event loop.
+        :param socket: Socket to monitor.
+        """
+        # Start a task only if it is not already running.
+        if self.monitor_listening.is_set():
+            return
+
+        self._socket = socket
+        self._monitor_socket = socket.get_monitor_socket(events=self.events)
+        self.monitor_listening.set()
+
+        self.monitor_task = asyncio.get_running_loop().create_task(self._event_listener(self._monitor_socket))
+
+
+    def stop(self):
+        """
+        Stop the monitoring task.
+        """
+        self.monitor_listening.clear()
+
+        if self.monitor_task:
+            self.monitor_task.cancel()
+            self.monitor_task = None
+
+        # Cleanup right away - the socket context cannot be terminated while the monitor socket is open.
+        self._cleanup()
+
+
+    async def _event_listener(self, monitor_socket):
+        try:
+            while self.monitor_listening.is_set():
+                try:
+                    frames = await asyncio.wait_for(monitor_socket.recv_multipart(), self.receive_timeout)
+                except asyncio.TimeoutError:
+                    # Heartbeat for listeners - we do not need an additional task for time based listeners.
+                    self._notify_listeners(None)
+                    continue
+
+                event = parse_monitor_message(frames)
+                # The socket is closed, just stop listening now.
+                if event["event"] == zmq.EVENT_CLOSED:
+                    self.monitor_listening.clear()
+
+                self._notify_listeners(event)
+        finally:
+            self._cleanup()
+
+
+    def _cleanup(self):
+        if self._monitor_socket is None:
+            return
+
+        if not self._socket.closed:
+            self._socket.disable_monitor()
+        self._monitor_socket.close(linger=0)
+
+        self._socket = None
+        self._monitor_socket = None
+
+
+    def _notify_listeners(self, event):
+        for callback in self.callbacks:
+            callback(event)
+
+
+
+def connect_async(address, conn_type="connect", mode=zmq.PULL, queue_size=100, receive_timeout=None, linger=1000,
+                  no_client_action=None, no_client_timeout=10, copy=True, send_timeout=None, copy_threshold=None):
+    """
+    Create an AsyncStream - see connect.
+    """
+    stream = AsyncStream()
+
+    # If no client action is specified, start monitor.
+    if no_client_action:
+        stream.register_socket_monitor(ConnectionCountMonitor(no_clients_timeout_notifier(no_client_action,
+                                                                                          no_client_timeout)))
+
+    stream.connect(address, conn_type=conn_type, mode=mode, receive_timeout=receive_timeout, queue_size=queue_size,
+                   linger=linger, copy=copy, send_timeout=send_timeout, copy_threshold=copy_threshold)
+    return stream
@@ -0,0 +1,57 @@
+import logging
+
+
+def setup_logging():
+    """
+    The mflow library does not configure logging itself - the command line tools log warnings and errors like this.
+    """
+    logging.basicConfig(format="[%(asctime)s][%(name)s][%(levelname)s] %(message)s")
+
+
+def add_profile_arguments(parser):
+    """
+    Add the --profile and --profile_memory options (see start_profiling()).
+    """
+    parser.add_argument("--profile", default=None, type=str, metavar="FILENAME",
+                        help="Profile the receive and send calls with cProfile - the statistics are written to "
+                             "FILENAME on exit (e.g. for snakeviz) and the top functions are printed")
+    parser.add_argument("--profile_memory", default=None, type=int, metavar="N",
+                        help="Take a tracemalloc snapshot every N receive and send calls - the allocations growing the "
+                             "most are printed on exit")
+
+
+def start_profiling(arguments):
+    """
+    :param arguments: Parsed arguments with the options of add_profile_arguments().
+    :return: List of the hooks (see mflow.hooks) requested, to attach to the streams and pass to stop_profiling().
+    """
+    hooks = []
+    if arguments.profile or arguments.profile_memory:
+        from mflow.hooks import RECEIVE, SEND, ProfileHook, TracemallocHook
+
+        if arguments.profile:
+            hooks.append(ProfileHook())
+        if arguments.profile_memory:
+            hooks.append(TracemallocHook(every=arguments.profile_memory, regions=(RECEIVE, SEND)))
+    return hooks
+
+
+def stop_profiling(arguments, hooks, limit=20):
+    """
+    Detach the hooks, write the profile and print the results.
+    """
+    if not hooks:
+        return
+    from mflow.hooks import ProfileHook
+
+    for hook in hooks:
+        hook.detach()
+
+        if isinstance(hook, ProfileHook):
+            if hook.dump(arguments.profile):
+                print("Profile written to %s" % arguments.profile)
+                hook.get_stats().sort_stats("cumulative").print_stats(limit)
+        else:
+            print("Top %d growing allocations:" % limit)
+            for statistic in hook.get_statistics(limit):
+                print(statistic)
@@ -1,14 +1,18 @@
 import argparse
 import os
 import signal
+import time
 
 import mflow
+from mflow.cli import add_profile_arguments, setup_logging, start_profiling, stop_profiling
+from mflow.recording import Writer
 
 
 #TODO: globals?
 counter = 0
 folder = None
 skip_from_message = None
+writer = None
 
 
 def dump(receiver):
@@ -29,6 +33,20 @@ def dump(receiver):
                 f.write(message)
 
 
+def record(receiver):
+    # The first next() waits for the message - the receive time is once it returns.
+    frames = [receiver.next()]
+    timestamp = time.time_ns()
+
+    while receiver.has_more():
+        frame = receiver.next()
+        if not skip_from_message or len(frames) + 1 < skip_from_message:
+            frames.append(frame)
+
+    writer.write(frames, timestamp)
+    return frames
+
+
 def dump_screen(receiver):
     cnt = 0
     message = receiver.next()
@@ -54,6 +72,7 @@ def main():
     global counter
     global folder
     global skip_from_message
+    global writer
 
     parser = argparse.ArgumentParser(description="Stream dump utility")
 
@@ -63,18 +82,34 @@ def main():
                         help="Communication mode - either pull (default) or sub")
     parser.add_argument("-s", "--skip", default=None, type=int,
                         help="Skip sub-messages starting from this number (including number)")
+    parser.add_argument("-f", "--format", default="raw", choices=["raw", "segments"], type=str,
+                        help="File format - a file per sub-message (raw, default) or all messages in indexed segment "
+                             "files (segments)")
+    parser.add_argument("--segment_size", default=1024, type=float,
+                        help="Start a new segment file after this size (MB)")
+    parser.add_argument("--segment_time", default=None, type=float,
+                        help="Start a new segment file after this time (seconds)")
+    add_profile_arguments(parser)
 
     arguments = parser.parse_args()
+    setup_logging()
 
     folder = arguments.folder
     address = arguments.source
     skip_from_message = arguments.skip
     mode = mflow.SUB if arguments.mode == "sub" else mflow.PULL
 
+    if arguments.format == "segments" and not folder:
+        parser.error("the segments format requires a destination folder")
+
     if folder and not os.path.exists(folder):
         os.makedirs(folder)
 
-    stream = mflow.connect(address, mode=mode)
+    # The frames are only copied to the write buffer of the recording.
+    stream = mflow.connect(address, mode=mode, copy=arguments.format != "segments")
+    profiling = start_profiling(arguments)
+    for hook in profiling:
+        hook.attach(stream)
 
     # Signal handling
     global receive_more #TODO: is this correct?
@@ -83,7 +118,8 @@ def main():
     def stop(*args):
         global receive_more
         receive_more = False
-        signal.siginterrupt()
+        # Interrupt a blocking receive
+        raise KeyboardInterrupt
 
     signal.signal(signal.SIGINT, stop)
 
@@ -91,10 +127,21 @@ def main():
     handler = dump
     if not folder:
         handler = dump_screen
-
-    while receive_more:
-        stream.receive(handler=handler)
-        counter += 1
+    elif arguments.format == "segments":
+        handler = record
+        writer = Writer(folder, max_segment_size=int(arguments.segment_size * 1024 * 1024),
+                        max_segment_time=arguments.segment_time)
+
+    try:
+        while receive_more:
+            stream.receive(handler=handler)
+            counter += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if writer is not None:
+            writer.close()
+        stop_profiling(arguments, profiling)
 
 
 
@@ -1,55 +1,293 @@
 import argparse
-import json
+import threading
+import time
+
+import numpy
 
 import mflow
-from mflow.utils import ThroughputStatisticsPrinter
+from mflow.cli import add_profile_arguments, setup_logging, start_profiling, stop_profiling
+from mflow.handlers import array_1_0, dheader_1_0, dimage_1_0, dseries_end_1_0, raw_1_0
+from mflow.pool import SendBufferPool
+from mflow.utils import MONOTONIC, REALTIME, HopStamps, ThroughputStatisticsPrinter, TokenBucket
+
+
+# Generated messages
+RAW = "raw-1.0"
+ARRAY = "array-1.0"
+SERIES = "dimage-1.0"  # Eiger series: dheader-1.0, dimage-1.0 x series length, dseries_end-1.0
+
+HTYPES = (RAW, ARRAY, SERIES)
+
+# Content of the data
+ZEROS = "zeros"
+COUNTER = "counter"  # Every element is the frame number.
+RAMP = "ramp"        # 0, 1, 2, ... shifted by the frame number (wrapping around for integer types).
+RANDOM = "random"    # Random data, generated once.
+
+PATTERNS = (ZEROS, COUNTER, RAMP, RANDOM)
+
+
+class MessageGenerator:
+    """
+    Generate the frames of the messages of one sender. Every header carries the source, a sequence number (counting
+    all the messages of the source) and the send time (time.time_ns()).
+    """
+
+    def __init__(self, htype=RAW, dtype="int32", shape=(1, 262144), pattern=COUNTER, series_length=100,
+                 source="generator", buffers=16, stamps=None):
+        """
+        :param htype: RAW, ARRAY or SERIES.
+        :param dtype: Numpy dtype of the data.
+        :param shape: Shape of the data - (height, width) of the images of a series.
+        :param pattern: Content of the data - see PATTERNS.
+        :param series_length: Number of images of a series.
+        :param source: Source of the messages.
+        :param buffers: Number of send buffers - see SendBufferPool.
+        :param stamps: mflow.utils.HopStamps to stamp the headers with (see Stream.enable_stamps()).
+        """
+        if htype not in HTYPES:
+            raise ValueError("Unsupported htype [%s] - supported: %s" % (htype, ", ".join(HTYPES)))
+        if pattern not in PATTERNS:
+            raise ValueError("Unsupported pattern [%s] - supported: %s" % (pattern, ", ".join(PATTERNS)))
+        if htype == SERIES and len(shape) != 2:
+            raise ValueError("The images of a series need a 2 dimensional shape, not %s" % (shape, ))
+
+        self.htype = htype
+        self.dtype = numpy.dtype(dtype)
+        self.shape = tuple(int(size) for size in shape)
+        self.pattern = pattern
+        self.series_length = series_length
+        self.source = source
+        self.buffer_pool = SendBufferPool(buffers)
+        self.stamps = stamps
+
+        self.sequence = 0
+        self.series = 0
+        # Frame number - within the series for SERIES.
+        self.frame = 0
+        self._series_started = False
+
+        self._base = None
+        if pattern == RAMP:
+            self._base = numpy.arange(numpy.prod(self.shape)).reshape(self.shape)
+        elif pattern == RANDOM:
+            self._base = (numpy.random.default_rng().random(self.shape) * 1000).astype(self.dtype)
+
+        self._detector_header = None
+
+
+    def next(self):
+        """
+        :return: Frames of the next message and the send buffer used by the message (None if none), to be tracked with
+                 buffer_pool.track once sent.
+        """
+        if self.htype != SERIES:
+            data = self._data()
+            header = self._header(self.htype, type=self.dtype.name, shape=list(self.shape), frame=self.frame)
+            if self.htype == RAW:
+                frames = raw_1_0.Handler.frames({"header": header, "data": [data]})
+            else:
+                frames = array_1_0.Handler.frames({"header": header, "data": [data]})
+            self.frame += 1
+            return frames, data
+
+        if self.frame == 0 and not self._series_started:
+            self._series_started = True
+            return dheader_1_0.Handler.frames(self._detector_header_message()), None
+
+        if self.frame == self.series_length:
+            frames = dseries_end_1_0.Handler.frames({"header": self._header("dseries_end-1.0", series=self.series)})
+            self.series += 1
+            self.frame = 0
+            self._series_started = False
+            return frames, None
+
+        data = self._data()
+        start_time = time.time_ns()
+        frames = dimage_1_0.Handler.frames({
+            "header": self._header("dimage-1.0", series=self.series, frame=self.frame, hash=""),
+            # The image header gives the shape as [width, height].
+            "part_2": {"htype": "dimage_d-1.0", "shape": list(reversed(self.shape)), "type": self.dtype.name,
+                       "encoding": "<"},
+            "part_3_raw": data,
+            "part_4": {"htype": "dconfig-1.0", "start_time": start_time, "stop_time": start_time, "real_time": 0}
+        })
+        self.frame += 1
+        return frames, data
+
+
+    def _header(self, htype, **fields):
+        header = {"htype": htype, "source": self.source, "sequence": self.sequence, "send_time": time.time_ns()}
+        header.update(fields)
+        self.sequence += 1
+        if self.stamps is not None:
+            self.stamps.stamp(header)
+        return header
+
+
+    def _data(self):
+        # Only reuse a buffer once it was sent.
+        data = self.buffer_pool.acquire(self.dtype, self.shape)
+
+        if self.pattern == ZEROS:
+            data.fill(0)
+        elif self.pattern == COUNTER:
+            data.fill(self.frame)
+        elif self.pattern == RAMP:
+            numpy.add(self._base, self.frame, out=data, casting="unsafe")
+        else:
+            numpy.copyto(data, self._base)
+        return data
+
+
+    def _detector_header_message(self):
+        height, width = self.shape
+        if self._detector_header is None:
+            # Static parts of the header (the maps are sent without copying, so they must not change).
+            self._detector_header = {
+                "part_2": {"htype": "dconfig-1.0", "nimages": self.series_length, "ntrigger": 1,
+                           "x_pixels_in_detector": width, "y_pixels_in_detector": height,
+                           "bit_depth_image": self.dtype.itemsize * 8, "description": "mflow generator"},
+                "part_3": {"htype": "dflatfield-1.0", "shape": [width, height], "type": "float32"},
+                "part_4_raw": numpy.ones(self.shape, dtype=numpy.float32),
+                "part_5": {"htype": "dpixelmask-1.0", "shape": [width, height], "type": "uint32"},
+                "part_6_raw": numpy.zeros(self.shape, dtype=numpy.uint32),
+                "part_7": {"htype": "dcountrate_table-1.0", "shape": [2, 1000], "type": "float32"},
+                "part_8_raw": numpy.zeros((1000, 2), dtype=numpy.float32)
+            }
+
+        message = {"header": self._header("dheader-1.0", header_detail="all", series=self.series)}
+        message.update(self._detector_header)
+        return message
+
+
+
+def send(stream, generator, rate=None, count=None, statistics=None, stop_event=None):
+    """
+    Send the messages of a generator.
+    :param stream: Stream connected with copy=False.
+    :param generator: MessageGenerator.
+    :param rate: Messages per second (None = as fast as possible).
+    :param count: Number of messages to send (None = until stopped).
+    :param statistics: mflow.Statistics to update with the messages sent.
+    :param stop_event: threading.Event to stop sending.
+    """
+    bucket = TokenBucket(rate) if rate else None
+    if statistics is None:
+        statistics = mflow.Statistics()
+
+    while (count is None or statistics.messages_received < count) and not (stop_event and stop_event.is_set()):
+        if bucket is not None:
+            bucket.acquire()
+
+        frames, data = generator.next()
+        if data is None:
+            stream.send_multipart(frames)
+        else:
+            # The tracker covers all the frames - the buffer is only reused once its own (zero-copy) frame was sent,
+            # not when the last frame was, e.g. the small part_4 of a dimage-1.0, copied and done right away.
+            generator.buffer_pool.track(stream.send_multipart(frames, copy=False, track=True), data)
+
+        statistics.total_bytes_received += sum(memoryview(frame).nbytes for frame in frames)
+        statistics.messages_received += 1
+
 
 
 def main():
     parser = argparse.ArgumentParser(description="Stream generation utility")
 
-    parser.add_argument("-a", "--address", default="tcp://*:9999", type=str,
-                        help='Address - format "tcp://<address>:<port>"')
+    parser.add_argument("-a", "--address", default=None, type=str, action="append",
+                        help='Address - format "tcp://<address>:<port>" (default: "tcp://*:9999"). Can be given '
+                             'several times - every address is sent to by its own thread')
     parser.add_argument("-s", "--size", default=1, type=float,
-                        help='Size of data to send (MB)"')
+                        help='Size of data to send (MB), if no shape is given')
     parser.add_argument("-m", "--mode", default="push", type=str,
                         help="Communication mode - either push (default) or pub")
+    parser.add_argument("-b", "--buffers", default=16, type=int,
+                        help="Number of send buffers - messages are sent without copying from a pool of recycled "
+                             "buffers")
+    parser.add_argument("-t", "--htype", default=RAW, choices=HTYPES, type=str,
+                        help="Messages to send - %s sends Eiger series (dheader-1.0, images, dseries_end-1.0)" % SERIES)
+    parser.add_argument("-d", "--dtype", default="int32", type=str, help="Data type, e.g. uint16")
+    parser.add_argument("--shape", default=None, type=str,
+                        help='Shape of the data, e.g. "512,1024" (height, width for images)')
+    parser.add_argument("-p", "--pattern", default=COUNTER, choices=PATTERNS, type=str, help="Content of the data")
+    parser.add_argument("-l", "--series_length", default=100, type=int, help="Number of images of a series")
+    parser.add_argument("-r", "--rate", default=None, type=float,
+                        help="Total message rate (Hz), shared by the senders (default: as fast as possible)")
+    parser.add_argument("-n", "--count", default=None, type=int, help="Number of messages to send per address")
+    parser.add_argument("--stamp", action="store_true",
+                        help="Stamp the headers (hop name: address), to measure the latency of each hop")
+    parser.add_argument("--stamp_clock", default=REALTIME, choices=(REALTIME, MONOTONIC), type=str,
+                        help="Clock of the stamps - monotonic only works if all hops are on the same host")
+    add_profile_arguments(parser)
 
     arguments = parser.parse_args()
-    address = arguments.address
-    size = arguments.size
+    setup_logging()
+    addresses = arguments.address or ["tcp://*:9999"]
     mode = mflow.PUB if arguments.mode == "pub" else mflow.PUSH
+    dtype = numpy.dtype(arguments.dtype)
+
+    if arguments.shape:
+        shape = tuple(int(size) for size in arguments.shape.split(","))
+    else:
+        size_bytes = int(arguments.size * 1024 * 1024)
+        shape = (1, size_bytes // dtype.itemsize)
+    if arguments.htype == SERIES and len(shape) != 2:
+        parser.error("the images of a series need a 2 dimensional shape (--shape)")
 
-    stream = mflow.connect(address, conn_type="bind", mode=mode)
+    print("Sending %s messages of shape %s (%s, %.3f MB) to %s" % (
+        arguments.htype, shape, dtype.name, numpy.prod(shape) * dtype.itemsize / 1024 / 1024, ", ".join(addresses)))
 
-    size_bytes = int(size * 1024 * 1024)
-    header = {"htype": "raw-1.0", "type": "int32", "shape": [1, size_bytes/4]}
-    data = bytearray(size_bytes)
+    stop_event = threading.Event()
+    profiling = start_profiling(arguments)
+    generators = []
+    senders = []
+    sender_statistics = []
+    for index, address in enumerate(addresses):
+        stream = mflow.connect(address, conn_type="bind", mode=mode, copy=False)
+        for hook in profiling:
+            hook.attach(stream)
+        generator = MessageGenerator(arguments.htype, dtype, shape, arguments.pattern, arguments.series_length,
+                                     source="generator-%d" % index, buffers=arguments.buffers,
+                                     stamps=HopStamps(address, arguments.stamp_clock) if arguments.stamp else None)
+        statistics = mflow.Statistics()
 
-    print("Sending messages of size %f MB" % size)
+        def run(stream=stream, generator=generator, statistics=statistics):
+            try:
+                send(stream, generator, rate=arguments.rate / len(addresses) if arguments.rate else None,
+                     count=arguments.count, statistics=statistics, stop_event=stop_event)
+            finally:
+                stream.disconnect()
 
-    statistics = ThroughputStatisticsPrinter()
-    message_statistics = argparse.Namespace(total_bytes_received=0)
+        generators.append(generator)
+        sender_statistics.append(statistics)
+        senders.append(threading.Thread(target=run, name="mflow-generate-%d" % index, daemon=True))
 
-    counter = 0
+    for sender in senders:
+        sender.start()
+
+    statistics_printer = ThroughputStatisticsPrinter()
+    total_statistics = mflow.Statistics()
     try:
-        while True:
-            # Sending random data
-            # stream.send(os.urandom(size * 8), send_more=False)  # Slow - cryptographically strong random numbers
-            # stream.send(numpy.random.random(size), send_more=False)  # Fast - random numbers
-
-            header["frame"] = counter
-            stream.send(json.dumps(header).encode("utf-8"), send_more=True)
-            stream.send(data, send_more=False)
-            counter += 1
-
-            # Not totally correct - the total bytes do not take into account the header.
-            message_statistics.total_bytes_received += size_bytes
-            message_statistics.messages_received = counter
-            statistics.save_statistics(message_statistics)
+        while any(sender.is_alive() for sender in senders):
+            time.sleep(0.1)
+            total_statistics.total_bytes_received = sum(s.total_bytes_received for s in sender_statistics)
+            total_statistics.messages_received = sum(s.messages_received for s in sender_statistics)
+            statistics_printer.save_statistics(total_statistics)
     except KeyboardInterrupt:
         print("Terminated by user.")
-        statistics.close()
+        stop_event.set()
+        for sender in senders:
+            sender.join()
+
+    statistics_printer.close()
+    stop_profiling(arguments, profiling)
+    for address, generator in zip(addresses, generators):
+        pool = generator.buffer_pool
+        print("%s - send buffers: %d allocated, %d waits (average %.3f ms, max %.3f ms)" %
+              (address, pool.buffers_free + pool.buffers_in_flight, pool.waits, pool.average_wait_time * 1000,
+               pool.max_wait_time * 1000))
 
 
 
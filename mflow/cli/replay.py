@@ -1,16 +1,29 @@
 import argparse
+import glob
 import os
+import time
 from os import listdir
 from os.path import isfile, join
 
 import mflow
+from mflow.cli import add_profile_arguments, setup_logging, start_profiling, stop_profiling
 
 
-def replay_folder(bind_address, folder, mode):
+# Replay timing
+FAST = "fast"          # As fast as possible.
+RATE = "rate"          # Fixed message rate.
+ORIGINAL = "original"  # Inter-arrival times of the recording (receive timestamps).
+
+TIMINGS = (FAST, RATE, ORIGINAL)
+
+
+def replay_folder(bind_address, folder, mode, hooks=()):
     if not os.path.exists(folder):
         raise ValueError("Specified folder '%s' does not exist.")
 
     stream = mflow.connect(bind_address, conn_type="bind", mode=mode)
+    for hook in hooks:
+        hook.attach(stream)
 
     files = sorted(listdir(folder))
 
@@ -28,29 +41,206 @@ def replay_folder(bind_address, folder, mode):
             stream.send(file_handle.read(), send_more=send_more)
 
 
+
+class ReplayStatistics:
+
+    def __init__(self, target_rate=None):
+        # Target message rate (None = as fast as possible)
+        self.target_rate = target_rate
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        # Maximum delay behind the schedule, in seconds (original timing)
+        self.max_lag = 0.0
+
+        self.start_time = time.monotonic()
+        self.end_time = None
+
+
+    @property
+    def elapsed_time(self):
+        return (self.end_time or time.monotonic()) - self.start_time
+
+
+    @property
+    def rate(self):
+        elapsed_time = self.elapsed_time
+        return self.messages_sent / elapsed_time if elapsed_time else 0.0
+
+
+    def __str__(self):
+        target = "as fast as possible" if self.target_rate is None else "target %.1f Hz" % self.target_rate
+        text = "Sent %d messages (%.3f MB) in %.3f s - %.1f Hz (%s), %.3f MB/s" % (
+            self.messages_sent, self.bytes_sent / 10**6, self.elapsed_time, self.rate, target,
+            self.bytes_sent / 10**6 / self.elapsed_time if self.elapsed_time else 0.0)
+        if self.max_lag:
+            text += ", max lag %.3f ms" % (self.max_lag * 1000)
+        return text
+
+
+
+def replay_recording(bind_addresses, folder, mode, timing=FAST, rate=None, speed=1.0, loops=1, round_robin=False,
+                     prefix="recording", report_interval=1.0, queue_size=100, statistics=None, hooks=()):
+    """
+    Replay a recording written by m_dump -f segments (mflow.recording.Writer). The recording is memory mapped and the
+    frames are sent without copying them.
+    :param bind_addresses: Addresses to bind to - every message is sent to all of them (see round_robin).
+    :param folder: Folder of the recording.
+    :param mode: PUSH or PUB.
+    :param timing: FAST (as fast as possible), RATE (fixed rate) or ORIGINAL (recorded inter-arrival times).
+    :param rate: Messages per second, with the RATE timing.
+    :param speed: Speed multiplier of the ORIGINAL timing.
+    :param loops: Number of times to replay the recording (0 = forever).
+    :param round_robin: Distribute the messages over the addresses, instead of sending each message to all of them.
+    :param prefix: Name prefix of the segment files.
+    :param report_interval: Print the achieved rate every this many seconds (None = only at the end).
+    :param queue_size: Send queue size of the sockets.
+    :param statistics: ReplayStatistics to update, e.g. to still have them if the replay is interrupted.
+    :param hooks: Hooks to attach to the streams, e.g. mflow.hooks.ProfileHook.
+    :return: ReplayStatistics.
+    """
+    from mflow.recording import Reader
+    from mflow.utils import TokenBucket
+
+    if timing not in TIMINGS:
+        raise ValueError("Unsupported timing [%s] - supported: %s" % (timing, ", ".join(TIMINGS)))
+    if timing == RATE and not rate:
+        raise ValueError("The rate timing requires a rate")
+
+    streams = [mflow.connect(address, conn_type=mflow.BIND, mode=mode, queue_size=queue_size, copy=False)
+               for address in bind_addresses]
+    for hook in hooks:
+        hook.attach(*streams)
+
+    with Reader(folder, prefix=prefix) as reader:
+        if statistics is None:
+            statistics = ReplayStatistics()
+        try:
+            n_messages = len(reader)
+            if not n_messages:
+                raise ValueError("No recording found in '%s'" % folder)
+
+            bucket = None
+            offsets = None
+            if timing == RATE:
+                bucket = TokenBucket(rate)
+                statistics.target_rate = rate
+            elif timing == ORIGINAL:
+                timestamps = reader.index["timestamp"]
+                # Send time of each message, relative to the start of the loop.
+                offsets = ((timestamps - timestamps[0]) / 10**9 / speed).tolist()
+                if offsets[-1] > 0:
+                    statistics.target_rate = (n_messages - 1) / offsets[-1]
+
+            statistics.start_time = time.monotonic()
+            next_report = statistics.start_time + report_interval if report_interval else None
+
+            loop = 0
+            while not loops or loop < loops:
+                loop_start = time.monotonic()
+
+                for number in range(n_messages):
+                    if bucket is not None:
+                        bucket.acquire()
+                    elif offsets is not None:
+                        delay = loop_start + offsets[number] - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                        elif -delay > statistics.max_lag:
+                            statistics.max_lag = -delay
+
+                    frames = reader.frames(number)
+                    if round_robin:
+                        streams[statistics.messages_sent % len(streams)].send_multipart(frames, track=False)
+                    else:
+                        for stream in streams:
+                            stream.send_multipart(frames, track=False)
+
+                    statistics.messages_sent += 1
+                    statistics.bytes_sent += sum(len(frame) for frame in frames)
+
+                    if next_report is not None and time.monotonic() >= next_report:
+                        print(statistics)
+                        next_report += report_interval
+
+                loop += 1
+
+        finally:
+            statistics.end_time = time.monotonic()
+            # Send the queued messages before unmapping the recording.
+            for stream in streams:
+                stream.disconnect()
+
+    return statistics
+
+
+def is_recording(folder, prefix="recording"):
+    from mflow.recording import INDEX_SUFFIX
+    return bool(glob.glob(os.path.join(glob.escape(folder), glob.escape(prefix) + "_*" + INDEX_SUFFIX)))
+
+
 def main():
     parser = argparse.ArgumentParser(description="Stream replay utility")
 
     parser.add_argument("folder", type=str, help="Destination folder")
-    parser.add_argument("-a", "--address", default="tcp://*:9999", type=str,
-                        help='Address - format "tcp://<address>:<port>" (default: "tcp://*:9999")')
+    parser.add_argument("-a", "--address", default=None, type=str, action="append",
+                        help='Address - format "tcp://<address>:<port>" (default: "tcp://*:9999"). Can be given '
+                             'several times to send the stream to several addresses')
     parser.add_argument("-m", "--mode", default="push", type=str,
                         help="Communication mode - either push (default) or pub")
+    parser.add_argument("-t", "--timing", default=FAST, choices=TIMINGS, type=str,
+                        help="Send as fast as possible (default), at a fixed rate or with the original timing of the "
+                             "recording")
+    parser.add_argument("-r", "--rate", default=None, type=float,
+                        help="Message rate (Hz) of the rate timing")
+    parser.add_argument("-s", "--speed", default=1.0, type=float,
+                        help="Speed multiplier of the original timing")
+    parser.add_argument("-l", "--loop", default=1, type=int,
+                        help="Number of times to replay the recording (0 = forever)")
+    parser.add_argument("--round_robin", action="store_true",
+                        help="Distribute the messages over the addresses, instead of sending all of them to each "
+                             "address")
+    parser.add_argument("-i", "--report_interval", default=1.0, type=float,
+                        help="Interval (seconds) to print the achieved rate")
+    add_profile_arguments(parser)
 
     arguments = parser.parse_args()
+    setup_logging()
 
     folder = arguments.folder
-    address = arguments.address
+    addresses = arguments.address or ["tcp://*:9999"]
     mode = mflow.PUB if arguments.mode == "pub" else mflow.PUSH
 
-    replay_folder(address, folder, mode)
+    # Recordings made with m_dump -f segments, otherwise the files of m_dump - which are just sent once, in order.
+    legacy = not is_recording(folder)
+    if legacy and (len(addresses) > 1 or arguments.timing != FAST or arguments.rate is not None or
+                   arguments.speed != 1.0 or arguments.loop != 1 or arguments.round_robin):
+        parser.error("a folder of m_dump files (not a recording of m_dump -f segments) is replayed once to one "
+                     "address - --timing, --rate, --speed, --loop, --round_robin and several --address are not "
+                     "supported")
 
+    profiling = start_profiling(arguments)
 
+    if legacy:
+        replay_folder(addresses[0], folder, mode, hooks=profiling)
+        stop_profiling(arguments, profiling)
+        return
 
+    if arguments.timing == RATE and not arguments.rate:
+        parser.error("the rate timing requires --rate")
+
+    statistics = ReplayStatistics()
+    try:
+        replay_recording(addresses, folder, mode, timing=arguments.timing, rate=arguments.rate, speed=arguments.speed,
+                         loops=arguments.loop, round_robin=arguments.round_robin,
+                         report_interval=arguments.report_interval, statistics=statistics, hooks=profiling)
+    except KeyboardInterrupt:
+        print("Terminated by user.")
+    print(statistics)
+    stop_profiling(arguments, profiling)
 
 
-if __name__ == "__main__":
-    main()
 
 
 
+if __name__ == "__main__":
+    main()
@@ -2,54 +2,511 @@ import argparse
 import json
 import re
 import signal
+import threading
+import time
+from collections import namedtuple
+
+import zmq
+import zmq.devices
+
+from logging import getLogger
 
 import mflow
+from mflow.cli import add_profile_arguments, setup_logging, start_profiling, stop_profiling
+from mflow.utils import MONOTONIC, REALTIME, HopStamps, ThroughputStatistics
+
+
+logger = getLogger(__name__)
+
+
+def receive_frames(receiver):
+    """
+    Receive all the frames of a message as they are - zmq.Frame objects if the input stream does not copy.
+    :return: List of frames or None if the message could not be received completely.
+    """
+    frames = [receiver.next_frame()]
+    while receiver.has_more():
+        frames.append(receiver.next_frame())
+
+    if None in frames:
+        return None
+    return frames
+
+
+
+def send_noblock(stream, frames):
+    """
+    Send a message only if the output can take it right away. Only the first frame is sent non-blocking: once it is
+    queued, libzmq takes the rest of the message as well, so a message is never cut. Sent via the stream, so the send
+    hooks (e.g. --profile) see it.
+    :return: True if the message was sent.
+    """
+    return stream.send_multipart(frames, block=False, copy=False, track=False) is not False
+
+
+
+# Send policies of the outputs
+BLOCK = "block"              # Wait until the output can take the message - a slow output stalls the splitter.
+DROP_NEWEST = "drop-newest"  # Drop the message if the output cannot take it right away.
+ADAPTIVE = "adaptive"        # Only send every n-th message, n is raised while the output falls behind.
+
+POLICIES = (BLOCK, DROP_NEWEST, ADAPTIVE)
+
+
+class BlockingSend:
+
+    def __init__(self):
+        self.messages_dropped = 0
+
+
+    def send(self, stream, frames):
+        stream.send_multipart(frames, copy=False, track=False)
+        return True
+
+
+
+class DropNewestSend:
+
+    def __init__(self):
+        self.messages_dropped = 0
+
+
+    def send(self, stream, frames):
+        if send_noblock(stream, frames):
+            return True
+
+        self.messages_dropped += 1
+        return False
+
+
+
+class AdaptiveDecimation:
+    """
+    Send every modulo-th message. The modulo is doubled whenever the output cannot take a message, and halved again
+    once the output kept up for the recovery time.
+    """
+
+    def __init__(self, modulo=1, max_modulo=1024, recovery_time=1.0):
+        """
+        :param modulo: Minimum (and initial) modulo.
+        :param max_modulo: Maximum modulo.
+        :param recovery_time: Time in seconds without drops before the modulo is lowered.
+        """
+        self.min_modulo = modulo
+        self.max_modulo = max_modulo
+        self.recovery_time = recovery_time
+        self.modulo = modulo
+
+        self.messages_dropped = 0
+        self.messages_decimated = 0
+
+        self._counter = 0
+        self._last_change = time.monotonic()
+
+
+    def send(self, stream, frames):
+        self._counter += 1
+        if self._counter < self.modulo:
+            self.messages_decimated += 1
+            return False
+        self._counter = 0
+
+        now = time.monotonic()
+        if send_noblock(stream, frames):
+            if self.modulo > self.min_modulo and now - self._last_change >= self.recovery_time:
+                self.modulo = max(self.modulo // 2, self.min_modulo)
+                self._last_change = now
+            return True
+
+        self.messages_dropped += 1
+        self.modulo = min(self.modulo * 2, self.max_modulo)
+        self._last_change = now
+        return False
+
+
+
+def create_policy(policy=BLOCK, **kwargs):
+    """
+    :param policy: BLOCK, DROP_NEWEST or ADAPTIVE.
+    :param kwargs: Parameters of AdaptiveDecimation.
+    """
+    if policy == BLOCK:
+        return BlockingSend()
+    if policy == DROP_NEWEST:
+        return DropNewestSend()
+    if policy == ADAPTIVE:
+        return AdaptiveDecimation(**kwargs)
+    raise ValueError("Unsupported policy [%s] - supported: %s" % (policy, ", ".join(POLICIES)))
+
+
+
+# Control messages are sent to every output, whatever its routing rule, filter or policy.
+CONTROL_HTYPES = ("dheader-1.0", "dseries_end-1.0")
+
+
+def read_header(frame):
+    """
+    Decode the header (first frame) of a message.
+    :return: Header dict - empty if the header cannot be decoded.
+    """
+    try:
+        if isinstance(frame, zmq.Frame):
+            frame = frame.bytes
+        header = mflow.jsonapi.loads(frame)
+        return header if isinstance(header, dict) else {}
+    except Exception:
+        logger.debug("Unable to read header", exc_info=True)
+        return {}
+
+
+_MISSING = object()
+
+
+def compile_route(rule):
+    """
+    Compile a routing rule of the split configuration into a predicate on the message header, e.g.:
+    {
+        "htype": ["array-1.0"],             # htype is one of these (a single value is accepted too)
+        "source": "detector_1",             # source is one of these
+        "frames": [[0, 99], [1000, null]],  # frame is in one of these ranges (inclusive, null = open end)
+        "tags": ["preview"],                # header tags contain at least one of these
+        "keys": {"type": "uint16"}          # header fields equal to these values
+    }
+    All the given conditions have to match.
+    :param rule: Routing rule dict.
+    :return: Function header -> bool.
+    """
+    checks = []
+
+    for key, value in rule.items():
+        if key in ("htype", "source"):
+            checks.append(_match_any(key, value))
+
+        elif key == "frames":
+            checks.append(_match_frames(value))
+
+        elif key == "tags":
+            wanted = frozenset([value] if isinstance(value, str) else value)
+            checks.append(lambda header: any(tag in wanted for tag in header.get("tags") or ()))
+
+        elif key == "keys":
+            for field, expected in value.items():
+                checks.append(_match_any(field, [expected]))
+
+        else:
+            raise ValueError("Unsupported routing condition [%s] in rule %s" % (key, rule))
+
+    if not checks:
+        return lambda header: True
+    if len(checks) == 1:
+        return checks[0]
+    return lambda header: all(check(header) for check in checks)
+
+
+def _match_any(field, values):
+    if isinstance(values, str) or not isinstance(values, (list, tuple)):
+        values = [values]
+    values = tuple(values)
+    return lambda header: header.get(field, _MISSING) in values
+
+
+def _match_frames(ranges):
+    # A single range is accepted as well.
+    if ranges and not isinstance(ranges[0], (list, tuple)):
+        ranges = [ranges]
+    ranges = tuple((first, last) for first, last in ranges)
+
+    def check(header):
+        frame = header.get("frame")
+        if not isinstance(frame, int):
+            return False
+        return any(first <= frame and (last is None or frame <= last) for first, last in ranges)
+
+    return check
+
 
 
 class Splitter:
 
-    def __init__(self, output_streams):
+    def __init__(self, output_streams, output_policies=None, stamps=None):
+        """
+        :param output_streams: Streams to send the messages to.
+        :param output_policies: Send policy of each output (see create_policy) - by default all outputs block.
+        :param stamps: mflow.utils.HopStamps to append the stamp of the splitter to the headers (see
+                       Stream.enable_stamps()).
+        """
         self.output_streams = output_streams
+        self.stamps = stamps
+        self.output_policies = output_policies or [BlockingSend() for _ in output_streams]
+        # Data sent to each output (in the fields of the mflow statistics, so ThroughputStatistics can be used on it)
+        self.output_statistics = [mflow.Statistics() for _ in output_streams]
+
+        self._blocking_send = BlockingSend()
+        self._needs_header = self.needs_header
+
+
+    @property
+    def output_addresses(self):
+        return [stream.address for stream in self.output_streams]
+
+
+    @property
+    def needs_header(self):
+        """
+        The header has to be decoded to tell control messages apart, if not all outputs block.
+        """
+        return not all(isinstance(policy, BlockingSend) for policy in self.output_policies)
 
 
     def receive(self, receiver):
-        while True:
-            message = receiver.next()
-            more = receiver.has_more()
+        frames = receive_frames(receiver)
+        if frames is None:
+            return None
 
-            for stream in self.output_streams:
-                stream.send(message, send_more=more)
+        header = read_header(frames[0]) if self._needs_header or self.stamps is not None else None
+        if self.stamps is not None and header:
+            # Only the header frame is replaced, the data frames are still forwarded as they are.
+            frames = [mflow.jsonapi.dumps(self.stamps.stamp(header))] + frames[1:]
 
-            if not more:
-                break
+        message_size = sum(len(frame) for frame in frames)
+        control = header is not None and header.get("htype") in CONTROL_HTYPES
+        outputs = range(len(self.output_streams)) if control else self._outputs(header)
 
+        for index in outputs:
+            policy = self._blocking_send if control else self.output_policies[index]
+            # The same frames are sent to all outputs - libzmq only counts references.
+            if not policy.send(self.output_streams[index], frames):
+                continue
 
+            statistics = self.output_statistics[index]
+            statistics.total_bytes_received += message_size
+            statistics.messages_received += 1
 
-class FilterSplitter:
+        return frames
 
-    def __init__(self, output_streams, output_filters):
-        self.output_streams = output_streams
+
+    def _outputs(self, header):
+        """
+        :param header: Decoded header of the message (None if not needed).
+        :return: Indexes of the outputs to send the message to.
+        """
+        return range(len(self.output_streams))
+
+
+
+class FilterSplitter(Splitter):
+
+    def __init__(self, output_streams, output_filters, output_policies=None, output_routes=None, stamps=None):
+        """
+        :param output_filters: Filter (e.g. ModuloFilter) of each output - None to send all messages.
+        :param output_routes: Routing predicate (see compile_route) of each output - None to send all messages.
+        """
+        super().__init__(output_streams, output_policies, stamps)
         self.output_filters = output_filters
+        self.output_routes = output_routes or [None for _ in output_streams]
 
 
-    def receive(self, receiver):
-        for ofilter in self.output_filters:
+    @property
+    def needs_header(self):
+        # Control messages bypass the filters and routes
+        return True
+
+
+    def _outputs(self, header):
+        outputs = []
+        for index, (route, ofilter) in enumerate(zip(self.output_routes, self.output_filters)):
+            if route is not None and not route(header):
+                continue
+
+            # Filters only count the messages routed to their output.
             if ofilter:
                 ofilter.update()
+                if not ofilter.check():
+                    continue
 
-        while True:
-            message = receiver.next()
-            more = receiver.has_more()
+            outputs.append(index)
 
-            for stream, ofilter in list(zip(self.output_streams, self.output_filters)):
-                if ofilter:
-                    if ofilter.check():
-                        stream.send(message, send_more=more)
-                else:
-                    stream.send(message, send_more=more)
+        return outputs
 
-            if not more:
-                break
+
+
+# Socket of the raw splitter - the fields are the arguments of mflow.connect.
+Endpoint = namedtuple("Endpoint", ["address", "conn_type", "mode", "queue_size"])
+
+
+class RawSplitter:
+    """
+    Split a stream inside libzmq, without passing the messages through Python: the input is forwarded by a proxy
+    device to an inproc PUB socket, from which one proxy device per output forwards to the output (a single output is
+    forwarded directly). The devices run zmq.proxy on their own threads with the GIL released.
+
+    The capture socket of every device publishes the forwarded messages, which a separate thread counts into mflow
+    statistics (input_statistics and output_statistics). The capture drops messages rather than slowing down the
+    proxies, so under heavy load the statistics can be lower than the actual throughput.
+
+    With several outputs a slow output does not block the others: once its queue (queue_size) is full, the messages
+    are dropped for this output only (as with the drop-newest policy).
+    """
+
+    def __init__(self, source, outputs):
+        """
+        :param source: Endpoint of the input.
+        :param outputs: Endpoints of the outputs.
+        """
+        self.source = source
+        self.outputs = outputs
+        self.output_addresses = [output.address for output in outputs]
+        # The messages dropped by the fan-out are not known.
+        self.output_policies = None
+
+        self.input_statistics = mflow.Statistics()
+        self.output_statistics = [mflow.Statistics() for _ in outputs]
+
+        self._devices = []
+        self._control_sockets = []
+        self._capture_sockets = {}
+        self._capture_thread = None
+        self._stop_event = threading.Event()
+
+
+    def start(self):
+        # The devices create their sockets on their thread, inproc only works within the same context.
+        context = zmq.Context.instance()
+        prefix = "inproc://mflow-split-%x" % id(self)
+
+        if len(self.outputs) == 1:
+            self._add_device(context, prefix, self.source, self.outputs[0], self.output_statistics[0])
+        else:
+            fanout = Endpoint(prefix + "-fanout", mflow.BIND, zmq.PUB, max(output.queue_size for output in self.outputs))
+            self._add_device(context, prefix, self.source, fanout, self.input_statistics)
+            for output, statistics in zip(self.outputs, self.output_statistics):
+                self._add_device(context, prefix, fanout._replace(conn_type=mflow.CONNECT, mode=zmq.SUB), output,
+                                 statistics)
+
+        self._capture_thread = threading.Thread(target=self._capture, name="mflow-split-capture", daemon=True)
+        self._capture_thread.start()
+
+        # Start the output devices first and give them the time to subscribe to the fan-out (slow joiner) - messages
+        # published before are lost.
+        for device in self._devices[1:]:
+            device.start()
+        if len(self._devices) > 1:
+            time.sleep(0.1)
+        self._devices[0].start()
+
+
+    def _add_device(self, context, prefix, input_endpoint, output_endpoint, statistics):
+        number = len(self._devices)
+        device = zmq.devices.ThreadProxySteerable(input_endpoint.mode, output_endpoint.mode, zmq.PUB, zmq.PAIR)
+
+        for side, endpoint in (("in", input_endpoint), ("out", output_endpoint)):
+            setsockopt = getattr(device, "setsockopt_" + side)
+            setsockopt(zmq.SNDHWM, endpoint.queue_size)
+            setsockopt(zmq.RCVHWM, endpoint.queue_size)
+            setsockopt(zmq.LINGER, 1000)
+            if endpoint.mode == zmq.SUB:
+                setsockopt(zmq.SUBSCRIBE, b"")
+            getattr(device, ("bind_" if endpoint.conn_type == mflow.BIND else "connect_") + side)(endpoint.address)
+
+        device.bind_mon("%s-capture-%d" % (prefix, number))
+        device.bind_ctrl("%s-control-%d" % (prefix, number))
+
+        capture_socket = context.socket(zmq.SUB)
+        capture_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        capture_socket.connect("%s-capture-%d" % (prefix, number))
+        self._capture_sockets[capture_socket] = statistics
+
+        control_socket = context.socket(zmq.PAIR)
+        control_socket.connect("%s-control-%d" % (prefix, number))
+        self._control_sockets.append(control_socket)
+
+        self._devices.append(device)
+
+
+    def _capture(self):
+        poller = zmq.Poller()
+        for capture_socket in self._capture_sockets:
+            poller.register(capture_socket, zmq.POLLIN)
+
+        try:
+            while not self._stop_event.is_set():
+                for capture_socket, _ in poller.poll(100):
+                    statistics = self._capture_sockets[capture_socket]
+                    while True:
+                        try:
+                            frames = capture_socket.recv_multipart(zmq.NOBLOCK, copy=False)
+                        except zmq.Again:
+                            break
+                        statistics.total_bytes_received += sum(len(frame) for frame in frames)
+                        statistics.messages_received += 1
+        finally:
+            for capture_socket in self._capture_sockets:
+                capture_socket.close(linger=0)
+
+
+    def stop(self, timeout=1.0):
+        """
+        Stop the devices, the input first. Messages still queued in the devices are dropped.
+        :param timeout: Time to wait for each device, in seconds.
+        """
+        for control_socket, device in zip(self._control_sockets, self._devices):
+            control_socket.send(b"TERMINATE")
+            device.join(timeout)
+            control_socket.close(linger=0)
+        self._control_sockets = []
+
+        self._stop_event.set()
+        if self._capture_thread is not None:
+            self._capture_thread.join(timeout)
+            self._capture_thread = None
+
+
+
+class OutputStatisticsPrinter:
+    """
+    Print the throughput of each output of a splitter.
+    """
+
+    def __init__(self, splitter, sampling_interval=1.0):
+        self.splitter = splitter
+        self.throughput = [ThroughputStatistics(sampling_interval=sampling_interval)
+                           for _ in splitter.output_statistics]
+
+
+    def save_statistics(self):
+        """
+        Should be called at every message received.
+        """
+        for address, statistics, throughput in zip(self.splitter.output_addresses, self.splitter.output_statistics,
+                                                   self.throughput):
+            if throughput.save_statistics(statistics):
+                self._print(address, throughput.get_last_sampled_statistics())
+
+
+    def close(self):
+        """
+        Print the summary of each output.
+        """
+        policies = self.splitter.output_policies or [None for _ in self.throughput]
+        for address, policy, throughput in zip(self.splitter.output_addresses, policies, self.throughput):
+            dropped = "" if policy is None else ", %d dropped" % policy.messages_dropped
+            if getattr(policy, "messages_decimated", None) is not None:
+                dropped += ", %d decimated" % policy.messages_decimated
+            summary = throughput.get_statistics()
+            if summary:
+                print("%s: %d messages, %.3f MB/s, %.3f Hz on average%s" % (
+                    address, summary["messages_received"],
+                    summary["average_data_rate"] * ThroughputStatistics.MB_FACTOR, summary["average_message_rate"],
+                    dropped))
+            else:
+                print("%s: no messages sent%s" % (address, dropped))
+
+
+    @staticmethod
+    def _print(address, sampled_statistics):
+        print("{address: <24} Data rate: {data_rate: >10.3f} MB/s    Message rate: {message_rate: >10.3f} Hz".format(
+            address=address, data_rate=sampled_statistics["data_rate"] * ThroughputStatistics.MB_FACTOR,
+            message_rate=sampled_statistics["message_rate"]))
 
 
 
@@ -77,27 +534,57 @@ def main():
 
     parser.add_argument("source", type=str, nargs="?", help='Source address - format "tcp://<address>:<port>"')
     parser.add_argument("streams", type=str, nargs="*", help='Streams to generate - "tcp://<address>:<port>"')
+    parser.add_argument("-s", "--statistics", type=float, default=None,
+                        help="Print the throughput of each output stream at this interval (seconds)")
+    parser.add_argument("--raw", action="store_true",
+                        help="Split the stream inside libzmq, without passing the messages through Python (outputs "
+                             "must not have a modulo, route or policy)")
+    parser.add_argument("--stamp", default=None, type=str,
+                        help="Append a stamp with this hop name to the headers, to measure the latency of each hop")
+    parser.add_argument("--stamp_clock", default=REALTIME, choices=(REALTIME, MONOTONIC), type=str,
+                        help="Clock of the stamps - monotonic only works if all hops are on the same host")
+    add_profile_arguments(parser)
 
     arguments = parser.parse_args()
+    setup_logging()
+
+    if arguments.raw and arguments.stamp:
+        parser.error("--stamp is not supported in the raw mode")
+    if arguments.raw and (arguments.profile or arguments.profile_memory):
+        parser.error("--profile is not supported in the raw mode")
 
     if arguments.config:
         print("config")
-        (input_stream, splitter) = load_configuration(arguments.config)
+        (input_stream, splitter) = load_configuration(arguments.config, raw=arguments.raw)
     elif arguments.source and arguments.streams:
         streams_to_generate = arguments.streams
         address = arguments.source
 
-        output_streams = []
-        for new_stream in streams_to_generate:
-            output_streams.append(mflow.connect(new_stream, conn_type=mflow.BIND, mode=mflow.PUSH))
+        if arguments.raw:
+            input_stream = None
+            splitter = RawSplitter(Endpoint(address, mflow.CONNECT, mflow.PULL, 100),
+                                   [Endpoint(new_stream, mflow.BIND, mflow.PUSH, 100)
+                                    for new_stream in streams_to_generate])
+        else:
+            output_streams = []
+            for new_stream in streams_to_generate:
+                output_streams.append(mflow.connect(new_stream, conn_type=mflow.BIND, mode=mflow.PUSH))
 
-        splitter = Splitter(output_streams)
-        input_stream = mflow.connect(address)
+            splitter = Splitter(output_streams)
+            # Frames are forwarded without copying them.
+            input_stream = mflow.connect(address, copy=False)
     else:
         parser.error("insufficient arguments given")
 
     # Info: By here splitter and input_stream needs to be specified
 
+    if arguments.stamp:
+        splitter.stamps = HopStamps(arguments.stamp, arguments.stamp_clock)
+
+    profiling = start_profiling(arguments)
+    for hook in profiling:
+        hook.attach(input_stream, *splitter.output_streams)
+
     # Signal handling
     global receive_more #TODO: is this correct?
     receive_more = True
@@ -105,15 +592,40 @@ def main():
     def stop(*args):
         global receive_more
         receive_more = False
-        signal.siginterrupt()
+        # Interrupt a blocking receive
+        raise KeyboardInterrupt
 
     signal.signal(signal.SIGINT, stop)
 
-    while receive_more:
-        input_stream.receive(handler=splitter.receive)
-
-
-def load_configuration(filename):
+    statistics_printer = None
+    if arguments.statistics is not None:
+        statistics_printer = OutputStatisticsPrinter(splitter, sampling_interval=arguments.statistics)
+
+    try:
+        if arguments.raw:
+            splitter.start()
+            # The devices split the stream, only the statistics are left to do.
+            while receive_more:
+                time.sleep(min(arguments.statistics or 1.0, 1.0))
+                if statistics_printer is not None:
+                    statistics_printer.save_statistics()
+        else:
+            while receive_more:
+                input_stream.receive(handler=splitter.receive)
+                if statistics_printer is not None:
+                    statistics_printer.save_statistics()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if arguments.raw:
+            splitter.stop()
+        stop_profiling(arguments, profiling)
+
+    if statistics_printer is not None:
+        statistics_printer.close()
+
+
+def load_configuration(filename, raw=False):
     """
     Read in a configuration file like this:
     {
@@ -129,6 +641,8 @@ def load_configuration(filename):
             }
         ]
     }
+    :param raw: Split the stream with a RawSplitter - outputs must not have a modulo, route or policy.
+    :return: Input stream and splitter - in raw mode the input stream is None, the RawSplitter receives the input.
     """
     # Load configuration file
     with open(filename) as file_handle:
@@ -155,11 +669,13 @@ def load_configuration(filename):
     if "queue_size" in configuration["source"]:
         queue_size = configuration["source"]["queue_size"]
 
-    input_stream = mflow.connect(address, mode=mode, conn_type=connection_type, queue_size=queue_size)
+    source = Endpoint(address, connection_type, mode, queue_size)
 
     # Construct output streams
-    output_streams = []
+    outputs = []
     output_filters = []
+    output_policies = []
+    output_routes = []
     use_filter = False
     for stream in configuration["streams"]:
         address = stream["address"]
@@ -182,18 +698,44 @@ def load_configuration(filename):
         if "queue_size" in stream:
             queue_size = stream["queue_size"]
 
-        if "modulo" in stream:
-            output_filters.append(ModuloFilter(int(stream["modulo"])))
+        policy = stream.get("policy", BLOCK)
+        if raw and (policy != BLOCK or "modulo" in stream or "route" in stream):
+            raise ValueError("The raw mode does not support modulo, route and policy - stream [%s]" % stream)
+
+        if policy == ADAPTIVE:
+            # The modulo is the minimum of the adaptive decimation.
+            output_policies.append(create_policy(ADAPTIVE, modulo=int(stream.get("modulo", 1)),
+                                                 max_modulo=int(stream.get("max_modulo", 1024)),
+                                                 recovery_time=float(stream.get("recovery_time", 1.0))))
+            output_filters.append(None)
+        else:
+            output_policies.append(create_policy(policy))
+
+            if "modulo" in stream:
+                output_filters.append(ModuloFilter(int(stream["modulo"])))
+                use_filter = True
+            else:
+                output_filters.append(None)
+
+        if "route" in stream:
+            output_routes.append(compile_route(stream["route"]))
             use_filter = True
         else:
-            output_filters.append(None)
+            output_routes.append(None)
+
+        outputs.append(Endpoint(address, connection_type, mode, queue_size))
+
+    if raw:
+        return None, RawSplitter(source, outputs)
 
-        output_streams.append(mflow.connect(address, conn_type=connection_type, mode=mode, queue_size=queue_size))
+    # Frames are forwarded without copying them.
+    input_stream = mflow.connect(*source, copy=False)
+    output_streams = [mflow.connect(*output) for output in outputs]
 
     if use_filter:
-        res = FilterSplitter(output_streams, output_filters)
+        res = FilterSplitter(output_streams, output_filters, output_policies, output_routes)
     else:
-        res = Splitter(output_streams)
+        res = Splitter(output_streams, output_policies)
 
     return input_stream, res
 
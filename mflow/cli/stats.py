@@ -1,7 +1,10 @@
 import argparse
+import json
+import time
 
 import mflow
-from mflow.utils import ThroughputStatisticsPrinter
+from mflow.cli import add_profile_arguments, setup_logging, start_profiling, stop_profiling
+from mflow.utils import SequenceTracker, ThroughputStatistics, ThroughputStatisticsPrinter
 
 
 def main():
@@ -12,40 +15,113 @@ def main():
     parser.add_argument("-i", "--sampling_interval", type=float, default=0.5,
                         help="Interval in seconds at which to sample the stream.\n"
                              "If zero, every packet will be sampled.")
+    latency = parser.add_mutually_exclusive_group()
+    latency.add_argument("-l", "--latency", action="store_true",
+                         help="Show the latency percentiles of the receive stages for every interval.")
+    latency.add_argument("-s", "--stamps", action="store_true",
+                         help="Show the latency percentiles of each hop for every interval, from the stamps in the "
+                              "headers (see m_generate --stamp).")
+    parser.add_argument("-k", "--key", default="frame", type=str,
+                        help="Header key with the sequence number of the messages (default: frame)")
+    parser.add_argument("-j", "--json", action="store_true",
+                        help="Print the statistics of every interval as a JSON line")
+    add_profile_arguments(parser)
     arguments = parser.parse_args()
+    setup_logging()
 
     address = arguments.source
     mode = mflow.SUB if arguments.mode == "sub" else mflow.PULL
-    stream = mflow.connect(address, mode=mode, receive_timeout=1000)
-    statistics_printer = ThroughputStatisticsPrinter(sampling_interval=arguments.sampling_interval)
-
-    print("mflow stats started. Sampling interval is %.2f seconds." % arguments.sampling_interval)
-    print("_" * 60)
+    # Only the header is decoded, the data is received without copying.
+    stream = mflow.connect(address, mode=mode, receive_timeout=1000, copy=False)
+    timings = None
+    if arguments.latency:
+        timings = stream.enable_timing()
+    elif arguments.stamps:
+        timings = stream.enable_stamps("m_stats")
+    tracker = SequenceTracker(key=arguments.key)
+    profiling = start_profiling(arguments)
+    for hook in profiling:
+        hook.attach(stream)
+
+    if arguments.json:
+        statistics = ThroughputStatistics(sampling_interval=arguments.sampling_interval)
+    else:
+        statistics = ThroughputStatisticsPrinter(sampling_interval=arguments.sampling_interval, timings=timings)
+        print("mflow stats started. Sampling interval is %.2f seconds." % arguments.sampling_interval)
+        print("_" * 60)
 
     try:
         while True:
-            message = stream.receive(handler=dump)
+            message = stream.receive(handler=read_header)
             if message is not None:
-                statistics_printer.save_statistics(message.statistics)
+                tracker.update(message.data["header"], message.data["nbytes"])
+
+            # Also sampled while no messages arrive (once the first one did).
+            if stream.receiver.statistics.messages_received and \
+                    statistics.save_statistics(stream.receiver.statistics):
+                if arguments.json:
+                    print_json(statistics, tracker)
+                else:
+                    print_sequences(tracker)
     except KeyboardInterrupt:
         stream.disconnect()
-        # Flush and Print summary.
-        statistics_printer.close()
-
+        stop_profiling(arguments, profiling)
 
-def dump(receiver):
+        # Flush and Print summary.
+        if arguments.json:
+            if statistics.flush():
+                print_json(statistics, tracker)
+            print(json.dumps({"time": time.time(), "summary": statistics.get_statistics(),
+                              "rates": statistics.get_rolling_statistics(),
+                              "sequences": tracker.get_statistics()}), flush=True)
+        else:
+            statistics.close()
+            print_sequences(tracker, summary=True)
+
+
+def read_header(receiver):
     """
-    Just read the stream.
+    Decode the header of the message - the data frames are only counted.
     :param receiver: Function to use as a receiver.
-    :return: 1 if the reception was successful, None if it timed out.
+    :return: Dict with the header and the size of the message (nbytes), None if the reception timed out.
     """
-    data = receiver.next()
+    header = receiver.next(as_json=True)
     while receiver.has_more():
         # If any of the message parts time outed (the only way a message part can be None)
-        if receiver.next() is None:
+        if receiver.next_frame() is None:
             return None
-    # Return 1 only for valid data.
-    return 1 if data else None
+
+    if not isinstance(header, dict):
+        return None
+    return {"header": header, "nbytes": receiver.statistics.bytes_received}
+
+
+def print_sequences(tracker, summary=False):
+    """
+    Print the statistics of each source and htype.
+    :param summary: Print the totals instead of the rates of the last interval.
+    """
+    for sequence in tracker.get_statistics(now=None if summary else time.time()):
+        if summary:
+            rates = "{: >10d} messages {: >10.3f} MB".format(
+                sequence["messages_received"], sequence["total_bytes_received"] * ThroughputStatistics.MB_FACTOR)
+        else:
+            rates = "{: >10.3f} MB/s {: >10.3f} Hz".format(
+                sequence["data_rate"] * ThroughputStatistics.MB_FACTOR, sequence["message_rate"])
+
+        print("  {: <32}{}    lost: {}    duplicated: {}    out of order: {}    gaps: {} (max {})".format(
+            "%s %s" % (sequence["source"] or "-", sequence["htype"]), rates, sequence["messages_lost"],
+            sequence["messages_duplicated"], sequence["messages_out_of_order"], sequence["gaps"],
+            sequence["max_gap"]))
+
+
+def print_json(statistics, tracker):
+    sampled_statistics = statistics.get_last_sampled_statistics()
+    print(json.dumps({"time": time.time(), "data_rate": sampled_statistics["data_rate"],
+                      "message_rate": sampled_statistics["message_rate"],
+                      "ewma_data_rate": statistics.rolling.ewma_data_rate,
+                      "ewma_message_rate": statistics.rolling.ewma_message_rate,
+                      "sequences": tracker.get_statistics(now=time.time())}), flush=True)
 
 
 
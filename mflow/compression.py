@@ -0,0 +1,262 @@
+import os
+import struct
+import threading
+import zlib
+from logging import getLogger
+
+import numpy
+
+
+logger = getLogger(__name__)
+
+
+# Encodings of uncompressed data ("<" and ">" are used by the Dectris streams to give the byte order).
+UNCOMPRESSED = (None, "", "raw", "<", ">")
+
+# Messages with more than one segment and at least this many bytes in total are (de)compressed on the thread pool.
+# The codec libraries release the GIL, so the segments are processed on several cores.
+PARALLEL_THRESHOLD = 1024 * 1024
+
+# Default block size of the bitshuffle filter, in bytes.
+BITSHUFFLE_BLOCK_SIZE = 8192
+
+
+class ZlibCodec:
+
+    def __init__(self, level=6):
+        self.level = level
+
+
+    def compress(self, data, dtype=None):
+        return zlib.compress(data, self.level)
+
+
+    def decompress(self, data, nbytes, dtype=None):
+        return zlib.decompress(data, bufsize=nbytes)
+
+
+
+class LZMACodec:
+
+    def __init__(self, preset=1):
+        import lzma
+        self.lzma = lzma
+        self.preset = preset
+
+
+    def compress(self, data, dtype=None):
+        return self.lzma.compress(data, preset=self.preset)
+
+
+    def decompress(self, data, nbytes, dtype=None):
+        return self.lzma.decompress(data)
+
+
+
+class LZ4Codec:
+    """
+    LZ4 block format without size prefix - the size is given by the shape and type of the array (as in the Dectris
+    "lz4<" encoding).
+    """
+
+    def __init__(self):
+        import lz4.block
+        self.lz4 = lz4.block
+
+
+    def compress(self, data, dtype=None):
+        return self.lz4.compress(data, store_size=False)
+
+
+    def decompress(self, data, nbytes, dtype=None):
+        return self.lz4.decompress(data, uncompressed_size=nbytes)
+
+
+
+class ZstdCodec:
+
+    def __init__(self, level=3):
+        import zstandard
+        self.zstandard = zstandard
+        self.level = level
+        # Compression contexts must not be shared between threads.
+        self._local = threading.local()
+
+
+    def compress(self, data, dtype=None):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = self._local.compressor = self.zstandard.ZstdCompressor(level=self.level)
+        return compressor.compress(data)
+
+
+    def decompress(self, data, nbytes, dtype=None):
+        decompressor = getattr(self._local, "decompressor", None)
+        if decompressor is None:
+            decompressor = self._local.decompressor = self.zstandard.ZstdDecompressor()
+        return decompressor.decompress(data, max_output_size=nbytes)
+
+
+
+class BitshuffleLZ4Codec:
+    """
+    Bitshuffle + LZ4, with the 12 byte header of the HDF5 filter (and the Dectris "bs32-lz4<" encodings): big endian
+    uint64 uncompressed size and uint32 block size in bytes.
+    """
+
+    header = struct.Struct(">QI")
+
+    def __init__(self, element_size=None):
+        """
+        :param element_size: Size of the shuffled elements in bytes - by default the item size of the array.
+        """
+        import bitshuffle
+        self.bitshuffle = bitshuffle
+        self.element_size = element_size
+
+
+    def _element_type(self, dtype):
+        return numpy.dtype("u%d" % (self.element_size or numpy.dtype(dtype or "u1").itemsize))
+
+
+    def compress(self, data, dtype=None):
+        element_type = self._element_type(dtype)
+        block_size = max(BITSHUFFLE_BLOCK_SIZE // element_type.itemsize // 8 * 8, 128)
+
+        elements = numpy.frombuffer(data, dtype=element_type)
+        compressed = self.bitshuffle.compress_lz4(elements, block_size)
+        return self.header.pack(elements.nbytes, block_size * element_type.itemsize) + compressed.tobytes()
+
+
+    def decompress(self, data, nbytes, dtype=None):
+        element_type = self._element_type(dtype)
+        size, block_size = self.header.unpack_from(data)
+
+        compressed = numpy.frombuffer(data, dtype=numpy.uint8, offset=self.header.size)
+        return self.bitshuffle.decompress_lz4(compressed, (size // element_type.itemsize, ), element_type,
+                                              block_size // element_type.itemsize)
+
+
+
+_codec_factories = {
+    "zlib": ZlibCodec,
+    "lzma": LZMACodec,
+    "lz4": LZ4Codec,
+    "zstd": ZstdCodec,
+    "bitshuffle-lz4": BitshuffleLZ4Codec,
+    # Dectris stream encodings
+    "lz4<": LZ4Codec,
+    "bs32-lz4<": lambda: BitshuffleLZ4Codec(4),
+    "bs16-lz4<": lambda: BitshuffleLZ4Codec(2),
+    "bs8-lz4<": lambda: BitshuffleLZ4Codec(1),
+}
+
+# Codecs by encoding, created on first use (lz4, zstandard and bitshuffle are optional dependencies).
+codecs = {}
+
+
+def get_codec(encoding):
+    """
+    :param encoding: Encoding as found in the header, e.g. "zstd".
+    :return: Codec with compress(data, dtype) and decompress(data, nbytes, dtype) methods.
+    """
+    codec = codecs.get(encoding)
+    if codec is None:
+        factory = _codec_factories.get(encoding)
+        if factory is None:
+            raise ValueError("Unsupported encoding [%s] - supported: %s" % (encoding, ", ".join(_codec_factories)))
+
+        try:
+            codec = factory()
+        except ImportError as e:
+            raise ValueError("Encoding [%s] requires the %s package" % (encoding, e.name)) from e
+
+        codecs[encoding] = codec
+    return codec
+
+
+def is_compressed(encoding):
+    return encoding not in UNCOMPRESSED
+
+
+_executor = None
+_threads = None
+_executor_lock = threading.Lock()
+
+
+def set_threads(threads):
+    """
+    Set the number of threads used to (de)compress the segments of a message.
+    :param threads: Number of threads (None = number of CPUs).
+    """
+    global _executor, _threads
+
+    with _executor_lock:
+        _threads = threads
+        if _executor is not None:
+            _executor.shutdown(wait=False)
+            _executor = None
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(max_workers=_threads or os.cpu_count(), thread_name_prefix="mflow-codec")
+        return _executor
+
+
+def _map(function, frames):
+    if len(frames) > 1:
+        nbytes = sum(memoryview(frame).nbytes for frame in frames if frame is not None)
+        if nbytes >= PARALLEL_THRESHOLD:
+            return list(get_executor().map(function, frames))
+    return [function(frame) for frame in frames]
+
+
+def compress(data, encoding, dtype=None):
+    """
+    Compress a frame.
+    :param data: Frame data - any contiguous buffer, e.g. a numpy array.
+    :param encoding: Encoding, e.g. "zstd".
+    :param dtype: Numpy dtype of the data (used by bitshuffle to shuffle the elements).
+    :return: Compressed bytes.
+    """
+    return get_codec(encoding).compress(data, dtype)
+
+
+def decompress(data, encoding, dtype, shape):
+    """
+    Decompress a frame into an array.
+    :param data: Compressed frame.
+    :param encoding: Encoding, e.g. "zstd".
+    :param dtype: Numpy dtype of the array.
+    :param shape: Shape tuple of the array.
+    :return: Numpy array.
+    """
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape, dtype=numpy.int64)) * dtype.itemsize
+
+    raw = get_codec(encoding).decompress(data, nbytes, dtype)
+    return numpy.frombuffer(raw, dtype=dtype).reshape(shape)
+
+
+def compress_frames(frames, encoding, dtype=None):
+    """
+    Compress the segments of a message - in parallel, if they are large enough.
+    :return: List of compressed bytes.
+    """
+    codec = get_codec(encoding)
+    return _map(lambda frame: codec.compress(frame, dtype), frames)
+
+
+def decompress_frames(frames, encoding, dtype, shape):
+    """
+    Decompress the segments of a message - in parallel, if they are large enough.
+    :param frames: List of compressed frames - None for empty frames.
+    :return: List of numpy arrays (None for empty frames).
+    """
+    get_codec(encoding)
+    return _map(lambda frame: None if frame is None else decompress(frame, encoding, dtype, shape), frames)
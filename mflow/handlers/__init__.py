@@ -0,0 +1,10 @@
+def send_frames(frames, send, block=True):
+    """
+    Send the frames of a message (as built by Handler.frames) one by one, with a Stream.send like function.
+    :param frames:  List of frames - the first one (the header) is always sent blocking.
+    :param send:    Function with the signature of Stream.send.
+    :param block:   Blocking send of the frames after the header.
+    """
+    last_index = len(frames) - 1
+    for index, frame in enumerate(frames):
+        send(frame, send_more=index < last_index, block=block if index else True)
@@ -1,7 +1,8 @@
-import json
-
 import numpy
 
+from .. import compression, jsonapi
+from . import send_frames
+
 
 class Handler:
 
@@ -9,14 +10,25 @@ class Handler:
     def receive(receiver):
         # header contains: "htype", "shape", "type", "frame", "endianness", "source", "encoding", "tags"
         header = receiver.next(as_json=True)
+        dtype, shape = get_layout(header["type"], header["shape"])
+        compressed = compression.is_compressed(header.get("encoding"))
+
+        # Receive straight into recycled buffers if the stream has a buffer pool (and the data is not compressed)
+        buffer_pool = None if compressed else getattr(receiver, "buffer_pool", None)
 
         data = []
         while receiver.has_more():
-            segment = receiver.next() or None
-            if segment:
-                segment = get_array(segment, header["type"], header["shape"])
+            if buffer_pool is not None:
+                segment = receiver.next_array(dtype, shape)
+            else:
+                segment = receiver.next() or None
+                if segment and not compressed:
+                    segment = numpy.frombuffer(segment, dtype=dtype).reshape(shape)
             data.append(segment)
 
+        if compressed:
+            data = compression.decompress_frames(data, header["encoding"], dtype, shape)
+
         res = None #TODO: this is inconsistent -- should it always be a dict?
         if header or data:
             res = {
@@ -27,23 +39,66 @@ class Handler:
         return res
 
 
+    @staticmethod
+    def frames(message):
+        """
+        Build the frames of a message. Arrays are passed on through the buffer protocol, without copying them - only
+        non-contiguous arrays are copied (once) into a contiguous one.
+        If the header specifies an encoding, the arrays are compressed (other segments are sent as they are).
+        """
+        header = message["header"]
+        frames = [jsonapi.dumps(header)]
+
+        for segment in message["data"]:
+            if segment is None:
+                segment = b""
+            elif isinstance(segment, numpy.ndarray) and not segment.flags.c_contiguous:
+                segment = numpy.ascontiguousarray(segment)
+            frames.append(segment)
+
+        encoding = header.get("encoding")
+        if compression.is_compressed(encoding):
+            indexes = [index for index, frame in enumerate(frames) if isinstance(frame, numpy.ndarray)]
+            dtype, _ = get_layout(header["type"], header["shape"])
+
+            compressed = compression.compress_frames([frames[index] for index in indexes], encoding, dtype)
+            for index, frame in zip(indexes, compressed):
+                frames[index] = frame
+
+        return frames
+
+
     @staticmethod
     def send(message, send, block=True):
-        send(json.dumps(message["header"]).encode(), send_more=True, block=True)
+        send_frames(Handler.frames(message), send, block)
+
 
-        data = message["data"]
-        last_index = len(data) - 1
 
-        for index, segment in enumerate(data):
-            if not isinstance(segment, bytes):
-                segment = segment.tobytes()
+# Only the frame changes between the messages of a stream, so the layout objects are reused.
+_layouts = {}
+_MAX_LAYOUTS = 1024
 
-            send_more = index < last_index
-            send(segment, block=block, send_more=send_more)
 
+def get_layout(dtype, shape):
+    """
+    Get the numpy dtype and the shape tuple for the type and shape of an array-1.0 header.
+    :param dtype: Type as found in the header, e.g. "int32".
+    :param shape: Shape as found in the header, e.g. [512, 1024].
+    :return: Tuple (numpy.dtype, shape tuple).
+    """
+    key = (dtype, tuple(shape))
+    layout = _layouts.get(key)
+    if layout is None:
+        if len(_layouts) >= _MAX_LAYOUTS:
+            _layouts.clear()
+        layout = _layouts[key] = (numpy.dtype(dtype), key[1])
+    return layout
 
 
-def get_array(raw_data, dtype, shape):
+def get_array(raw_data, dtype, shape, encoding=None):
+    dtype, shape = get_layout(dtype, shape)
+    if compression.is_compressed(encoding):
+        return compression.decompress(raw_data, encoding, dtype, shape)
     return numpy.frombuffer(raw_data, dtype=dtype).reshape(shape)
 
 
@@ -1,4 +1,5 @@
-import json
+from .. import jsonapi
+from . import send_frames
 
 
 class Handler:
@@ -47,27 +48,31 @@ class Handler:
 
 
     @staticmethod
-    def send(message, send, block=True):
-        detailed_header = message["header"]["header_detail"] == "all"
-        has_appendix = "appendix" in message
+    def frames(message):
+        header_detail = message["header"]["header_detail"]
+
+        frames = [jsonapi.dumps(message["header"])]
 
-        # Header and part_2 are always present.
-        send(json.dumps(message["header"]).encode(), send_more=True, block=True)
-        # Send more data if message has appendix or a detailed header.
-        send(json.dumps(message["part_2"]).encode(), send_more=has_appendix or detailed_header, block=block)
+        if header_detail == "all" or header_detail == "basic":
+            frames.append(jsonapi.dumps(message["part_2"]))
 
         # Other parts only in complete header.
-        if detailed_header:
-            send(json.dumps(message["part_3"]).encode(), send_more=True, block=block)
-            send(message["part_4_raw"], send_more=True, block=block)
-            send(json.dumps(message["part_5"]).encode(), send_more=True, block=block)
-            send(message["part_6_raw"], send_more=True, block=block)
-            send(json.dumps(message["part_7"]).encode(), send_more=True, block=block)
-            # Send more only if it has appendix.
-            send(message["part_8_raw"], send_more=has_appendix, block=block)
+        if header_detail == "all":
+            frames += [
+                jsonapi.dumps(message["part_3"]),
+                message["part_4_raw"],
+                jsonapi.dumps(message["part_5"]),
+                message["part_6_raw"],
+                jsonapi.dumps(message["part_7"]),
+                message["part_8_raw"]
+            ]
 
-        if has_appendix:
-            send(json.dumps(message["appendix"]).encode(), send_more=False, block=block)
+        if "appendix" in message:
+            frames.append(jsonapi.dumps(message["appendix"]))
 
+        return frames
 
 
+    @staticmethod
+    def send(message, send, block=True):
+        send_frames(Handler.frames(message), send, block)
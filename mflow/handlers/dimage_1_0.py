@@ -1,4 +1,5 @@
-import json
+from .. import jsonapi
+from . import send_frames
 
 
 class Handler:
@@ -25,13 +26,53 @@ class Handler:
         return res
 
 
+    @staticmethod
+    def frames(message):
+        image = message["part_3_raw"]
+
+        # numpy arrays are compressed according to the image header, raw data is expected to be encoded already
+        if hasattr(image, "dtype"):
+            from .. import compression
+
+            encoding = message["part_2"].get("encoding")
+            if compression.is_compressed(encoding):
+                image = compression.compress(image, encoding, image.dtype)
+
+        frames = [
+            jsonapi.dumps(message["header"]),
+            jsonapi.dumps(message["part_2"]),
+            image,
+            jsonapi.dumps(message["part_4"])
+        ]
+
+        if "appendix" in message:
+            frames.append(jsonapi.dumps(message["appendix"]))
+
+        return frames
+
+
     @staticmethod
     def send(message, send, block=True):
-        send(json.dumps(message["header"]).encode(), send_more=True, block=True)
-        send(json.dumps(message["part_2"]).encode(), send_more=True, block=block)
-        send(message["part_3_raw"], send_more=True, block=block)
-        send(json.dumps(message["part_4"]).encode(), send_more=False, block=block)
-        #TODO: should this optionally send the appendix?
+        send_frames(Handler.frames(message), send, block)
+
+
+
+def get_image(message):
+    """
+    Get the image of a dimage-1.0 message, decompressed according to the encoding of its image header (part_2).
+    :param message: Message data, as returned by Handler.receive.
+    :return: Numpy array of shape (height, width).
+    """
+    import numpy
 
+    from .. import compression
 
+    image_header = message["part_2"]
+    # The header gives the shape as [width, height].
+    shape = tuple(reversed(image_header["shape"]))
+    dtype = numpy.dtype(image_header["type"])
 
+    encoding = image_header.get("encoding")
+    if compression.is_compressed(encoding):
+        return compression.decompress(message["part_3_raw"], encoding, dtype, shape)
+    return numpy.frombuffer(message["part_3_raw"], dtype=dtype).reshape(shape)
@@ -1,4 +1,4 @@
-import json
+from .. import jsonapi
 
 
 class Handler:
@@ -9,8 +9,9 @@ class Handler:
         return {"header": header}
 
     @staticmethod
-    def send(message, send, block=True):
-        send(json.dumps(message["header"]).encode(), send_more=False, block=True)
-
-
+    def frames(message):
+        return [jsonapi.dumps(message["header"])]
 
+    @staticmethod
+    def send(message, send, block=True):
+        send(jsonapi.dumps(message["header"]), send_more=False, block=True)
@@ -1,4 +1,5 @@
-import json
+from .. import jsonapi
+from . import send_frames
 
 
 class Handler:
@@ -23,12 +24,13 @@ class Handler:
 
 
     @staticmethod
-    def send(message, send, block=True):
-        send(json.dumps(message["header"]).encode(), send_more=True, block=True)
-
+    def frames(message):
+        frames = [jsonapi.dumps(message["header"])]
         for segment in message["data"]:
-            #TODO: why does this not need send_more=True up until the last segment?
-            send(segment, block=block)
-
+            frames.append(b"" if segment is None else segment)
+        return frames
 
 
+    @staticmethod
+    def send(message, send, block=True):
+        send_frames(Handler.frames(message), send, block)
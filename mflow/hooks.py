@@ -0,0 +1,317 @@
+"""
+Instrumentation hooks of a stream - see Stream.add_hook().
+
+The callbacks of an event are called with the stream first:
+
+    pre_receive(stream)               receive call started (before waiting for the message)
+    post_header(stream, htype)        header received and decoded (only if the handler is selected by htype)
+    post_decode(stream, message)      handler done - message is None if nothing was decoded
+    post_flush(stream, message)       receive call done (also on timeouts and errors, message is None then)
+    decode_error(stream, exception)   header or message could not be decoded
+    pre_send(stream, data)            frame (send) or list of frames (send_multipart) about to be sent
+    post_send(stream, data)           send done (also if it failed)
+
+The callbacks run in the thread calling the stream (the prefetch thread if prefetching), on the hot path - they should
+be fast and must not raise. With asyncio streams the receive events start once the frames of the message arrived.
+"""
+import cProfile
+import os
+import pstats
+import threading
+import tracemalloc
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+PRE_RECEIVE = "pre_receive"
+POST_HEADER = "post_header"
+POST_DECODE = "post_decode"
+POST_FLUSH = "post_flush"
+DECODE_ERROR = "decode_error"
+PRE_SEND = "pre_send"
+POST_SEND = "post_send"
+
+EVENTS = (PRE_RECEIVE, POST_HEADER, POST_DECODE, POST_FLUSH, DECODE_ERROR, PRE_SEND, POST_SEND)
+
+# Regions of the built-in hooks: (start event, end event)
+RECEIVE = "receive"
+SEND = "send"
+
+REGIONS = {RECEIVE: (PRE_RECEIVE, POST_FLUSH), SEND: (PRE_SEND, POST_SEND)}
+
+
+class Hooks:
+    """
+    Callbacks of a stream. Every event is an attribute, None if the event has no callbacks or a single callable
+    calling all of them - the stream only checks the attribute before calling it.
+    """
+
+    def __init__(self):
+        self.callbacks = {event: [] for event in EVENTS}
+        for event in EVENTS:
+            setattr(self, event, None)
+
+
+    def add(self, event, callback):
+        if event not in self.callbacks:
+            raise ValueError("Unknown hook event [%s] - supported: %s" % (event, ", ".join(EVENTS)))
+        self.callbacks[event].append(callback)
+        self._compile(event)
+
+
+    def remove(self, event, callback):
+        """
+        :return: True if the callback was registered for the event.
+        """
+        if callback not in self.callbacks.get(event, ()):
+            return False
+        self.callbacks[event].remove(callback)
+        self._compile(event)
+        return True
+
+
+    def _compile(self, event):
+        callbacks = tuple(self.callbacks[event])
+        if not callbacks:
+            call = None
+        elif len(callbacks) == 1:
+            call = callbacks[0]
+        else:
+            def call(*args):
+                for callback in callbacks:
+                    callback(*args)
+        setattr(self, event, call)
+
+
+    def __bool__(self):
+        return any(self.callbacks.values())
+
+
+
+class _Hook:
+    """
+    Base of the built-in hooks: attached to the start and end events of regions of one or more streams.
+    """
+
+    def __init__(self, regions):
+        for region in regions:
+            if region not in REGIONS:
+                raise ValueError("Unknown region [%s] - supported: %s" % (region, ", ".join(REGIONS)))
+        self.regions = tuple(regions)
+        self.streams = []
+
+
+    def attach(self, *streams):
+        """
+        :param streams: Streams to hook into.
+        :return: self
+        """
+        for stream in streams:
+            for region in self.regions:
+                start, end = REGIONS[region]
+                stream.add_hook(start, self.enter)
+                stream.add_hook(end, self.exit)
+            self.streams.append(stream)
+        return self
+
+
+    def detach(self):
+        for stream in self.streams:
+            for region in self.regions:
+                start, end = REGIONS[region]
+                stream.remove_hook(start, self.enter)
+                stream.remove_hook(end, self.exit)
+        self.streams = []
+
+
+    def enter(self, stream, *args):
+        pass
+
+
+    def exit(self, stream, *args):
+        pass
+
+
+
+class ProfileHook(_Hook):
+    """
+    Profile the receive and/or send calls of streams with cProfile - only the code running within the regions is
+    profiled (e.g. receive and decode, but not the processing of the application between receive calls). Every thread
+    gets its own profiler, the statistics are merged by get_stats().
+
+    From Python 3.12 cProfile runs on sys.monitoring, which allows only one active profiler per process. Once a second
+    profiler cannot be enabled, the hook falls back to a single profiler shared by all threads - enabled while any
+    thread is within a region, so it also profiles the other threads then. If a profiler not belonging to the hook is
+    active, the regions are not profiled.
+    """
+
+    def __init__(self, regions=(RECEIVE, SEND)):
+        """
+        :param regions: Regions to profile - RECEIVE (pre_receive to post_flush) and/or SEND (pre_send to post_send).
+        """
+        super().__init__(regions)
+        self.profilers = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # Fallback to a single profiler (Python 3.12+), enabled while within the regions of any thread.
+        self._single_profiler = None
+        self._single_depth = 0
+
+
+    def enter(self, stream, *args):
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        # Regions can be nested, e.g. the sends done while decoding a message.
+        local.depth = depth + 1
+        if depth == 0:
+            local.active = self._enable(local)
+
+
+    def exit(self, stream, *args):
+        local = self._local
+        depth = getattr(local, "depth", 0)
+        if depth == 0:
+            # Attached within a region.
+            return
+        local.depth = depth - 1
+        if depth == 1 and local.active is not None:
+            if local.active is self._single_profiler:
+                with self._lock:
+                    self._single_depth -= 1
+                    if self._single_depth == 0:
+                        local.active.disable()
+            else:
+                local.active.disable()
+
+
+    def _enable(self, local):
+        """
+        :return: Profiler enabled, None if none could be enabled.
+        """
+        if self._single_profiler is None:
+            profiler = getattr(local, "profiler", None)
+            if profiler is None:
+                profiler = local.profiler = cProfile.Profile()
+                with self._lock:
+                    self.profilers.append(profiler)
+            try:
+                profiler.enable()
+                return profiler
+            except ValueError:
+                pass
+
+        with self._lock:
+            if self._single_profiler is None:
+                logger.warning("Only one profiler can be active at a time - profiling all the threads with a single "
+                               "profiler while any of them is within a profiled region")
+                self._single_profiler = cProfile.Profile()
+                self.profilers.append(self._single_profiler)
+
+            if self._single_depth == 0:
+                try:
+                    self._single_profiler.enable()
+                except ValueError:
+                    # Another profiler is active, e.g. the one of a thread still within its region.
+                    logger.debug("Region not profiled - another profiler is active")
+                    return None
+            self._single_depth += 1
+            return self._single_profiler
+
+
+    def get_stats(self):
+        """
+        :return: pstats.Stats of all the threads, None if nothing was profiled yet.
+        """
+        with self._lock:
+            profilers = list(self.profilers)
+        if not profilers:
+            return None
+
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        return stats
+
+
+    def dump(self, filename):
+        """
+        Write the statistics to a file, to be read with pstats or e.g. snakeviz.
+        :return: True if anything was profiled.
+        """
+        stats = self.get_stats()
+        if stats is None:
+            return False
+        stats.dump_stats(filename)
+        logger.info("Profile written to %s", filename)
+        return True
+
+
+
+class TracemallocHook(_Hook):
+    """
+    Take tracemalloc snapshots every n receive (or send) calls of streams, to find what keeps allocating memory.
+    Starts tracemalloc when attached if it is not already tracing - which slows down all allocations.
+    """
+
+    def __init__(self, every=1000, regions=(RECEIVE, ), folder=None, frames=1):
+        """
+        :param every: Take a snapshot every n calls.
+        :param regions: Regions to count - RECEIVE and/or SEND.
+        :param folder: Also write the snapshots to "<folder>/mflow_tracemalloc_<pid>_<n>.snapshot" if set.
+        :param frames: Frames of the traceback stored by tracemalloc.
+        """
+        super().__init__(regions)
+        self.every = every
+        self.folder = folder
+        self.frames = frames
+
+        self.calls = 0
+        self.first_snapshot = None
+        self.last_snapshot = None
+        self.snapshots_taken = 0
+        self._lock = threading.Lock()
+
+
+    def attach(self, *streams):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        return super().attach(*streams)
+
+
+    def exit(self, stream, *args):
+        with self._lock:
+            self.calls += 1
+            if self.calls % self.every == 0 or self.first_snapshot is None:
+                self.take_snapshot()
+
+
+    def take_snapshot(self):
+        """
+        :return: tracemalloc.Snapshot
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+        snapshot = tracemalloc.take_snapshot()
+        if self.first_snapshot is None:
+            self.first_snapshot = snapshot
+        self.last_snapshot = snapshot
+        self.snapshots_taken += 1
+
+        if self.folder is not None:
+            filename = os.path.join(self.folder, "mflow_tracemalloc_%d_%d.snapshot" % (os.getpid(),
+                                                                                         self.snapshots_taken))
+            snapshot.dump(filename)
+        return snapshot
+
+
+    def get_statistics(self, limit=10, key_type="lineno"):
+        """
+        :return: List of the limit tracemalloc.StatisticDiff growing the most between the first and the last snapshot.
+        """
+        if self.last_snapshot is None or self.last_snapshot is self.first_snapshot:
+            return []
+        return self.last_snapshot.compare_to(self.first_snapshot, key_type)[:limit]
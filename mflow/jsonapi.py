@@ -0,0 +1,31 @@
+"""
+JSON codec shared by the streams and all the htype handlers.
+
+The fastest available implementation is selected at import: orjson, ujson or the standard library json.
+dumps() always returns bytes (ready to be sent) and loads() accepts bytes or str.
+"""
+
+try:
+    import orjson
+
+    name = "orjson"
+
+    def dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def loads(data):
+        return orjson.loads(data)
+
+except ImportError:
+    try:
+        import ujson as json
+        name = "ujson"
+    except ImportError:
+        import json
+        name = "json"
+
+    def dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    def loads(data):
+        return json.loads(data)
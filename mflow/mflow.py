@@ -2,23 +2,14 @@ import logging
 
 import zmq
 
-from .handlers import array_1_0, dheader_1_0, dimage_1_0, dseries_end_1_0, raw_1_0
-from .utils import ConnectionCountMonitor, SocketEventListener, no_clients_timeout_notifier
-
-#TODO: should the handlers (etc.) also use ujson if available? could add a shim and import from there...
-try:
-    import ujson as json
-except ImportError:
-    import json
+from . import jsonapi
+from .pool import BufferPool, BufferPoolExhausted
+from .prefetch import Prefetcher
+from .registry import HandlerRegistry, HandlerView
 
 
+# No handlers are attached here - configuring the log output is up to the application.
 logger = logging.getLogger(__name__)
-ch = logging.StreamHandler()
-#formatter = logging.Formatter("[%(name)s][%(levelname)s] %(message)s")
-formatter = logging.Formatter("[%(asctime)s][%(name)s][%(levelname)s] %(message)s")
-
-ch.setFormatter(formatter)
-logger.addHandler(ch)
 
 
 CONNECT = "connect"
@@ -29,22 +20,31 @@ SUB = zmq.SUB
 PUSH = zmq.PUSH
 PULL = zmq.PULL
 
+# How often (in milliseconds) the prefetch thread checks if it should stop.
+PREFETCH_POLL_INTERVAL = 100
+
+# Status of the receive calls in the flight recorder (see mflow.tracing)
+TRACE_OK = 0
+TRACE_TIMEOUT = 1
+TRACE_ERROR = 2
+
 
-handler_modules = {
-    "array-1.0": array_1_0,
-    "dheader-1.0": dheader_1_0,
-    "dimage-1.0": dimage_1_0,
-    "dseries_end-1.0": dseries_end_1_0,
-    "raw-1.0": raw_1_0
-}
+# Handler modules are only imported once their htype is first seen - third-party handlers can be registered through
+# the "mflow.handlers" entry point group (see mflow.registry).
+handler_modules = HandlerRegistry()
 
-handlers = {k: getattr(v, "Handler") for k, v in handler_modules.items()}
-receive_handlers = {k: getattr(v, "receive") for k, v in handlers.items()}
-send_handlers = {k: getattr(v, "send") for k, v in handlers.items()}
+handlers = HandlerView(handler_modules)
+receive_handlers = HandlerView(handler_modules, "receive")
+send_handlers = HandlerView(handler_modules, "send")
+# Build the complete frame list of a message, for sending it with a single send_multipart call.
+frame_handlers = HandlerView(handler_modules, "frames")
 
 
 class Stream:
 
+    # Context class used if no context is passed on connect.
+    context_class = zmq.Context
+
     def __init__(self):
         self.context = None
         self._context_is_owned = False
@@ -56,13 +56,29 @@ class Stream:
         self.zmq_track = False
 
         self.receiver = None
+        self.batch_receiver = None
+        self.receive_timeout = None
+
+        # see start_prefetch()
+        self.prefetcher = None
+        self._prefetch_handler = None
+        # see enable_timing()
+        self.timing = None
+        # see enable_stamps()
+        self.stamps = None
+        # see enable_flight_recorder()
+        self.recorder = None
+        # see add_hook()
+        self.hooks = None
 
         self._socket_monitors = []
-        self._socket_event_listener = SocketEventListener(self._socket_monitors)
+        # Created when the first socket monitor is registered
+        self._socket_event_listener = None
 
 
     def connect(self, address, conn_type=CONNECT, mode=PULL, receive_timeout=None, queue_size=100, linger=1000,
-                context=None, copy=True, send_timeout=None):
+                context=None, copy=True, send_timeout=None, buffer_pool_size=None, buffer_pool_policy="block",
+                prefetch_depth=None, prefetch_overflow="block", copy_threshold=None, buffer_pool_timeout=10):
         """
         :param address:         Address to connect to, in the form of protocol://IP_or_Hostname:port, e.g.: tcp://127.0.0.1:40000
         :param conn_type:       Connection type - connect or bind to socket
@@ -72,10 +88,21 @@ class Stream:
         :param linger:          Linger option -i.e. how long to keep message in memory at socket shutdown - in milliseconds (-1 infinite)
         :param copy:            If False, allows to do zero-copy send and receive. It automatically sets the 0MQ track parameter to True
         :param send_timeout:    Send timeout in milliseconds (-1 = infinite)
+        :param buffer_pool_size:    If set, array payloads are received (recv_into) into a pool of this many recycled
+                                    buffers. Messages have to be released (Message.release()) to hand them back -
+                                    a consumer keeping more than buffer_pool_size messages unreleased exhausts the pool
+        :param buffer_pool_policy:  What to do if all pool buffers are in use: "block", "grow" or "drop" the message
+        :param buffer_pool_timeout: With the "block" policy, how long to wait for a released buffer in seconds (None =
+                                    forever) - afterwards a warning is logged and the message is dropped, instead of
+                                    deadlocking a single threaded consumer that does not release its messages
+        :param prefetch_depth:      If set, messages are received on a background thread - see start_prefetch()
+        :param prefetch_overflow:   What to do if the prefetch queue is full - see start_prefetch()
+        :param copy_threshold:      With copy=False, frames smaller than this (in bytes) are still copied, as tracking
+                                    them costs more than copying - e.g. the json headers (default: zmq.COPY_THRESHOLD)
         :return:
         """
         if not context:
-            self.context = zmq.Context()
+            self.context = self.context_class()
             self._context_is_owned = True
         else:
             self.context = context
@@ -86,6 +113,8 @@ class Stream:
 
         self.socket.setsockopt(zmq.LINGER, linger)
         self.socket.set_hwm(queue_size)
+        if copy_threshold is not None:
+            self.socket.copy_threshold = copy_threshold
         try:
             if conn_type == CONNECT:
                 self.socket.connect(address)
@@ -105,6 +134,7 @@ class Stream:
 
         if receive_timeout:
             self.socket.RCVTIMEO = receive_timeout
+            self.receive_timeout = receive_timeout
             logger.info("Receive timeout set: %f", receive_timeout)
 
         if send_timeout:
@@ -117,7 +147,14 @@ class Stream:
 
         # If socket is used for receiving messages, create receive handler
         if mode == zmq.SUB or mode == zmq.PULL:
-            self.receiver = ReceiveHandler(self.socket, copy=copy)
+            buffer_pool = None
+            if buffer_pool_size:
+                buffer_pool = BufferPool(buffer_pool_size, buffer_pool_policy, timeout=buffer_pool_timeout)
+            self.receiver = ReceiveHandler(self.socket, copy=copy, buffer_pool=buffer_pool)
+            self.batch_receiver = FrameListReceiveHandler(self.receiver.statistics)
+
+            if prefetch_depth:
+                self.start_prefetch(depth=prefetch_depth, overflow=prefetch_overflow)
 
 
     def register_socket_monitor(self, monitor):
@@ -128,6 +165,9 @@ class Stream:
         if monitor not in self._socket_monitors:
             self._socket_monitors.append(monitor)
 
+        if self._socket_event_listener is None:
+            self._socket_event_listener = self._create_socket_event_listener()
+
         # If the socket event listener is not running yet, but the socket is already connected, start it.
         if not self._socket_event_listener.monitor_listening.is_set() and (self.socket and not self.socket.closed):
             self._socket_event_listener.start(self.socket)
@@ -142,17 +182,154 @@ class Stream:
             self._socket_monitors.remove(callback_function)
 
         # Stop the event listener if there are no more monitors.
-        if not self._socket_monitors:
+        if not self._socket_monitors and self._socket_event_listener is not None:
             self._socket_event_listener.stop()
 
 
+    def _create_socket_event_listener(self):
+        from .utils import SocketEventListener
+        return SocketEventListener(self._socket_monitors)
+
+
+    def start_prefetch(self, depth=100, overflow="block", handler=None):
+        """
+        Receive and decode messages on a dedicated thread, so the socket queue keeps being drained while the
+        messages are processed. receive() and receive_batch() then deliver the prefetched messages.
+        :param depth:       Maximum number of messages waiting to be delivered
+        :param overflow:    What to do if the queue is full: "block" (stop receiving until there is space),
+                            "drop-newest" or "drop-oldest"
+        :param handler:     Reference to a specific message handler function to use for all messages - receive() and
+                            receive_batch() cannot select another handler while prefetching
+        """
+        if self.prefetcher is not None:
+            return
+
+        def receive():
+            # Wake up regularly to be able to stop the thread.
+            if not self.socket.poll(PREFETCH_POLL_INTERVAL, zmq.POLLIN):
+                return None
+            return self._receive_message(self.receiver, handler)
+
+        # The prefetch thread owns the socket from now on.
+        self.receiver.block = True
+        self._prefetch_handler = handler
+        self.prefetcher = Prefetcher(receive, depth=depth, overflow=overflow)
+        self.prefetcher.start()
+        logger.info("Prefetch started (depth %d, overflow %s)", depth, overflow)
+
+
+    def stop_prefetch(self):
+        """
+        Stop the prefetch thread. Messages still in the prefetch queue are discarded.
+        """
+        if self.prefetcher is None:
+            return
+
+        self.prefetcher.stop()
+        self.prefetcher = None
+        self._prefetch_handler = None
+
+
+    @property
+    def prefetch_statistics(self):
+        """
+        Queue depth and time in queue statistics of the prefetch thread (None if prefetch is not active).
+        """
+        if self.prefetcher is None:
+            return None
+        return self.prefetcher.statistics
+
+
+    def enable_timing(self):
+        """
+        Collect latency histograms of the receive stages (socket receive, header decode, handler decode and the
+        processing time between receive calls). Without timing enabled, receive() does not take any timestamps.
+        :return: StageTimings holding the histograms
+        """
+        if self.timing is None:
+            from .utils import StageTimings
+            self.timing = StageTimings()
+        return self.timing
+
+
+    def disable_timing(self):
+        self.timing = None
+
+
+    def enable_flight_recorder(self, size=65536):
+        """
+        Record every receive() call (message number, frames, bytes and the timestamps of its stages) in a ring of
+        trace records, which can be dumped to a file to find out what happened during a stall - see mflow.tracing.
+        :param size:    Number of receive calls kept
+        :return: FlightRecorder
+        """
+        if self.recorder is None:
+            from .tracing import FlightRecorder
+            self.recorder = FlightRecorder(size)
+        return self.recorder
+
+
+    def disable_flight_recorder(self):
+        self.recorder = None
+
+
+    def add_hook(self, event, callback):
+        """
+        Call a function on an event of the receive or send path - see mflow.hooks for the events and their arguments.
+        Without any hook registered, the stream does not make any extra calls.
+        :param event:       Event, e.g. "pre_receive" or "post_send"
+        :param callback:    Function called with the stream and the arguments of the event
+        :return: callback
+        """
+        if self.hooks is None:
+            from .hooks import Hooks
+            hooks = Hooks()
+            hooks.add(event, callback)
+            self.hooks = hooks
+        else:
+            self.hooks.add(event, callback)
+        return callback
+
+
+    def remove_hook(self, event, callback):
+        if self.hooks is not None and self.hooks.remove(event, callback) and not self.hooks:
+            self.hooks = None
+
+
+    def enable_stamps(self, hop=None, clock="realtime"):
+        """
+        Measure the latency of each hop of the messages. Forwarded messages get a stamp [hop, clock, nanoseconds]
+        appended to the "mflow_stamps" list of their header. Received messages with stamps are recorded in a latency
+        histogram per hop - in Message.statistics.latencies.
+        :param hop:     Name of this hop (default: address of the stream)
+        :param clock:   "monotonic" - exact, but only on the same host, or "realtime" - across hosts, as accurate as
+                        the clock synchronization of the hosts
+        :return: HopStamps holding the histograms
+        """
+        if self.stamps is None:
+            from .utils import HopStamps
+            self.stamps = HopStamps(hop or self.address, clock)
+            if self.receiver is not None:
+                self.receiver.statistics.latencies = self.stamps.histograms
+        return self.stamps
+
+
+    def disable_stamps(self):
+        self.stamps = None
+        if self.receiver is not None:
+            self.receiver.statistics.latencies = None
+
+
     def disconnect(self):
         if self.socket.closed:
             logger.warning("Trying to close an already closed socket... ignore and return")
             return
         try:
+            self.stop_prefetch()
+
             # Stop the socket event listener.
-            self._socket_event_listener.stop()
+            if self._socket_event_listener is not None:
+                self._socket_event_listener.stop()
 
             # Even if disconnect fails, we need to close.
             try:
@@ -172,29 +349,133 @@ class Stream:
     def receive(self, handler=None, block=True):
         """
         :param handler:     Reference to a specific message handler function to use for interpreting
-                            the message to be received
+                            the message to be received - while prefetching, the messages are already decoded with the
+                            handler of start_prefetch(), another handler raises a ValueError
         :param block:       Blocking receive call
         :return:            Map holding the data, timestamp, data and main header
         """
-        message = None
+        if self.prefetcher is not None:
+            self._check_prefetch_handler(handler)
+            return self.prefetcher.get(block, self._prefetch_timeout())
+
         # Set blocking flag in receiver
         self.receiver.block = block
-        receive_is_successful = False
+        return self._receive_message(self.receiver, handler)
 
-        if not handler:
+
+    def receive_batch(self, max_messages=100, timeout=None, handler=None):
+        """
+        Receive all the messages already queued on the socket (up to max_messages) in one go.
+        Each message is fetched as a whole with recv_multipart and then interpreted by the htype handlers.
+        :param max_messages:    Maximum number of messages to return
+        :param timeout:         Time to wait for the first message in milliseconds (None = use the receive timeout
+                                of the socket, 0 = do not wait)
+        :param handler:         Reference to a specific message handler function to use for interpreting
+                                the messages to be received - see receive() for the restriction while prefetching
+        :return:                List of messages - empty if no message arrived in time
+        """
+        messages = []
+        if self.prefetcher is not None:
+            self._check_prefetch_handler(handler)
+            message = self.prefetcher.get(timeout != 0, self._prefetch_timeout(timeout))
+            while message is not None:
+                messages.append(message)
+                if len(messages) == max_messages:
+                    break
+                message = self.prefetcher.get(block=False)
+            return messages
+
+        if timeout is not None and not self.socket.poll(timeout, zmq.POLLIN):
+            return messages
+
+        # Only wait for the first message, afterwards just drain what is already queued.
+        flags = 0
+        while len(messages) < max_messages:
             try:
-                # Dynamically select handler
-                htype = self.receiver.header()["htype"]
+                frames = self.socket.recv_multipart(flags, copy=self.zmq_copy, track=self.zmq_track)
             except zmq.Again:
-                # not clear if this is needed
-                self.receiver.flush(receive_is_successful)
-                return message
-            except Exception:
-                logger.exception("Unable to read header - skipping")
-                # Clear remaining sub-messages if exist
-                self.receiver.flush(receive_is_successful)
-                return message
+                break
+            flags = zmq.NOBLOCK
+
+            self.batch_receiver.load(frames)
+            message = self._receive_message(self.batch_receiver, handler)
+            if message:
+                messages.append(message)
+
+        return messages
+
+
+    def _check_prefetch_handler(self, handler):
+        if handler is not None and handler is not self._prefetch_handler:
+            raise ValueError("The messages are prefetched and decoded with the handler given to start_prefetch() - "
+                             "another handler cannot be used while prefetching")
+
 
+    def _prefetch_timeout(self, timeout=None):
+        # Same semantics as for the socket: milliseconds, falling back to the receive timeout (None = infinite)
+        if timeout is None:
+            timeout = self.receive_timeout
+        if timeout is None or timeout < 0:
+            return None
+        return timeout / 1000
+
+
+    def _receive_message(self, receiver, handler):
+        message = None
+        receive_is_successful = False
+
+        timing = self.timing
+        if timing is not None:
+            timing.start()
+        recorder = self.recorder
+        if recorder is not None:
+            recorder.start(receiver.statistics)
+        hooks = self.hooks
+        if hooks is not None and hooks.pre_receive is not None:
+            hooks.pre_receive(self)
+
+        try:
+            if timing is not None:
+                # Receive the header on its own, to tell the socket receive apart from the decoding
+                receiver.receive_header()
+                timing.header_received()
+
+            if not handler:
+                # Dynamically select handler
+                if timing is None:
+                    htype = receiver.header()["htype"]
+                else:
+                    htype = receiver.decode_header()["htype"]
+                    timing.header_decoded()
+                if recorder is not None:
+                    recorder.header_received()
+                if hooks is not None and hooks.post_header is not None:
+                    hooks.post_header(self, htype)
+        except zmq.Again:
+            # not clear if this is needed
+            receiver.flush(receive_is_successful)
+            if timing is not None:
+                timing.end(decoded=False)
+            if recorder is not None:
+                recorder.end(receiver.statistics, TRACE_TIMEOUT)
+            if hooks is not None and hooks.post_flush is not None:
+                hooks.post_flush(self, message)
+            return message
+        except Exception as e:
+            logger.exception("Unable to read header - skipping")
+            if hooks is not None and hooks.decode_error is not None:
+                hooks.decode_error(self, e)
+            # Clear remaining sub-messages if exist
+            receiver.flush(receive_is_successful)
+            if timing is not None:
+                timing.end(decoded=False)
+            if recorder is not None:
+                recorder.end(receiver.statistics, TRACE_ERROR)
+            if hooks is not None and hooks.post_flush is not None:
+                hooks.post_flush(self, message)
+            return message
+
+        if not handler:
             try:
                 handler = receive_handlers[htype]
             except Exception:
@@ -203,16 +484,37 @@ class Stream:
                 logger.warning(msg)
 
         try:
-            data = handler(self.receiver)
+            data = handler(receiver)
             # as an extra safety margin
             if data:
                 receive_is_successful = True
-                message = Message(self.receiver.statistics, data)
-        except Exception:
+                message = Message(receiver.statistics, data)
+                if receiver.buffer_pool is not None:
+                    message.buffers = receiver.take_buffers()
+                    message.buffer_pool = receiver.buffer_pool
+                if self.stamps is not None and isinstance(data, dict) and isinstance(data.get("header"), dict):
+                    self.stamps.record(data["header"])
+        except BufferPoolExhausted:
+            logger.debug("No free buffer available - dropping message", exc_info=True)
+        except Exception as e:
             logger.exception("Unable to decode message - skipping")
+            if hooks is not None and hooks.decode_error is not None:
+                hooks.decode_error(self, e)
+
+        if recorder is not None:
+            recorder.decoded()
+        if hooks is not None and hooks.post_decode is not None:
+            hooks.post_decode(self, message)
 
         # Clear remaining sub-messages if exist
-        self.receiver.flush(receive_is_successful)
+        receiver.flush(receive_is_successful)
+
+        if timing is not None:
+            timing.end(decoded=receive_is_successful)
+        if recorder is not None:
+            recorder.end(receiver.statistics, TRACE_OK if receive_is_successful else TRACE_ERROR)
+        if hooks is not None and hooks.post_flush is not None:
+            hooks.post_flush(self, message)
 
         return message
 
@@ -229,9 +531,12 @@ class Stream:
         if not block:
             flags = flags | zmq.NOBLOCK
 
+        hooks = self.hooks
+        if hooks is not None and hooks.pre_send is not None:
+            hooks.pre_send(self, message)
         try:
             if as_json:
-                self.socket.send_json(message, flags)
+                self.socket.send(jsonapi.dumps(message), flags)
             else:
                 self.socket.send(message, flags, copy=self.zmq_copy, track=self.zmq_track)
         except zmq.Again:
@@ -242,54 +547,142 @@ class Stream:
         except zmq.ZMQError:
             logger.exception("Error while sending")
             raise
+        finally:
+            if hooks is not None and hooks.post_send is not None:
+                hooks.post_send(self, message)
 
 
-    def forward(self, message, handler=None, block=True):
-        if not handler:
-            try:
-                # Dynamically select handler
-                htype = message["header"]["htype"]
-            except Exception:
-                msg = "Unable to read header - skipping"
-                logger.debug(msg, exc_info=True)
-                logger.warning(msg)
-                # Clear remaining sub-messages if exist
+    def send_multipart(self, frames, block=True, copy=None, track=None):
+        """
+        Send all the frames of a message with one call.
+        :param frames:  List of frames - bytes, zmq.Frame or any contiguous buffer (e.g. numpy arrays). Without copy,
+                        the buffers must not be modified until they are sent (see the returned tracker).
+        :param block:   Blocking send call - if the first frame cannot be queued, the message is not sent at all
+        :param copy:    Copy the frames (default: copy setting of the stream, see connect(..., copy=...))
+        :param track:   Track the frames (default: track if not copying)
+        :return:        MessageTracker covering all the frames if tracked (frames below the copy threshold are copied
+                        and done right away), otherwise None - False if not blocking and the message could not be queued
+        """
+        if copy is None:
+            copy = self.zmq_copy
+        if track is None:
+            track = not copy
+
+        hooks = self.hooks
+        if hooks is not None and hooks.pre_send is not None:
+            hooks.pre_send(self, frames)
+        try:
+            if not track:
+                return self.socket.send_multipart(frames, 0 if block else zmq.NOBLOCK, copy=copy, track=False)
+            return _send_tracked(self.socket, frames, 0 if block else zmq.NOBLOCK, copy)
+        except zmq.Again:
+            if block:
                 raise
+            return False
+        except zmq.ZMQError:
+            logger.exception("Error while sending")
+            raise
+        finally:
+            if hooks is not None and hooks.post_send is not None:
+                hooks.post_send(self, frames)
 
-            try:
-                handler = send_handlers[htype]
-            except Exception:
-                msg = "htype - %s - not supported" % htype
-                logger.debug(msg, exc_info=True)
-                logger.warning(msg)
+
+    def forward(self, message, handler=None, block=True):
+        """
+        Send a received (or compatible) message.
+        :param message: Message data, as returned in Message.data
+        :param handler: Reference to a specific send handler function - by default the frames of the message are
+                        built by the htype handler and sent with one send_multipart call
+        :param block:   Blocking send call
+        """
+        frames_handler = None
+        if not handler:
+            htype = self._get_htype(message)
+            frames_handler = frame_handlers.get(htype)
+            if frames_handler is None:
+                handler = self._get_send_handler(htype)
 
         try:
-            handler(message, send=self.send, block=block)
+            if self.stamps is not None:
+                message = self._stamp(message)
+
+            if frames_handler is not None:
+                self.send_multipart(frames_handler(message), block=block)
+            else:
+                handler(message, send=self.send, block=block)
         except Exception:
             msg = "Unable to send message - skipping"
             logger.debug(msg, exc_info=True)
             logger.warning(msg)
 
 
+    def _stamp(self, message):
+        header = message.get("header") if isinstance(message, dict) else None
+        if not isinstance(header, dict):
+            return message
+        # The header is copied, so a message forwarded to several streams only carries the stamp of each stream.
+        return dict(message, header=self.stamps.stamp(dict(header)))
+
+
+    @staticmethod
+    def _get_htype(message):
+        try:
+            return message["header"]["htype"]
+        except Exception:
+            msg = "Unable to read header - skipping"
+            logger.debug(msg, exc_info=True)
+            logger.warning(msg)
+            raise
+
+
+    @staticmethod
+    def _get_send_handler(htype):
+        try:
+            return send_handlers[htype]
+        except Exception:
+            msg = "htype - %s - not supported" % htype
+            logger.debug(msg, exc_info=True)
+            logger.warning(msg)
+
+
 
 class ReceiveHandler:
 
-    def __init__(self, socket, copy=True):
+    def __init__(self, socket, copy=True, buffer_pool=None):
         self.socket = socket
 
         # Basic statistics
         self.statistics = Statistics()
         self.raw_header = None
+        # Header decoded by header(), so it is parsed only once per message
+        self.parsed_header = None
         self.block = True
 
         self.zmq_copy = copy
         self.zmq_track = not copy
 
+        # Buffers acquired from the pool for the current message
+        self.buffer_pool = buffer_pool
+        self.pooled_buffers = []
+
 
     def header(self):
+        self.receive_header()
+        return self.decode_header()
+
+
+    def receive_header(self):
+        """
+        Receive the first frame - next() will return it.
+        """
         flags = 0 if self.block else zmq.NOBLOCK
         self.raw_header = self.socket.recv(flags=flags)
-        return json.loads(self.raw_header.decode("utf-8"))
+        self.parsed_header = None
+
+
+    def decode_header(self):
+        self.parsed_header = jsonapi.loads(self.raw_header)
+        return self.parsed_header
 
 
     def has_more(self):
@@ -300,30 +693,89 @@ class ReceiveHandler:
         try:
             if self.raw_header:
                 raw = self.raw_header
+                parsed_header = self.parsed_header
                 self.raw_header = None
+                self.parsed_header = None
+
+                self.statistics.bytes_received += len(raw)
+                self.statistics.frames_received += 1
+                if as_json and parsed_header is not None:
+                    return parsed_header
+                return _decode_frame(raw, as_json)
+
+            flags = 0 if self.block else zmq.NOBLOCK
+            raw = self.socket.recv(flags=flags, copy=self.zmq_copy, track=self.zmq_track)
+
+            self.statistics.bytes_received += len(raw)
+            self.statistics.frames_received += 1
+            return _decode_frame(raw, as_json)
+        except zmq.ZMQError:
+            return None
+
+
+    def next_frame(self):
+        """
+        Receive the next frame as it is - a zmq.Frame if the stream does not copy (see connect(..., copy=False)), so
+        it can be forwarded without copying it.
+        :return:        Frame (or bytes) or None if the frame could not be received
+        """
+        try:
+            if self.raw_header:
+                raw = self.raw_header
+                self.raw_header = None
+                self.parsed_header = None
             else:
                 flags = 0 if self.block else zmq.NOBLOCK
                 raw = self.socket.recv(flags=flags, copy=self.zmq_copy, track=self.zmq_track)
+        except zmq.ZMQError:
+            return None
 
-            self.statistics.bytes_received += len(raw)
-            if as_json:
-                # non-copying recv returns a Frame object
-                # use Frame.bytes field will incur a copy, but without causing
-                # significant overhead since json header is of small size
-                if isinstance(raw, zmq.Frame):
-                    raw = raw.bytes
-                return json.loads(raw.decode("utf-8"))
-            else:
-                # non-copying recv returns a Frame object
-                # use Frame.buffer interface (read-only) to avoid extra copying
-                if isinstance(raw, zmq.Frame):
-                    raw = raw.buffer
-                return raw
+        self.statistics.bytes_received += len(raw)
+        self.statistics.frames_received += 1
+        return raw
+
+
+    def next_array(self, dtype, shape):
+        """
+        Receive the next frame straight into an array acquired from the buffer pool.
+        :param dtype:   Numpy dtype of the array
+        :param shape:   Shape tuple of the array
+        :return:        Numpy array or None if the frame is empty (or could not be received)
+        """
+        buffer = self.buffer_pool.acquire(dtype, shape)
+        try:
+            flags = 0 if self.block else zmq.NOBLOCK
+            nbytes = self.socket.recv_into(buffer, flags=flags)
         except zmq.ZMQError:
+            self.buffer_pool.release(buffer)
             return None
 
+        self.statistics.bytes_received += nbytes
+        self.statistics.frames_received += 1
+        if nbytes != buffer.nbytes:
+            self.buffer_pool.release(buffer)
+            if nbytes == 0:
+                return None
+            raise ValueError("Frame size %d does not match the array size %d" % (nbytes, buffer.nbytes))
+
+        self.pooled_buffers.append(buffer)
+        return buffer
+
+
+    def take_buffers(self):
+        """
+        Take over the pool buffers of the current message - they will not be released on flush.
+        """
+        buffers = self.pooled_buffers
+        self.pooled_buffers = []
+        return buffers
+
 
     def flush(self, success=True):
+        # Hand back the buffers of a message that was not delivered
+        while self.pooled_buffers:
+            self.buffer_pool.release(self.pooled_buffers.pop())
+
         flags = 0 if self.block else zmq.NOBLOCK
         # Clear remaining sub-messages
         while self.has_more():
@@ -341,12 +793,131 @@ class ReceiveHandler:
 
 
 
+class FrameListReceiveHandler:
+    """
+    Receive handler working on the frames of an already received multipart message (e.g. from recv_multipart).
+    It offers the same interface as ReceiveHandler, so the htype handlers can be used on it unchanged.
+    """
+
+    def __init__(self, statistics=None):
+        # Statistics are usually shared with the ReceiveHandler of the same stream
+        self.statistics = statistics if statistics is not None else Statistics()
+        self.frames = []
+        self.index = 0
+        # Header decoded by header(), so it is parsed only once per message
+        self.parsed_header = None
+        self.block = True
+        # Frames are already received, so they cannot be received into pool buffers
+        self.buffer_pool = None
+
+
+    def load(self, frames):
+        self.frames = frames
+        self.index = 0
+        self.parsed_header = None
+
+
+    def header(self):
+        # Only peek at the header - the handler will read it again with next(as_json=True)
+        return self.decode_header()
+
+
+    def receive_header(self):
+        # Already received
+        pass
+
+
+    def decode_header(self):
+        self.parsed_header = _decode_frame(self.frames[0], as_json=True)
+        return self.parsed_header
+
+
+    def has_more(self):
+        return self.index < len(self.frames)
+
+
+    def next(self, as_json=False):
+        if self.index >= len(self.frames):
+            return None
+
+        raw = self.frames[self.index]
+        self.index += 1
+
+        self.statistics.bytes_received += len(raw)
+        self.statistics.frames_received += 1
+        if as_json and self.index == 1 and self.parsed_header is not None:
+            return self.parsed_header
+        return _decode_frame(raw, as_json)
+
+
+    def next_frame(self):
+        if self.index >= len(self.frames):
+            return None
+
+        raw = self.frames[self.index]
+        self.index += 1
+
+        self.statistics.bytes_received += len(raw)
+        self.statistics.frames_received += 1
+        return raw
+
+
+    def flush(self, success=True):
+        # Clear remaining sub-messages
+        for _ in range(self.index, len(self.frames)):
+            logger.info("Skipping sub-message")
+        self.index = len(self.frames)
+
+        if success:
+            # Update statistics
+            self.statistics.total_bytes_received += self.statistics.bytes_received
+            self.statistics.bytes_received = 0
+            self.statistics.messages_received += 1
+
+
+
+def _send_tracked(socket, frames, flags, copy):
+    # socket.send_multipart only returns the tracker of the last frame - which is done right away if that frame was
+    # copied (e.g. a small json part after the data), while the frames before might still be queued.
+    trackers = []
+    last = len(frames) - 1
+    for index, frame in enumerate(frames):
+        tracker = socket.send(frame, flags if index == last else flags | zmq.SNDMORE, copy=copy, track=True)
+        if tracker is not None:
+            trackers.append(tracker)
+    return zmq.MessageTracker(*trackers)
+
+
+
+def _decode_frame(raw, as_json):
+    if as_json:
+        # non-copying recv returns a Frame object
+        # use Frame.bytes field will incur a copy, but without causing
+        # significant overhead since json header is of small size
+        if isinstance(raw, zmq.Frame):
+            raw = raw.bytes
+        elif isinstance(raw, memoryview):
+            raw = raw.tobytes()
+        return jsonapi.loads(raw)
+    else:
+        # non-copying recv returns a Frame object
+        # use Frame.buffer interface (read-only) to avoid extra copying
+        if isinstance(raw, zmq.Frame):
+            raw = raw.buffer
+        return raw
+
+
+
 class Statistics:
 
     def __init__(self):
         self.bytes_received = 0
         self.total_bytes_received = 0
         self.messages_received = 0
+        # Frames received in total
+        self.frames_received = 0
+        # LatencyHistogram of each hop - see Stream.enable_stamps()
+        self.latencies = None
 
 
 
@@ -356,19 +927,45 @@ class Message:
         self.statistics = statistics
         self.data = data
 
+        # Pool buffers the data is stored in (see Stream.connect(..., buffer_pool_size=...))
+        self.buffers = []
+        self.buffer_pool = None
+
+
+    def release(self):
+        """
+        Hand the buffers of the message back to the pool. The data must not be used afterwards.
+        """
+        while self.buffers:
+            self.buffer_pool.release(self.buffers.pop())
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
 
 
 def connect(address, conn_type="connect", mode=zmq.PULL, queue_size=100, receive_timeout=None, linger=1000,
-            no_client_action=None, no_client_timeout=10, copy=True, send_timeout=None):
+            no_client_action=None, no_client_timeout=10, copy=True, send_timeout=None, buffer_pool_size=None,
+            buffer_pool_policy="block", prefetch_depth=None, prefetch_overflow="block", copy_threshold=None,
+            buffer_pool_timeout=10):
     stream = Stream()
 
     # If no client action is specified, start monitor.
     if no_client_action:
+        from .utils import ConnectionCountMonitor, no_clients_timeout_notifier
         stream.register_socket_monitor(ConnectionCountMonitor(no_clients_timeout_notifier(no_client_action,
                                                                                           no_client_timeout)))
 
     stream.connect(address, conn_type=conn_type, mode=mode, receive_timeout=receive_timeout, queue_size=queue_size,
-                   linger=linger, copy=copy, send_timeout=send_timeout)
+                   linger=linger, copy=copy, send_timeout=send_timeout, buffer_pool_size=buffer_pool_size,
+                   buffer_pool_policy=buffer_pool_policy, prefetch_depth=prefetch_depth,
+                   prefetch_overflow=prefetch_overflow, copy_threshold=copy_threshold,
+                   buffer_pool_timeout=buffer_pool_timeout)
     return stream
 
 
@@ -0,0 +1,361 @@
+import mmap
+import threading
+import time
+from logging import getLogger
+
+import zmq
+
+
+logger = getLogger(__name__)
+
+
+# Behaviour when all the buffers of the pool are in use.
+BLOCK = "block"  # Wait until a buffer is released (or the pool timeout elapses).
+GROW = "grow"    # Allocate an additional buffer - it is discarded again on release.
+DROP = "drop"    # Drop the message.
+
+POLICIES = (BLOCK, GROW, DROP)
+
+
+class BufferPoolExhausted(Exception):
+    """
+    No buffer could be acquired from the pool - the message should be dropped.
+    """
+
+
+
+def aligned_empty(dtype, shape, alignment=mmap.PAGESIZE):
+    """
+    Allocate an uninitialized numpy array, starting on an alignment (by default page) boundary.
+    :param dtype: Numpy data type of the array.
+    :param shape: Shape tuple of the array.
+    :param alignment: Alignment of the first byte of the array, in bytes.
+    :return: Numpy array.
+    """
+    # numpy is only imported once buffers are actually used.
+    import numpy
+
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape, dtype=numpy.int64)) * dtype.itemsize
+
+    raw = numpy.empty(nbytes + alignment, dtype=numpy.uint8)
+    offset = -raw.ctypes.data % alignment
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+
+class BufferPool:
+    """
+    Pool of recycled, page aligned numpy buffers.
+    Buffers are acquired for a given dtype and shape and must be handed back with release().
+    """
+
+    def __init__(self, size=16, policy=BLOCK, timeout=None):
+        """
+        :param size: Number of buffers in the pool.
+        :param policy: Behaviour when all the buffers are in use - BLOCK, GROW or DROP.
+        :param timeout: Maximum time to wait for a free buffer in seconds, with the BLOCK policy (None = infinite).
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unsupported buffer pool policy [%s] - supported: %s" % (policy, ", ".join(POLICIES)))
+
+        self.size = size
+        self.policy = policy
+        self.timeout = timeout
+
+        self._condition = threading.Condition()
+        # Free buffers by (dtype, shape).
+        self._free = {}
+        # Buffers handed out, by id.
+        self._in_use = {}
+        self._allocated = 0
+
+        # Statistics
+        self.buffers_grown = 0
+        self.buffers_dropped = 0
+
+
+    @property
+    def buffers_in_use(self):
+        return len(self._in_use)
+
+
+    def acquire(self, dtype, shape):
+        """
+        Get a buffer for the given layout.
+        :param dtype: Numpy dtype of the buffer.
+        :param shape: Shape tuple of the buffer.
+        :return: Numpy array - its content is undefined.
+        """
+        key = (dtype, shape)
+
+        with self._condition:
+            while True:
+                free = self._free.get(key)
+                if free:
+                    buffer = free.pop()
+                    self._in_use[id(buffer)] = buffer
+                    return buffer
+
+                if self._allocated < self.size or self._discard_free_buffer():
+                    break
+
+                if self.policy == GROW:
+                    self.buffers_grown += 1
+                    break
+
+                if self.policy == DROP:
+                    self.buffers_dropped += 1
+                    raise BufferPoolExhausted("All %d buffers of the pool are in use" % self.size)
+
+                if not self._condition.wait(self.timeout):
+                    self.buffers_dropped += 1
+                    logger.warning("No buffer of the pool was released within %s s - the messages have to be "
+                                   "released (Message.release()) - dropping the message", self.timeout)
+                    raise BufferPoolExhausted("Timeout while waiting for a free buffer")
+
+            self._allocated += 1
+
+        buffer = aligned_empty(dtype, shape)
+        with self._condition:
+            self._in_use[id(buffer)] = buffer
+        return buffer
+
+
+    def release(self, buffer):
+        """
+        Hand a buffer back to the pool.
+        :param buffer: Buffer returned by acquire().
+        """
+        with self._condition:
+            if self._in_use.pop(id(buffer), None) is None:
+                raise ValueError("Buffer does not belong to the pool or was already released")
+
+            # Buffers allocated over the pool size are not kept.
+            if self._allocated > self.size:
+                self._allocated -= 1
+            else:
+                self._free.setdefault((buffer.dtype, buffer.shape), []).append(buffer)
+
+            self._condition.notify()
+
+
+    def _discard_free_buffer(self):
+        """
+        Discard a free buffer of another layout (e.g. after the shape of the stream changed), to make space for a new
+        one. Must be called with the condition acquired.
+        :return: True if a buffer was discarded.
+        """
+        for free in self._free.values():
+            if free:
+                free.pop()
+                self._allocated -= 1
+                return True
+        return False
+
+
+
+class SendBufferPool:
+    """
+    Pool of recycled, page aligned numpy buffers for zero-copy senders (see Stream.connect(..., copy=False)).
+    A buffer is acquired, filled and sent without copying, then handed back with track() together with the
+    MessageTracker of the send - it is only handed out again once libzmq is done with it.
+    """
+
+    def __init__(self, size=16, policy=BLOCK, timeout=None):
+        """
+        :param size: Number of buffers in the pool.
+        :param policy: Behaviour when all the buffers are in use or still being sent - BLOCK, GROW or DROP.
+        :param timeout: Maximum time to wait for a free buffer in seconds, with the BLOCK policy (None = infinite).
+        """
+        if policy not in POLICIES:
+            raise ValueError("Unsupported buffer pool policy [%s] - supported: %s" % (policy, ", ".join(POLICIES)))
+
+        self.size = size
+        self.policy = policy
+        self.timeout = timeout
+
+        self._condition = threading.Condition()
+        # Free buffers by (dtype, shape).
+        self._free = {}
+        # Buffers handed out and not sent yet, by id.
+        self._in_use = {}
+        # (tracker, buffers) of the messages being sent.
+        self._in_flight = []
+        self._allocated = 0
+
+        # Statistics
+        self.buffers_grown = 0
+        self.buffers_dropped = 0
+        self.acquisitions = 0
+        # Number of acquisitions that had to wait for a buffer, and the time (in seconds) spent waiting.
+        self.waits = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+
+    @property
+    def buffers_in_use(self):
+        return len(self._in_use)
+
+
+    @property
+    def buffers_in_flight(self):
+        return sum(len(buffers) for _, buffers in self._in_flight)
+
+
+    @property
+    def buffers_free(self):
+        return sum(len(free) for free in self._free.values())
+
+
+    @property
+    def average_wait_time(self):
+        if not self.waits:
+            return 0.0
+        return self.total_wait_time / self.waits
+
+
+    def acquire(self, dtype, shape):
+        """
+        Get a buffer for the given layout, waiting for a sent buffer to be released by libzmq if needed.
+        :param dtype: Numpy dtype of the buffer.
+        :param shape: Shape tuple of the buffer.
+        :return: Numpy array - its content is undefined.
+        """
+        buffer = self._acquire(dtype, shape)
+        if buffer is None:
+            buffer = aligned_empty(dtype, shape)
+            with self._condition:
+                self._in_use[id(buffer)] = buffer
+        return buffer
+
+
+    def _acquire(self, dtype, shape):
+        # Returns a free buffer, or None if a new one has to be allocated.
+        import numpy
+
+        key = (numpy.dtype(dtype), tuple(shape))
+        start = None
+
+        with self._condition:
+            self.acquisitions += 1
+            try:
+                while True:
+                    self._reclaim()
+
+                    free = self._free.get(key)
+                    if free:
+                        buffer = free.pop()
+                        self._in_use[id(buffer)] = buffer
+                        return buffer
+
+                    if self._allocated < self.size or self._discard_free_buffer():
+                        break
+
+                    if self.policy == GROW:
+                        self.buffers_grown += 1
+                        break
+
+                    if self.policy == DROP:
+                        self.buffers_dropped += 1
+                        raise BufferPoolExhausted("All %d buffers of the pool are in use" % self.size)
+
+                    if start is None:
+                        start = time.monotonic()
+                        self.waits += 1
+
+                    remaining = None
+                    if self.timeout is not None:
+                        remaining = self.timeout - (time.monotonic() - start)
+                        if remaining <= 0:
+                            self.buffers_dropped += 1
+                            raise BufferPoolExhausted("Timeout while waiting for a free buffer")
+
+                    if self._in_flight:
+                        # Wait for the oldest message to be sent, without blocking track() and release().
+                        tracker = self._in_flight[0][0]
+                        self._condition.release()
+                        try:
+                            tracker.wait(-1 if remaining is None else remaining)
+                        except zmq.NotDone:
+                            pass
+                        finally:
+                            self._condition.acquire()
+                    else:
+                        # All the buffers are acquired but not sent yet.
+                        self._condition.wait(remaining)
+
+                self._allocated += 1
+                return None
+
+            finally:
+                if start is not None:
+                    wait_time = time.monotonic() - start
+                    self.total_wait_time += wait_time
+                    if wait_time > self.max_wait_time:
+                        self.max_wait_time = wait_time
+
+
+    def track(self, tracker, *buffers):
+        """
+        Hand back buffers that were sent - they are recycled once the send is done.
+        :param tracker: MessageTracker covering the frames of the buffers (e.g. returned by Stream.send_multipart,
+                        which covers all the frames). Not the tracker of a single frame of a multipart message sent
+                        frame by frame: frames below the copy threshold are copied and their tracker is done right
+                        away. None if the buffers were copied.
+        :param buffers: Buffers returned by acquire().
+        """
+        with self._condition:
+            for buffer in buffers:
+                if self._in_use.pop(id(buffer), None) is None:
+                    raise ValueError("Buffer does not belong to the pool or was already released")
+
+            self._in_flight.append((tracker, buffers))
+            self._condition.notify()
+
+
+    def release(self, buffer):
+        """
+        Hand back a buffer that was not sent.
+        :param buffer: Buffer returned by acquire().
+        """
+        with self._condition:
+            if self._in_use.pop(id(buffer), None) is None:
+                raise ValueError("Buffer does not belong to the pool or was already released")
+
+            self._recycle(buffer)
+            self._condition.notify()
+
+
+    def _reclaim(self):
+        # Recycle the buffers of all the messages libzmq is done with. Must be called with the condition acquired.
+        if not self._in_flight:
+            return
+
+        in_flight = []
+        for tracker, buffers in self._in_flight:
+            if tracker is None or tracker.done:
+                for buffer in buffers:
+                    self._recycle(buffer)
+            else:
+                in_flight.append((tracker, buffers))
+        self._in_flight = in_flight
+
+
+    def _recycle(self, buffer):
+        # Buffers allocated over the pool size are not kept.
+        if self._allocated > self.size:
+            self._allocated -= 1
+        else:
+            self._free.setdefault((buffer.dtype, buffer.shape), []).append(buffer)
+
+
+    def _discard_free_buffer(self):
+        # See BufferPool._discard_free_buffer.
+        for free in self._free.values():
+            if free:
+                free.pop()
+                self._allocated -= 1
+                return True
+        return False
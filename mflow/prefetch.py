@@ -0,0 +1,149 @@
+import queue
+import threading
+import time
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+# Behaviour when the prefetch queue is full.
+BLOCK = "block"              # Stop receiving until the consumer catches up (the socket queue fills up instead).
+DROP_NEWEST = "drop-newest"  # Drop the message just received.
+DROP_OLDEST = "drop-oldest"  # Drop the oldest message in the queue to make space.
+
+POLICIES = (BLOCK, DROP_NEWEST, DROP_OLDEST)
+
+
+class PrefetchStatistics:
+
+    def __init__(self):
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.messages_dropped = 0
+        self.messages_delivered = 0
+        # Time (in seconds) messages spent in the queue before being delivered.
+        self.total_time_in_queue = 0.0
+        self.max_time_in_queue = 0.0
+
+
+    @property
+    def average_time_in_queue(self):
+        if not self.messages_delivered:
+            return 0.0
+        return self.total_time_in_queue / self.messages_delivered
+
+
+
+class Prefetcher:
+    """
+    Receive messages on a dedicated thread and hand them over to the consumer through a bounded queue.
+    """
+
+    def __init__(self, receive, depth=100, overflow=BLOCK):
+        """
+        :param receive: Function returning the next message, or None if no message arrived in a short while. It is
+                        called on the prefetch thread only.
+        :param depth: Maximum number of messages in the queue.
+        :param overflow: Behaviour when the queue is full - BLOCK, DROP_NEWEST or DROP_OLDEST.
+        """
+        if overflow not in POLICIES:
+            raise ValueError("Unsupported prefetch overflow policy [%s] - supported: %s" %
+                             (overflow, ", ".join(POLICIES)))
+
+        self.receive = receive
+        self.overflow = overflow
+        self.statistics = PrefetchStatistics()
+
+        self._queue = queue.Queue(maxsize=depth)
+        self._running = threading.Event()
+        self._thread = None
+
+
+    def start(self):
+        if self._running.is_set():
+            return
+
+        self._running.set()
+        self._thread = threading.Thread(target=self._prefetch, name="mflow-prefetch")
+        # In case someone does not call disconnect, this will stop the thread anyway.
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        self._running.clear()
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+
+    def get(self, block=True, timeout=None):
+        """
+        Get the next prefetched message.
+        :param block: Wait for a message if the queue is empty.
+        :param timeout: Maximum time to wait in seconds (None = infinite).
+        :return: Message or None if no message is available.
+        """
+        try:
+            enqueue_time, message = self._queue.get(block, timeout)
+        except queue.Empty:
+            return None
+
+        time_in_queue = time.monotonic() - enqueue_time
+
+        statistics = self.statistics
+        statistics.queue_depth = self._queue.qsize()
+        statistics.messages_delivered += 1
+        statistics.total_time_in_queue += time_in_queue
+        if time_in_queue > statistics.max_time_in_queue:
+            statistics.max_time_in_queue = time_in_queue
+
+        return message
+
+
+    def _prefetch(self):
+        while self._running.is_set():
+            try:
+                message = self.receive()
+            except Exception:
+                logger.exception("Unable to prefetch message")
+                continue
+
+            if message is not None:
+                self._put((time.monotonic(), message))
+
+
+    def _put(self, item):
+        if self.overflow == BLOCK:
+            while self._running.is_set():
+                try:
+                    self._queue.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                if self.overflow == DROP_OLDEST:
+                    try:
+                        _, dropped = self._queue.get_nowait()
+                    except queue.Empty:
+                        # Consumer emptied the queue in the meantime.
+                        dropped = None
+                    self._queue.put_nowait(item)
+                else:
+                    _, dropped = item
+
+                if dropped is not None:
+                    self.statistics.messages_dropped += 1
+                    # Hand back pool buffers of dropped messages.
+                    dropped.release()
+
+        queue_depth = self._queue.qsize()
+        self.statistics.queue_depth = queue_depth
+        if queue_depth > self.statistics.max_queue_depth:
+            self.statistics.max_queue_depth = queue_depth
@@ -0,0 +1,451 @@
+"""
+Recording of streams into a few large segment files instead of a file per sub-message.
+
+Every segment consists of three files:
+    <prefix>_<segment>.dat  the frames of all the messages, back to back
+    <prefix>_<segment>.frm  one (offset, length) record per frame, pointing into the .dat file
+    <prefix>_<segment>.idx  one record per message: message number, receive timestamp, header frame, first frame
+                            record and number of frames, htype
+
+The .frm and .idx files start with a 16 byte header (magic, version and record size), all numbers are little endian.
+"""
+import glob
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from logging import getLogger
+
+import numpy
+
+from . import jsonapi
+from .mflow import FrameListReceiveHandler, Message, Statistics, receive_handlers
+
+
+logger = getLogger(__name__)
+
+
+VERSION = 1
+
+FILE_HEADER = struct.Struct("<8sII")
+INDEX_MAGIC = b"MFLOWIDX"
+FRAMES_MAGIC = b"MFLOWFRM"
+
+# message, timestamp (ns), frame (header "frame", NO_FRAME if missing), first_frame, frame_count, htype (empty if
+# longer than HTYPE_SIZE - the htype is read from the header frame then)
+HTYPE_SIZE = 20
+INDEX_RECORD = struct.Struct("<QqqQI%ds" % HTYPE_SIZE)
+# offset, length
+FRAME_RECORD = struct.Struct("<QQ")
+
+# The same records as numpy dtypes, to read the files without unpacking every record.
+INDEX_DTYPE = numpy.dtype([("message", "<u8"), ("timestamp", "<i8"), ("frame", "<i8"), ("first_frame", "<u8"),
+                           ("frame_count", "<u4"), ("htype", "S%d" % HTYPE_SIZE)])
+FRAME_DTYPE = numpy.dtype([("offset", "<u8"), ("length", "<u8")])
+
+NO_FRAME = -1
+
+DATA_SUFFIX = ".dat"
+INDEX_SUFFIX = ".idx"
+FRAMES_SUFFIX = ".frm"
+
+
+def segment_name(prefix, segment):
+    return "%s_%06d" % (prefix, segment)
+
+
+
+class Writer:
+    """
+    Write messages into segment files. The files are written by a background thread, with large buffered writes.
+    """
+
+    def __init__(self, folder, prefix="recording", max_segment_size=1024 ** 3, max_segment_time=None,
+                 buffer_size=16 * 1024 ** 2, queue_size=1000):
+        """
+        :param folder: Folder to write the segments to - created if it does not exist.
+        :param prefix: Name prefix of the segment files.
+        :param max_segment_size: Start a new segment once the data file reached this size, in bytes (None = no limit).
+        :param max_segment_time: Start a new segment after this many seconds (None = no limit).
+        :param buffer_size: Write buffer size of the data file, in bytes.
+        :param queue_size: Maximum number of messages waiting to be written - write() blocks if the queue is full.
+        """
+        self.folder = folder
+        self.prefix = prefix
+        self.max_segment_size = max_segment_size
+        self.max_segment_time = max_segment_time
+        self.buffer_size = buffer_size
+
+        # Statistics
+        self.messages_written = 0
+        self.bytes_written = 0
+        self.segments_written = 0
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._error = None
+
+        self._segment = -1
+        self._segment_start = None
+        self._data_file = None
+        self._index_file = None
+        self._frames_file = None
+        self._data_offset = 0
+        self._frame_number = 0
+
+        os.makedirs(folder, exist_ok=True)
+
+        self._thread = threading.Thread(target=self._write, name="mflow-recording")
+        # In case someone does not call close, this will stop the thread anyway.
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def write(self, frames, timestamp=None):
+        """
+        Queue a message for writing.
+        :param frames: List of frames (bytes, memoryview or any other buffer) - the first one is the json header. The
+                       frames must not be modified until they are written.
+        :param timestamp: Receive time in nanoseconds since the epoch (default: now).
+        """
+        if self._error is not None:
+            raise RuntimeError("Recording failed") from self._error
+
+        if timestamp is None:
+            timestamp = time.time_ns()
+        self._queue.put((timestamp, frames))
+
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+
+    def close(self):
+        """
+        Write all queued messages and close the files.
+        """
+        if self._thread is None:
+            return
+
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+        if self._error is not None:
+            raise RuntimeError("Recording failed") from self._error
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def _write(self):
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    break
+
+                timestamp, frames = item
+                self._write_message(timestamp, frames)
+        except Exception as e:
+            logger.exception("Unable to write recording")
+            self._error = e
+            # Do not block the producer.
+            while self._queue.get() is not None:
+                pass
+        finally:
+            self._close_segment()
+
+
+    def _write_message(self, timestamp, frames):
+        if self._data_file is None or self._segment_is_full():
+            self._close_segment()
+            self._open_segment()
+
+        first_frame = self._frame_number
+        frame_records = []
+        for frame in frames:
+            length = memoryview(frame).nbytes
+            self._data_file.write(frame)
+            frame_records.append(FRAME_RECORD.pack(self._data_offset, length))
+            self._data_offset += length
+            self.bytes_written += length
+        self._frames_file.write(b"".join(frame_records))
+        self._frame_number += len(frames)
+
+        htype, frame_key = _read_header(frames[0]) if frames else (b"", NO_FRAME)
+        self._index_file.write(INDEX_RECORD.pack(self.messages_written, timestamp, frame_key, first_frame,
+                                                 len(frames), htype))
+        self.messages_written += 1
+
+
+    def _segment_is_full(self):
+        if self.max_segment_size is not None and self._data_offset >= self.max_segment_size:
+            return True
+        if self.max_segment_time is not None and time.monotonic() - self._segment_start >= self.max_segment_time:
+            return True
+        return False
+
+
+    def _open_segment(self):
+        self._segment += 1
+        base = os.path.join(self.folder, segment_name(self.prefix, self._segment))
+
+        self._data_file = open(base + DATA_SUFFIX, "wb", buffering=self.buffer_size)
+        self._frames_file = open(base + FRAMES_SUFFIX, "wb", buffering=1024 ** 2)
+        self._index_file = open(base + INDEX_SUFFIX, "wb", buffering=1024 ** 2)
+
+        self._frames_file.write(FILE_HEADER.pack(FRAMES_MAGIC, VERSION, FRAME_RECORD.size))
+        self._index_file.write(FILE_HEADER.pack(INDEX_MAGIC, VERSION, INDEX_RECORD.size))
+
+        self._segment_start = time.monotonic()
+        self._data_offset = 0
+        self._frame_number = 0
+        logger.info("Writing segment %s", base)
+
+
+    def _close_segment(self):
+        if self._data_file is None:
+            return
+
+        # Write the data before the index, so the index never points past the data.
+        for file in (self._data_file, self._frames_file, self._index_file):
+            file.close()
+
+        self._data_file = None
+        self._frames_file = None
+        self._index_file = None
+        self.segments_written += 1
+
+
+
+class Reader:
+    """
+    Read recordings written by Writer. The segment files are memory mapped and the messages are decoded by the same
+    htype handlers as for Stream.receive() - arrays are numpy views into the mapping (read-only), nothing is copied.
+
+    Messages are accessed by their number (position in the recording) - reader[10], reader[-1], reader[100:200],
+    iteration - or by the "frame" of their header with by_frame().
+    """
+
+    def __init__(self, folder, prefix="recording", handler=None):
+        """
+        :param folder: Folder of the recording.
+        :param prefix: Name prefix of the segment files.
+        :param handler: Reference to a specific message handler function to use for all messages.
+        """
+        self.folder = folder
+        self.prefix = prefix
+        self.handler = handler
+
+        self.statistics = Statistics()
+        self._receiver = FrameListReceiveHandler(self.statistics)
+
+        self._maps = []
+        self._segments = []
+        for index_filename in sorted(glob.glob(os.path.join(glob.escape(folder), glob.escape(prefix) + "_*" +
+                                                            INDEX_SUFFIX))):
+            self._segments.append(self._open_segment(index_filename[:-len(INDEX_SUFFIX)]))
+
+        counts = [len(index) for index, _, _ in self._segments]
+        # Number of the first message of each segment.
+        self._starts = numpy.cumsum([0] + counts)[:-1]
+        self._length = sum(counts)
+        self._frames_lookup = None
+
+
+    def _map(self, filename):
+        with open(filename, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b""
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapping)
+        return mapping
+
+
+    def _read_records(self, filename, magic, dtype):
+        mapping = self._map(filename)
+        if len(mapping) < FILE_HEADER.size:
+            return numpy.empty(0, dtype=dtype)
+
+        file_magic, version, record_size = FILE_HEADER.unpack_from(mapping)
+        if file_magic != magic:
+            raise ValueError("%s is not a recording file" % filename)
+        if version != VERSION or record_size != dtype.itemsize:
+            raise ValueError("Unsupported version %d (record size %d) of the recording file %s - supported: version %d" %
+                             (version, record_size, filename, VERSION))
+
+        # An incomplete last record (e.g. the recording was interrupted) is ignored.
+        count = (len(mapping) - FILE_HEADER.size) // dtype.itemsize
+        return numpy.frombuffer(mapping, dtype=dtype, count=count, offset=FILE_HEADER.size)
+
+
+    def _open_segment(self, base):
+        index = self._read_records(base + INDEX_SUFFIX, INDEX_MAGIC, INDEX_DTYPE)
+        frames = self._read_records(base + FRAMES_SUFFIX, FRAMES_MAGIC, FRAME_DTYPE)
+        data = memoryview(self._map(base + DATA_SUFFIX))
+
+        # Drop messages that were not completely written.
+        count = len(index)
+        while count and not self._is_complete(index[count - 1], frames, data):
+            count -= 1
+
+        return index[:count], frames, data
+
+
+    @staticmethod
+    def _is_complete(record, frames, data):
+        end = int(record["first_frame"]) + int(record["frame_count"])
+        if end > len(frames):
+            return False
+        if end == int(record["first_frame"]):
+            return True
+        return int(frames[end - 1]["offset"]) + int(frames[end - 1]["length"]) <= len(data)
+
+
+    def __len__(self):
+        return self._length
+
+
+    def __getitem__(self, number):
+        if isinstance(number, slice):
+            return [self[i] for i in range(*number.indices(self._length))]
+
+        return self._read_message(*self._locate(number))
+
+
+    def __iter__(self):
+        for index, frames, data in self._segments:
+            for record in index:
+                yield self._read_message(record, frames, data)
+
+
+    def by_frame(self, frame):
+        """
+        Get the message with the given "frame" in its header - the first one, if there are several.
+        :param frame: Frame number.
+        :return: Message.
+        """
+        if self._frames_lookup is None:
+            keys = self.index["frame"]
+            # Stable sort, so the first message of a frame is found.
+            order = numpy.argsort(keys, kind="stable")
+            self._frames_lookup = (keys[order], order)
+
+        keys, order = self._frames_lookup
+        position = numpy.searchsorted(keys, frame)
+        if position == len(keys) or keys[position] != frame:
+            raise KeyError(frame)
+        return self[int(order[position])]
+
+
+    @property
+    def index(self):
+        """
+        Index records of all messages (numpy structured array with the fields of INDEX_DTYPE).
+        """
+        return numpy.concatenate([index for index, _, _ in self._segments] or [numpy.empty(0, dtype=INDEX_DTYPE)])
+
+
+    def frames(self, number):
+        """
+        Get the raw frames of a message.
+        :param number: Message number.
+        :return: List of memoryviews into the recording.
+        """
+        record, frames, data = self._locate(number)
+        return self._read_frames(record, frames, data)
+
+
+    def _locate(self, number):
+        if number < 0:
+            number += self._length
+        if not 0 <= number < self._length:
+            raise IndexError("Message %d not in recording (%d messages)" % (number, self._length))
+
+        segment = int(numpy.searchsorted(self._starts, number, side="right")) - 1
+        index, frames, data = self._segments[segment]
+        return index[number - self._starts[segment]], frames, data
+
+
+    @staticmethod
+    def _read_frames(record, frames, data):
+        first_frame = int(record["first_frame"])
+        return [data[offset:offset + length]
+                for offset, length in frames[first_frame:first_frame + int(record["frame_count"])].tolist()]
+
+
+    def _read_message(self, record, frames, data):
+        receiver = self._receiver
+        receiver.load(self._read_frames(record, frames, data))
+
+        handler = self.handler
+        if not handler:
+            htype = record["htype"]
+            # A full length htype might have been truncated (written before over-long htypes were left empty).
+            if not htype or len(htype) == HTYPE_SIZE:
+                htype = receiver.header()["htype"]
+            else:
+                htype = htype.decode()
+            handler = receive_handlers[htype]
+
+        message = None
+        data = handler(receiver)
+        if data:
+            message = Message(self.statistics, data)
+        receiver.flush(message is not None)
+        return message
+
+
+    def close(self):
+        """
+        Unmap the files - messages read before must not be used anymore.
+        """
+        self._segments = []
+        self._frames_lookup = None
+        self._receiver.load([])
+
+        while self._maps:
+            mapping = self._maps.pop()
+            try:
+                mapping.close()
+            except BufferError:
+                # Still referenced by messages - the mapping is closed once they are gone.
+                pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+
+def _read_header(raw):
+    try:
+        if not isinstance(raw, (bytes, bytearray)):
+            raw = memoryview(raw).tobytes()
+        header = jsonapi.loads(raw)
+
+        frame = header.get("frame", NO_FRAME)
+        if not isinstance(frame, int):
+            frame = NO_FRAME
+
+        htype = str(header.get("htype", "")).encode("ascii", "replace")
+        if len(htype) >= HTYPE_SIZE:
+            # Not stored instead of truncated - the reader decodes the header frame to get it.
+            logger.debug("htype %s too long for the index - not stored", htype)
+            htype = b""
+        return htype, frame
+    except Exception:
+        logger.debug("Unable to read header of recorded message", exc_info=True)
+        return b"", NO_FRAME
@@ -0,0 +1,127 @@
+import importlib
+from logging import getLogger
+
+# Import the handlers package right away: importing it lazily would rebind mflow.handlers, which is the
+# handlers mapping of the mflow module.
+from . import handlers as handlers_package
+
+
+logger = getLogger(__name__)
+
+
+# Entry point group for third-party handlers: the entry point name is the htype, its value a module providing a
+# Handler class (like the modules in mflow.handlers), e.g. "my_htype-1.0 = my_package.my_htype_1_0".
+ENTRY_POINT_GROUP = "mflow.handlers"
+
+BUILTIN_HANDLER_MODULES = {
+    "array-1.0": "array_1_0",
+    "dheader-1.0": "dheader_1_0",
+    "dimage-1.0": "dimage_1_0",
+    "dseries_end-1.0": "dseries_end_1_0",
+    "raw-1.0": "raw_1_0"
+}
+
+
+class HandlerRegistry(dict):
+    """
+    Map htype -> handler module, importing the module only when its htype is first used.
+    Besides the built-in handlers, the handlers registered under the "mflow.handlers" entry point group are available.
+    Iterating over the registry only lists the handlers loaded so far - see available().
+    """
+
+    def __init__(self, modules=None):
+        """
+        :param modules: Map htype -> name of a module in mflow.handlers to load on first use.
+        """
+        super().__init__()
+        self.modules = dict(BUILTIN_HANDLER_MODULES if modules is None else modules)
+        self._entry_points = None
+
+
+    def __missing__(self, htype):
+        name = self.modules.get(htype)
+        if name is not None:
+            module = importlib.import_module("." + name, handlers_package.__name__)
+        else:
+            entry_point = self.entry_points.get(htype)
+            if entry_point is None:
+                raise KeyError(htype)
+            module = entry_point.load()
+            logger.debug("Loaded handler for htype %s from %s", htype, entry_point.value)
+
+        self[htype] = module
+        return module
+
+
+    def __contains__(self, htype):
+        return super().__contains__(htype) or htype in self.modules or htype in self.entry_points
+
+
+    def get(self, htype, default=None):
+        try:
+            return self[htype]
+        except KeyError:
+            return default
+
+
+    def available(self):
+        """
+        :return: Sorted list of all the htypes a handler is available for.
+        """
+        return sorted(set(self.keys()) | set(self.modules) | set(self.entry_points))
+
+
+    @property
+    def entry_points(self):
+        """
+        Map htype -> entry point of the third-party handlers (discovered on first use).
+        """
+        if self._entry_points is None:
+            from importlib.metadata import entry_points
+
+            try:
+                selected = entry_points(group=ENTRY_POINT_GROUP)
+            except TypeError:
+                # Python < 3.10
+                selected = entry_points().get(ENTRY_POINT_GROUP, [])
+
+            self._entry_points = {entry_point.name: entry_point for entry_point in selected}
+
+        return self._entry_points
+
+
+
+class HandlerView(dict):
+    """
+    Map htype -> Handler class (or one of its attributes, e.g. receive) of a HandlerRegistry, filled on first use.
+    Entries can be overridden or added by assignment, like for a plain dict.
+    """
+
+    def __init__(self, registry, attribute=None):
+        super().__init__()
+        self.registry = registry
+        self.attribute = attribute
+
+
+    def __missing__(self, htype):
+        handler = self.registry[htype].Handler
+        if self.attribute is not None:
+            try:
+                handler = getattr(handler, self.attribute)
+            except AttributeError:
+                # E.g. a third-party handler without frames()
+                raise KeyError(htype) from None
+
+        self[htype] = handler
+        return handler
+
+
+    def __contains__(self, htype):
+        return super().__contains__(htype) or htype in self.registry
+
+
+    def get(self, htype, default=None):
+        try:
+            return self[htype]
+        except KeyError:
+            return default
@@ -0,0 +1,146 @@
+"""
+Rolling throughput statistics, on preallocated numpy rings of samples - see ThroughputStatistics.
+
+Every sample holds the time and the cumulative bytes and messages received at that time, so the rates over any
+window (and the distribution of the rates of the sampling intervals within it) are computed in one go from the
+differences between the samples.
+"""
+import math
+
+import numpy
+
+
+class RollingStatistics:
+    """
+    Ring of (timestamp, total bytes, total messages) samples with the exponentially weighted moving average of the
+    rates. Adding a sample does not allocate, the statistics of a window are computed on request.
+    """
+    PERCENTILES = (50, 90, 99)
+
+    def __init__(self, size=4096, half_life=5.0):
+        """
+        :param size: Number of samples kept.
+        :param half_life: Half life of the moving average in seconds - the weight of a rate halves every half_life.
+        """
+        if size < 2:
+            raise ValueError("At least 2 samples are needed to compute a rate, not %d" % size)
+
+        self.size = size
+        self.half_life = half_life
+
+        self.times = numpy.zeros(size, dtype=numpy.float64)
+        self.bytes = numpy.zeros(size, dtype=numpy.int64)
+        self.messages = numpy.zeros(size, dtype=numpy.int64)
+        # Number of samples added in total - the next sample goes to index count % size.
+        self.count = 0
+
+        self.ewma_data_rate = None
+        self.ewma_message_rate = None
+
+
+    def add(self, timestamp, total_bytes, total_messages):
+        """
+        Add a sample.
+        :param timestamp: Time of the sample in seconds (monotonic).
+        :param total_bytes: Bytes received so far.
+        :param total_messages: Messages received so far.
+        :return: Tuple (data rate, message rate) since the previous sample, (None, None) for the first sample or if
+                 no time passed.
+        """
+        data_rate = message_rate = None
+        if self.count:
+            previous = (self.count - 1) % self.size
+            delta_time = timestamp - float(self.times[previous])
+            if delta_time > 0:
+                data_rate = int(total_bytes - self.bytes[previous]) / delta_time
+                message_rate = int(total_messages - self.messages[previous]) / delta_time
+                self._update_ewma(data_rate, message_rate, delta_time)
+
+        index = self.count % self.size
+        self.times[index] = timestamp
+        self.bytes[index] = total_bytes
+        self.messages[index] = total_messages
+        self.count += 1
+
+        return data_rate, message_rate
+
+
+    def _update_ewma(self, data_rate, message_rate, delta_time):
+        if self.ewma_data_rate is None:
+            self.ewma_data_rate = data_rate
+            self.ewma_message_rate = message_rate
+            return
+
+        # Weighted by the time of the interval, so irregular sampling does not skew the average.
+        alpha = 1 - math.pow(2, -delta_time / self.half_life) if self.half_life else 1.0
+        self.ewma_data_rate += alpha * (data_rate - self.ewma_data_rate)
+        self.ewma_message_rate += alpha * (message_rate - self.ewma_message_rate)
+
+
+    def samples(self, window=None):
+        """
+        :param window: Only the samples of the last window seconds (and the one before, where the first interval of
+                       the window starts), None for all the samples kept.
+        :return: Tuple of arrays (times, bytes, messages), oldest first.
+        """
+        count = min(self.count, self.size)
+        if self.count <= self.size:
+            times, nbytes, messages = self.times[:count], self.bytes[:count], self.messages[:count]
+        else:
+            order = numpy.roll(numpy.arange(self.size), -(self.count % self.size))
+            times, nbytes, messages = self.times[order], self.bytes[order], self.messages[order]
+
+        if window is not None and count:
+            start = max(int(numpy.searchsorted(times, times[-1] - window, side="right")) - 1, 0)
+            times, nbytes, messages = times[start:], nbytes[start:], messages[start:]
+        return times, nbytes, messages
+
+
+    def interval_rates(self, window=None):
+        """
+        :param window: See samples().
+        :return: Tuple of arrays (data rates, message rates) of the intervals between the samples, oldest first.
+        """
+        return self._interval_rates(*self.samples(window))
+
+
+    @staticmethod
+    def _interval_rates(times, nbytes, messages):
+        delta_times = numpy.diff(times)
+        valid = delta_times > 0
+        delta_times = delta_times[valid]
+        return numpy.diff(nbytes)[valid] / delta_times, numpy.diff(messages)[valid] / delta_times
+
+
+    def get_statistics(self, window=None, percentiles=PERCENTILES):
+        """
+        :param window: See samples().
+        :param percentiles: Percentiles of the interval rates to compute.
+        :return: Dict with the average rates over the window, the minimum, maximum and percentiles of the interval
+                 rates and the moving averages - {} if there are less than 2 samples in the window.
+        """
+        times, nbytes, messages = self.samples(window)
+        if len(times) < 2 or times[-1] <= times[0]:
+            return {}
+
+        data_rates, message_rates = self._interval_rates(times, nbytes, messages)
+        duration = float(times[-1] - times[0])
+        statistics = {"window": duration,
+                      "intervals": len(data_rates),
+                      "data_rate": float(nbytes[-1] - nbytes[0]) / duration,
+                      "message_rate": float(messages[-1] - messages[0]) / duration,
+                      "ewma_data_rate": self.ewma_data_rate,
+                      "ewma_message_rate": self.ewma_message_rate}
+
+        for name, rates in (("data_rate", data_rates), ("message_rate", message_rates)):
+            statistics["min_" + name] = float(rates.min())
+            statistics["max_" + name] = float(rates.max())
+            values = numpy.percentile(rates, percentiles) if percentiles else ()
+            statistics[name + "_percentiles"] = {percentile: float(value)
+                                                 for percentile, value in zip(percentiles, values)}
+
+        return statistics
+
+
+    def __len__(self):
+        return min(self.count, self.size)
@@ -0,0 +1,249 @@
+"""
+Flight recorder of the receive calls of a stream - see Stream.enable_flight_recorder().
+
+Every call of Stream.receive() is recorded in a preallocated ring of int64 fields (see FIELDS), overwriting the
+oldest records. The ring can be dumped to a binary file at any time (dump() or on a signal, see
+install_signal_handler()) and turned into a timeline with read() and format_timeline(), or from the command line:
+
+    python -m mflow.tracing trace.bin --stall 10
+
+File format (little endian): FILE_HEADER (magic, version, number of fields, number of records, CLOCK_REALTIME and
+CLOCK_MONOTONIC of the dump in ns) followed by the records (RECORD), oldest first.
+"""
+import argparse
+import os
+import signal
+import struct
+import time
+from collections import namedtuple
+from logging import getLogger
+from time import monotonic_ns
+
+from .mflow import TRACE_ERROR as ERROR, TRACE_OK as OK, TRACE_TIMEOUT as TIMEOUT
+
+
+logger = getLogger(__name__)
+
+
+MAGIC = b"MFLOWTRC"
+VERSION = 1
+FILE_HEADER = struct.Struct("<8sIIQqq")
+
+# Fields of a record - the timestamps are CLOCK_MONOTONIC in ns, 0 if not taken.
+FIELDS = (
+    "sequence",   # Number of the receive call.
+    "message",    # Messages received by the stream so far (including this one).
+    "frames",     # Frames read.
+    "bytes",      # Bytes read.
+    "start",      # receive() called.
+    "header",     # Header received and decoded (only if the handler is selected by htype).
+    "decoded",    # Handler done.
+    "flushed",    # Remaining frames flushed, statistics updated.
+    "status",     # OK, TIMEOUT or ERROR.
+)
+N_FIELDS = len(FIELDS)
+RECORD = struct.Struct("<%dq" % N_FIELDS)
+
+TraceRecord = namedtuple("TraceRecord", FIELDS)
+
+# Status of a receive call: OK, TIMEOUT (nothing received - receive timeout or non blocking receive) or ERROR (header or
+# message could not be decoded).
+STATUS_NAMES = {OK: "ok", TIMEOUT: "timeout", ERROR: "error"}
+
+
+class FlightRecorder:
+    """
+    Preallocated ring of trace records. Recording does not allocate memory - a record is written with a single
+    pack_into call, so tracing a receive call costs a fraction of a microsecond.
+    """
+
+    def __init__(self, size=65536):
+        """
+        :param size: Number of records kept.
+        """
+        self.size = size
+        self.records = bytearray(RECORD.size * size)
+        self._pack_into = RECORD.pack_into
+        # Number of records written in total - the next record goes to index count % size.
+        self.count = 0
+
+        # Receive call in progress
+        self._start = 0
+        self._header = 0
+        self._decoded = 0
+        self._frames = 0
+        self._bytes = 0
+
+
+    def start(self, statistics):
+        self._start = monotonic_ns()
+        self._header = 0
+        self._decoded = 0
+        self._frames = statistics.frames_received
+        # Not reset by the flush of the message, unlike bytes_received alone.
+        self._bytes = statistics.total_bytes_received + statistics.bytes_received
+
+
+    def header_received(self):
+        self._header = monotonic_ns()
+
+
+    def decoded(self):
+        self._decoded = monotonic_ns()
+
+
+    def end(self, statistics, status=OK):
+        self.record(statistics.messages_received, statistics.frames_received - self._frames,
+                    statistics.total_bytes_received + statistics.bytes_received - self._bytes, self._start,
+                    self._header, self._decoded, monotonic_ns(), status)
+
+
+    def record(self, message, frames, nbytes, start, header, decoded, flushed, status):
+        count = self.count
+        self._pack_into(self.records, (count % self.size) * RECORD.size, count, message, frames, nbytes, start,
+                        header, decoded, flushed, status)
+        self.count = count + 1
+
+
+    def snapshot(self):
+        """
+        :return: Bytes of the records kept, oldest first.
+        """
+        # Copied first, so records written meanwhile (e.g. when dumping on a signal) do not mix in.
+        records = bytes(self.records)
+        count = self.count
+
+        if count <= self.size:
+            return records[:count * RECORD.size]
+        split = (count % self.size) * RECORD.size
+        return records[split:] + records[:split]
+
+
+    def dump(self, filename):
+        """
+        Write the records kept to a binary file (see read()).
+        :param filename: File to write.
+        :return: Number of records written.
+        """
+        records = self.snapshot()
+
+        n_records = len(records) // RECORD.size
+        with open(filename, "wb") as file_handle:
+            file_handle.write(FILE_HEADER.pack(MAGIC, VERSION, N_FIELDS, n_records, time.time_ns(),
+                                               time.monotonic_ns()))
+            file_handle.write(records)
+
+        logger.info("Dumped %d trace records to %s", n_records, filename)
+        return n_records
+
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+
+
+def install_signal_handler(recorder, folder=".", signum=signal.SIGUSR1):
+    """
+    Dump the flight recorder to "<folder>/mflow_trace_<pid>_<time>.bin" whenever the process receives a signal, e.g.
+    kill -USR1 <pid>. Has to be called from the main thread.
+    :param recorder: FlightRecorder to dump.
+    :param folder: Folder to write the files to.
+    :param signum: Signal to dump on.
+    :return: Previous handler of the signal.
+    """
+    def dump(*args):
+        filename = os.path.join(folder, "mflow_trace_%d_%s.bin" % (os.getpid(), time.strftime("%Y%m%d_%H%M%S")))
+        try:
+            recorder.dump(filename)
+        except Exception:
+            logger.exception("Unable to dump the flight recorder to %s", filename)
+
+    return signal.signal(signum, dump)
+
+
+def read(filename):
+    """
+    Read a file written by FlightRecorder.dump().
+    :param filename: File to read.
+    :return: Tuple (list of TraceRecord oldest first, offset to convert the monotonic timestamps to CLOCK_REALTIME
+             in ns).
+    """
+    with open(filename, "rb") as file_handle:
+        raw = file_handle.read()
+
+    magic, version, n_fields, n_records, realtime, monotonic = FILE_HEADER.unpack_from(raw)
+    if magic != MAGIC:
+        raise ValueError("%s is not an mflow trace file" % filename)
+    if version != VERSION or n_fields != N_FIELDS:
+        raise ValueError("Unsupported trace file version %d (%d fields)" % (version, n_fields))
+
+    records = [TraceRecord(*fields) for fields in
+               RECORD.iter_unpack(raw[FILE_HEADER.size:FILE_HEADER.size + n_records * RECORD.size])]
+    return records, realtime - monotonic
+
+
+def format_timeline(records, offset=0, stall=None):
+    """
+    Format the records as a timeline - one line per receive call with the time spent in each stage in ms:
+    process (since the previous receive call returned, i.e. in the application), wait (until the header was received
+    and decoded), decode (handler) and flush.
+    :param records: TraceRecords, oldest first.
+    :param offset: Offset to add to the timestamps to get CLOCK_REALTIME in ns (see read()).
+    :param stall: Mark the lines where a stage took at least this many ms.
+    :return: List of lines.
+    """
+    lines = ["%-26s %10s %10s %7s %12s %10s %10s %10s %10s" % (
+        "time", "sequence", "message", "frames", "bytes", "process", "wait", "decode", "flush")]
+
+    def duration(begin, end):
+        if not begin or not end:
+            return None
+        return (end - begin) / 10**6
+
+    def column(value):
+        return "%10s" % "-" if value is None else "%10.3f" % value
+
+    previous_end = None
+    for record in records:
+        # Without a header timestamp the wait is part of the decode, or the whole call if nothing was decoded.
+        stages = (duration(previous_end, record.start),
+                  duration(record.start, record.header or (None if record.decoded else record.flushed)),
+                  duration(record.header or record.start, record.decoded),
+                  duration(record.decoded, record.flushed))
+        previous_end = record.flushed
+
+        timestamp = (record.start + offset) / 10**9
+        line = "%s.%06d %10d %10d %7d %12d %s" % (
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)), (timestamp % 1) * 10**6, record.sequence,
+            record.message, record.frames, record.bytes, " ".join(column(value) for value in stages))
+
+        if record.status != OK:
+            line += "  " + STATUS_NAMES.get(record.status, str(record.status))
+        if stall is not None and any(value is not None and value >= stall for value in stages):
+            line += "  STALL"
+        lines.append(line)
+
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the timeline of an mflow flight recorder dump")
+    parser.add_argument("filename", type=str, help="Trace file (see FlightRecorder.dump())")
+    parser.add_argument("-s", "--stall", default=None, type=float,
+                        help="Mark the receive calls with a stage taking at least this many ms")
+    parser.add_argument("--stalls_only", action="store_true", help="Only print the receive calls marked as stall")
+    arguments = parser.parse_args()
+
+    records, offset = read(arguments.filename)
+    lines = format_timeline(records, offset, arguments.stall)
+    print(lines[0])
+    for line in lines[1:]:
+        if not arguments.stalls_only or line.endswith("STALL"):
+            print(line)
+
+
+
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
+import heapq
 import threading
 import time
 from argparse import Namespace
-from collections import OrderedDict, deque
+from collections import OrderedDict, deque, namedtuple
 from logging import getLogger
 
 import zmq
@@ -12,6 +13,9 @@ logger = getLogger(__name__)
 
 
 class RoundRobinStrategy:
+    """
+    Read the streams in turn, skipping streams without a message waiting.
+    """
 
     def __init__(self):
         self.last_stream_read = None
@@ -25,31 +29,154 @@ class RoundRobinStrategy:
             self.last_stream_read %= len(streams)
             return self.last_stream_read
 
+    def select(self, ready):
+        """
+        Select the stream to read from.
+        :param ready: Sorted indexes of the streams with a message waiting.
+        :return: Index of the stream to read from.
+        """
+        index = ready[0]
+        if self.last_stream_read is not None:
+            # First ready stream after the last one read.
+            for candidate in ready:
+                if candidate > self.last_stream_read:
+                    index = candidate
+                    break
+
+        self.last_stream_read = index
+        return index
+
+
+
+class WeightedStrategy:
+    """
+    Smooth weighted round robin - while all streams have messages waiting, stream i is read weights[i] times out of
+    sum(weights) receives, interleaved as evenly as possible.
+    """
+
+    def __init__(self, weights):
+        """
+        :param weights: Positive weight for each stream.
+        """
+        self.weights = list(weights)
+        self._current = [0] * len(self.weights)
+
+    def select(self, ready):
+        total_weight = 0
+        index = None
+        for candidate in ready:
+            self._current[candidate] += self.weights[candidate]
+            total_weight += self.weights[candidate]
+            if index is None or self._current[candidate] > self._current[index]:
+                index = candidate
+
+        self._current[index] -= total_weight
+        return index
+
+
+
+class PriorityStrategy:
+    """
+    Always read the stream with the highest priority (lowest value) that has a message waiting.
+    Streams with equal priority are read in index order.
+    """
+
+    def __init__(self, priorities):
+        """
+        :param priorities: Priority for each stream - lower value means higher priority.
+        """
+        self.priorities = list(priorities)
+
+    def select(self, ready):
+        return min(ready, key=self.priorities.__getitem__)
+
+
 
 class Merge:
     """
     Utility class to merge multiple streams to behave as one.
     """
 
-    def __init__(self, *arg, receive_strategy=RoundRobinStrategy()):
+    def __init__(self, *arg, receive_strategy=None, receive_timeout=None):
+        """
+        :param arg: Streams to merge.
+        :param receive_strategy: Strategy to select the stream to read from - default: RoundRobinStrategy.
+        :param receive_timeout: Receive timeout in milliseconds for blocking receives (None = infinite).
+        """
+        # Imported here, as the mflow module itself depends on this one.
+        from .mflow import Statistics
+
         self.streams = arg
-        self.receive_strategy = receive_strategy
+        self.receive_strategy = receive_strategy if receive_strategy is not None else RoundRobinStrategy()
+        self.receive_timeout = receive_timeout
+
+        # Statistics over all the merged streams - the per stream ones are kept by the streams.
+        self.statistics = Statistics()
+        self._last_total_bytes_received = [0] * len(self.streams)
+
+        self._poller = zmq.Poller()
+        self._socket_index = {}
+        for index, stream in enumerate(self.streams):
+            self._poller.register(stream.socket, zmq.POLLIN)
+            self._socket_index[stream.socket] = index
+
+
+    @property
+    def stream_statistics(self):
+        """
+        List of the statistics of the merged streams.
+        """
+        return [stream.receiver.statistics for stream in self.streams]
 
 
     def receive(self, handler=None, block=True):
-        message = None
-        count = 0
-        #
-        while (message is None or message.data is None) and count < len(self.streams):
-            index_stream = self.receive_strategy.next(self.streams)
-            print(index_stream)
-            message = self.streams[index_stream].receive(handler=handler, block=False)
-            count += 1
-
-        #TODO: need to update statistics
-        #TODO: need to decide what to do if block = True
+        """
+        Receive the next message from any of the streams, waiting on all of them at the same time.
+        :param handler: Reference to a specific message handler function to use for interpreting the message.
+        :param block: Blocking receive call (bounded by receive_timeout).
+        :return: Message (with the merged statistics) or None if no message is available.
+        """
+        return self._receive(handler, self.receive_timeout if block else 0)
+
+
+    def _receive(self, handler, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+
+        while True:
+            ready = sorted(self._socket_index[socket] for socket, _ in self._poller.poll(timeout))
+            if not ready:
+                return None
+
+            index = self._select(ready)
+            message = self.streams[index].receive(handler=handler, block=False)
+            if message is not None:
+                self._update_statistics(index)
+                message.statistics = self.statistics
+                return message
+
+            # The message could not be decoded - try again in the remaining time.
+            if deadline is not None:
+                timeout = max(0, (deadline - time.monotonic()) * 1000)
 
-        return message
+
+    def _select(self, ready):
+        if hasattr(self.receive_strategy, "select"):
+            return self.receive_strategy.select(ready)
+
+        # Strategies only providing next(streams).
+        for _ in self.streams:
+            index = self.receive_strategy.next(self.streams)
+            if index in ready:
+                return index
+        return ready[0]
+
+
+    def _update_statistics(self, index):
+        total_bytes_received = self.streams[index].receiver.statistics.total_bytes_received
+
+        self.statistics.total_bytes_received += total_bytes_received - self._last_total_bytes_received[index]
+        self.statistics.messages_received += 1
+        self._last_total_bytes_received[index] = total_bytes_received
 
 
     def disconnect(self):
@@ -57,26 +184,411 @@ class Merge:
         As this class should somehow behave as a stream this function will close all involved streams
         """
         for stream in self.streams:
+            self._poller.unregister(stream.socket)
             stream.disconnect()
 
 
 
+# Kinds of OrderedMerge events.
+GAP = "gap"    # Messages with the keys key...key+count-1 never arrived in time and were skipped.
+LATE = "late"  # A message with this key arrived after its turn (or twice) and was dropped.
+
+OrderEvent = namedtuple("OrderEvent", ["kind", "key", "count"])
+
+# Messages starting or ending a series - the keys of the next series start over (see OrderedMerge).
+SERIES_BOUNDARY_HTYPES = ("dheader-1.0", "dseries_end-1.0")
+
+
+class OrderedMerge:
+    """
+    Merge multiple streams into one stream ordered by a header value (e.g. frame or pulse id).
+    Messages arriving out of order are held back in a bounded reorder buffer until it is their turn.
+    The order starts over with a new series: when the "series" of the headers changes or a dheader-1.0 or
+    dseries_end-1.0 arrives (see reset()).
+    """
+
+    def __init__(self, *arg, key="frame", window=100, timeout=1000, receive_strategy=None, receive_timeout=None,
+                 event_callback=None, first=None):
+        """
+        :param arg: Streams to merge.
+        :param key: Header key to order the messages by - its values must be consecutive integers.
+        :param window: Maximum number of messages held back - when exceeded the missing messages are skipped.
+        :param timeout: Time in milliseconds to wait for a missing message before skipping it.
+        :param receive_strategy: Strategy to select the stream to read from - default: RoundRobinStrategy.
+        :param receive_timeout: Receive timeout in milliseconds for blocking receives (None = infinite).
+        :param event_callback: Function called with an OrderEvent for every gap or late arrival.
+        :param first: Key of the first message of every series - default: key of the first message received.
+        """
+        self.merge = Merge(*arg, receive_strategy=receive_strategy)
+        self.key = key
+        self.window = window
+        self.timeout = timeout / 1000
+        self.receive_timeout = receive_timeout
+        self.event_callback = event_callback
+
+        self.first = first
+        self.expected = first
+        # Series of the messages ordered (header "series")
+        self._series = None
+        self._heap = []
+        self._keys = set()
+        # Messages without key are not ordered, but delivered right away.
+        self._unordered = deque()
+        # Arrival counter, to keep the heap order stable.
+        self._arrival = 0
+        self._waiting_since = None
+
+        self.max_reorder_depth = 0
+        self.gaps = 0
+        self.messages_missing = 0
+        self.messages_late = 0
+
+
+    @property
+    def statistics(self):
+        return self.merge.statistics
+
+
+    @property
+    def reorder_depth(self):
+        """
+        Number of messages currently held back.
+        """
+        return len(self._heap)
+
+
+    def receive(self, handler=None, block=True):
+        """
+        Receive the next message in order.
+        :param handler: Reference to a specific message handler function to use for interpreting the message.
+        :param block: Blocking receive call (bounded by receive_timeout).
+        :return: Message (with the merged statistics) or None if no message is available.
+        """
+        deadline = None
+        if block and self.receive_timeout is not None:
+            deadline = time.monotonic() + self.receive_timeout / 1000
+
+        while True:
+            message = self._next_in_order()
+            if message is not None:
+                return message
+
+            # Wait for more messages, but not beyond the time a missing message is skipped.
+            timeout = None
+            if self._heap:
+                timeout = max(0, (self._waiting_since + self.timeout - time.monotonic()) * 1000)
+            if not block:
+                timeout = 0
+            elif deadline is not None:
+                remaining = max(0, (deadline - time.monotonic()) * 1000)
+                timeout = remaining if timeout is None else min(timeout, remaining)
+
+            message = self.merge._receive(handler, timeout)
+            if message is not None:
+                self._add(message)
+            elif not block or (deadline is not None and time.monotonic() >= deadline):
+                # A missing message might just have timed out.
+                return self._next_in_order()
+
+
+    def reset(self, first=None):
+        """
+        Start the order over, e.g. for a new series: the messages held back are delivered (in order, skipping the
+        missing ones) and the next message received is expected next.
+        :param first: Key of the first message - default: first given to the constructor.
+        """
+        while self._heap:
+            key, _, message = heapq.heappop(self._heap)
+            self._skip_to(key)
+            self.expected = key + 1
+            self._unordered.append(message)
+
+        self._keys.clear()
+        self._waiting_since = None
+        self.expected = self.first if first is None else first
+        self._series = None
+
+
+    def _add(self, message):
+        try:
+            header = message.data["header"]
+            series = header.get("series")
+            if header.get("htype") in SERIES_BOUNDARY_HTYPES or \
+                    (series is not None and self._series is not None and series != self._series):
+                self.reset()
+            if series is not None:
+                self._series = series
+
+            key = header[self.key]
+        except (KeyError, TypeError, AttributeError):
+            self._unordered.append(message)
+            return
+
+        if self.expected is None:
+            self.expected = key
+
+        if key < self.expected or key in self._keys:
+            self.messages_late += 1
+            self._notify(OrderEvent(LATE, key, 1))
+            message.release()
+            return
+
+        heapq.heappush(self._heap, (key, self._arrival, message))
+        self._arrival += 1
+        self._keys.add(key)
+        if self._waiting_since is None:
+            self._waiting_since = time.monotonic()
+
+        if len(self._heap) > self.max_reorder_depth:
+            self.max_reorder_depth = len(self._heap)
+
+
+    def _next_in_order(self):
+        if self._unordered:
+            return self._unordered.popleft()
+
+        if not self._heap:
+            return None
+
+        key = self._heap[0][0]
+        if key != self.expected:
+            # Wait for the missing messages, as long as the window and timeout allow.
+            if len(self._heap) <= self.window and time.monotonic() - self._waiting_since < self.timeout:
+                return None
+
+            self._skip_to(key)
+
+        _, _, message = heapq.heappop(self._heap)
+        self._keys.discard(key)
+        self.expected = key + 1
+        # Restart the timeout for the next message.
+        self._waiting_since = time.monotonic() if self._heap else None
+
+        return message
+
+
+    def _skip_to(self, key):
+        if self.expected is not None and key != self.expected:
+            self.gaps += 1
+            self.messages_missing += key - self.expected
+            self._notify(OrderEvent(GAP, self.expected, key - self.expected))
+
+
+    def _notify(self, event):
+        logger.debug("Ordered merge event: %s", event)
+        if self.event_callback is not None:
+            self.event_callback(event)
+
+
+    def disconnect(self):
+        """
+        Close all involved streams.
+        """
+        self.merge.disconnect()
+
+
+
+class SequenceStatistics:
+    """
+    Statistics of the frame sequence of one source and htype - see SequenceTracker.
+    """
+
+    def __init__(self, source, htype, now):
+        self.source = source
+        self.htype = htype
+
+        self.messages_received = 0
+        self.total_bytes_received = 0
+        # Messages never received (so far - a message arriving late is counted as out of order instead).
+        self.messages_lost = 0
+        self.messages_duplicated = 0
+        self.messages_out_of_order = 0
+        # Number of gaps in the sequence and size of the largest one.
+        self.gaps = 0
+        self.max_gap = 0
+
+        self.series = None
+        self.expected = None
+        # Recently missed frames, to tell late messages from duplicates.
+        self.missing = OrderedDict()
+
+        self.first_time = now
+        self.last_time = now
+        self._interval = (now, 0, 0)
+
+
+    def as_dict(self, now=None):
+        """
+        :param now: time.time() of the end of the interval - the interval rates are not computed if None.
+        :return: Dict with the counters (and the rates since the previous call).
+        """
+        result = OrderedDict([
+            ("source", self.source), ("htype", self.htype), ("messages_received", self.messages_received),
+            ("total_bytes_received", self.total_bytes_received), ("messages_lost", self.messages_lost),
+            ("messages_duplicated", self.messages_duplicated), ("messages_out_of_order", self.messages_out_of_order),
+            ("gaps", self.gaps), ("max_gap", self.max_gap)])
+
+        if now is not None:
+            start_time, messages, total_bytes = self._interval
+            delta_time = now - start_time
+            result["message_rate"] = (self.messages_received - messages) / delta_time if delta_time > 0 else 0.0
+            result["data_rate"] = (self.total_bytes_received - total_bytes) / delta_time if delta_time > 0 else 0.0
+            self._interval = (now, self.messages_received, self.total_bytes_received)
+
+        return result
+
+
+
+class SequenceTracker:
+    """
+    Track the frame numbers of the messages of each source and htype, to count lost, duplicated and out of order
+    messages. Frame numbers restart with every series (the "series" header value), messages without frame number (e.g.
+    dheader-1.0) are only counted.
+    """
+
+    def __init__(self, key="frame", window=10000):
+        """
+        :param key: Header key with the sequence number.
+        :param window: Number of missed frames remembered per sequence - a missed frame arriving later is counted as
+                       out of order (and no longer as lost) only while it is remembered, afterwards as duplicate.
+        """
+        self.key = key
+        self.window = window
+        # SequenceStatistics by (source, htype)
+        self.sequences = OrderedDict()
+
+
+    def update(self, header, nbytes=0, now=None):
+        """
+        :param header: Header of the message received.
+        :param nbytes: Size of the message in bytes.
+        :param now: Receive time (default: time.time()).
+        :return: SequenceStatistics of the message's sequence.
+        """
+        if now is None:
+            now = time.time()
+
+        source = header.get("source")
+        htype = header.get("htype")
+        sequence = self.sequences.get((source, htype))
+        if sequence is None:
+            sequence = self.sequences[(source, htype)] = SequenceStatistics(source, htype, now)
+
+        sequence.messages_received += 1
+        sequence.total_bytes_received += nbytes
+        sequence.last_time = now
+
+        frame = header.get(self.key)
+        if not isinstance(frame, int):
+            return sequence
+
+        series = header.get("series")
+        if series != sequence.series:
+            sequence.series = series
+            sequence.expected = None
+            sequence.missing.clear()
+
+        if sequence.expected is None or frame == sequence.expected:
+            sequence.expected = frame + 1
+
+        elif frame > sequence.expected:
+            gap = frame - sequence.expected
+            sequence.messages_lost += gap
+            sequence.gaps += 1
+            sequence.max_gap = max(sequence.max_gap, gap)
+
+            for missing in range(max(sequence.expected, frame - self.window), frame):
+                sequence.missing[missing] = None
+            while len(sequence.missing) > self.window:
+                sequence.missing.popitem(last=False)
+            sequence.expected = frame + 1
+
+        elif frame in sequence.missing:
+            del sequence.missing[frame]
+            sequence.messages_lost -= 1
+            sequence.messages_out_of_order += 1
+
+        else:
+            sequence.messages_duplicated += 1
+
+        return sequence
+
+
+    @property
+    def messages_lost(self):
+        return sum(sequence.messages_lost for sequence in self.sequences.values())
+
+
+    def get_statistics(self, now=None):
+        """
+        :param now: time.time() of the end of the interval - the interval rates are not computed if None.
+        :return: List of dicts with the statistics of each sequence (see SequenceStatistics.as_dict).
+        """
+        return [sequence.as_dict(now) for sequence in self.sequences.values()]
+
+
+
+class TokenBucket:
+    """
+    Rate limiter - acquire() waits until the next message may be sent.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: Tokens (e.g. messages) per second.
+        :param burst: Maximum number of tokens that can be acquired without waiting after an idle period.
+        """
+        if rate <= 0:
+            raise ValueError("Rate must be positive")
+
+        self.rate = rate
+        self.burst = burst
+
+        self._tokens = burst
+        self._last = time.monotonic()
+
+
+    def acquire(self, tokens=1):
+        """
+        Take tokens from the bucket, waiting until enough of them are available.
+        :param tokens: Number of tokens to take.
+        :return: Time waited, in seconds.
+        """
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate) - tokens
+        self._last = now
+
+        if self._tokens >= 0:
+            return 0.0
+
+        # The deficit is made up by the time slept, on the next refill.
+        wait = -self._tokens / self.rate
+        time.sleep(wait)
+        return wait
+
+
+
 class ThroughputStatistics:
     """
     Utility to calculate the stream throughput based on the mflow statistics.
+    The samples are kept in a mflow.rolling.RollingStatistics - see get_rolling_statistics().
     """
     # Bytes to mega bytes conversion factor.
     MB_FACTOR = 1 / 10**6
 
-    def __init__(self, buffer=None, namespace=None, sampling_interval=0.2):
+    def __init__(self, buffer=None, namespace=None, sampling_interval=0.2, history=4096, half_life=5.0):
         """
         Initialize the statistics class.
-        :param buffer: Circular buffer for saving statistics events. Default: None.
+        :param buffer: Circular buffer for saving the sampled statistics events. Default: None.
         :type buffer: collections.deque
-        :param namespace: Namespace to use temporary variables. Default: None.
+        :param namespace: Namespace to keep the initial time and the last sampled statistics in. Default: None.
         :type namespace: argparse.Namespace
         :param sampling_interval: Sampling interval for adding new statistic events.
+        :param history: Number of samples kept for the rolling statistics.
+        :param half_life: Half life of the moving average of the rates in seconds.
         """
+        from .rolling import RollingStatistics
+
         self.sampling_interval = sampling_interval
         self._logger = getLogger(self.__class__.__name__)
 
@@ -92,8 +604,15 @@ class ThroughputStatistics:
         else:
             self.n = namespace
 
+        self.rolling = RollingStatistics(size=history, half_life=half_life)
+
+        # The rates are computed on the monotonic time, the times in the namespace are epoch times (time.time()).
+        self._initial_time = time.monotonic()
+        self._epoch_offset = time.time() - self._initial_time
+        self.rolling.add(self._initial_time, 0, 0)
+
         # Collect the initial time in case you need to print the summary.
-        self.n.initial_time = time.time()
+        self.n.initial_time = self._initial_time + self._epoch_offset
 
         # Keep track of the last statistics printed to the user.
         self.n.last_sampled_statistics = {"total_bytes_received": 0,
@@ -105,23 +624,32 @@ class ThroughputStatistics:
                                            "messages_received": 0,
                                            "time": self.n.initial_time}
 
+        # Last statistics received - only copied, everything else is done when sampling.
+        self._last_time = self._initial_time
+        self._last_bytes = 0
+        self._last_messages = 0
+        self._last_sample_time = self._initial_time
+        self._next_sample = self._initial_time + self.sampling_interval
+
 
     def save_statistics(self, message_statistics):
         """
-        Save new message statistics to the buffer.
+        Save new message statistics - they are only sampled once the sampling interval passed.
         :param message_statistics: Statistics to process.
         :return: True if sampling interval was reached, False otherwise.
         """
-        current_time = time.time()
-
-        # Save received statistics.
-        self.n.last_received_statistics["total_bytes_received"] = message_statistics.total_bytes_received
-        self.n.last_received_statistics["messages_received"] = message_statistics.messages_received
-        self.n.last_received_statistics["time"] = current_time
-
-        delta_time = current_time - self.n.last_sampled_statistics["time"]
-        # If the delta time is greater than the sampling rate, print the statistics.
-        if delta_time > self.sampling_interval:
+        current_time = time.monotonic()
+        self._last_time = current_time
+        self._last_bytes = message_statistics.total_bytes_received
+        self._last_messages = message_statistics.messages_received
+
+        last_received_statistics = self.n.last_received_statistics
+        last_received_statistics["total_bytes_received"] = self._last_bytes
+        last_received_statistics["messages_received"] = self._last_messages
+        last_received_statistics["time"] = current_time + self._epoch_offset
+
+        # If the delta time is greater than the sampling rate, sample the statistics.
+        if current_time > self._next_sample:
             self._save_statistics_to_buffer()
             return True
         # The sampling interval was not reached, no new statistics events.
@@ -130,17 +658,11 @@ class ThroughputStatistics:
 
     def _save_statistics_to_buffer(self):
         """
-        Calculate the data rate and print the statistics to the standard output.
+        Calculate the rates of the last interval and add them to the statistics.
         """
-        delta_time = self.n.last_received_statistics["time"] - self.n.last_sampled_statistics["time"]
-
-        # bytes/second in last interval.
-        data_rate = (self.n.last_received_statistics["total_bytes_received"] -
-                     self.n.last_sampled_statistics["total_bytes_received"]) / delta_time
-
-        # messages/second in last interval.
-        message_rate = (self.n.last_received_statistics["messages_received"] -
-                        self.n.last_sampled_statistics["messages_received"]) / delta_time
+        data_rate, message_rate = self.rolling.add(self._last_time, self._last_bytes, self._last_messages)
+        self._last_sample_time = self._last_time
+        self._next_sample = self._last_time + self.sampling_interval
 
         self._buffer.append({"message_rate": message_rate,
                              "data_rate": data_rate})
@@ -169,18 +691,15 @@ class ThroughputStatistics:
         Get aggregated statistics.
         :return: Dict with summary or {} if no statistics is available.
         """
-        delta_time = self.n.last_received_statistics["time"] - self.n.initial_time
+        delta_time = self._last_time - self._initial_time
         # Get statistics if any message was received.
-        if delta_time > 0:
-            average_message_size = self.n.last_received_statistics["total_bytes_received"] / \
-                                   self.n.last_received_statistics["messages_received"]
-
+        if delta_time > 0 and self._last_messages:
             statistics = {"total_elapsed_time": delta_time,
-                          "average_message_size": average_message_size,
-                          "total_bytes_received": self.n.last_received_statistics["total_bytes_received"],
-                          "average_data_rate": self.n.last_received_statistics["total_bytes_received"] / delta_time,
-                          "messages_received": self.n.last_received_statistics["messages_received"],
-                          "average_message_rate": self.n.last_received_statistics["messages_received"] / delta_time}
+                          "average_message_size": self._last_bytes / self._last_messages,
+                          "total_bytes_received": self._last_bytes,
+                          "average_data_rate": self._last_bytes / delta_time,
+                          "messages_received": self._last_messages,
+                          "average_message_rate": self._last_messages / delta_time}
 
             return OrderedDict(sorted(statistics.items()))
 
@@ -188,6 +707,17 @@ class ThroughputStatistics:
         return {}
 
 
+    def get_rolling_statistics(self, window=None, percentiles=(50, 90, 99)):
+        """
+        Get the statistics of the sampled rates over a window - see RollingStatistics.get_statistics().
+        :param window: Window in seconds (None = all the samples kept).
+        :param percentiles: Percentiles of the rates of the sampling intervals.
+        :return: Dict with the average, minimum, maximum, percentiles and moving average of the rates, {} if less
+                 than 2 samples were taken.
+        """
+        return self.rolling.get_statistics(window, percentiles)
+
+
     def get_statistics_raw(self):
         """
         Return the raw statistics data.
@@ -202,7 +732,7 @@ class ThroughputStatistics:
         this events will be added to the statistics (but the sampling interval will not be honored in this case).
         :return: True if new statistic events were added, False otherwise.
         """
-        delta_time = self.n.last_received_statistics["time"] - self.n.last_sampled_statistics["time"]
+        delta_time = self._last_time - self._last_sample_time
         # If the last received is not the same as the last printed statistics, process it.
         # Note: The sampling interval, when flushing, is not honored.
         if delta_time > 0:
@@ -213,26 +743,283 @@ class ThroughputStatistics:
 
 
 
+class LatencyHistogram:
+    """
+    Histogram of durations in nanoseconds with fixed log-linear buckets.
+    Every power of two is split in 32 linear buckets, so the values are resolved to about 3% over the whole range.
+    """
+    SUB_BUCKET_BITS = 6
+    # Largest value resolved - larger values are counted in the last bucket (about 9.7 hours).
+    MAX_VALUE_BITS = 45
+
+    _SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+    _HALF_SUB_BUCKETS = _SUB_BUCKETS >> 1
+    N_BUCKETS = _SUB_BUCKETS + (MAX_VALUE_BITS - SUB_BUCKET_BITS) * _HALF_SUB_BUCKETS
+
+    def __init__(self):
+        self.counts = [0] * self.N_BUCKETS
+        self.reset()
+
+
+    def reset(self):
+        """
+        Clear all recorded values (e.g. at the start of a new interval).
+        """
+        counts = self.counts
+        for index in range(self.N_BUCKETS):
+            counts[index] = 0
+
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+
+    def record(self, value):
+        """
+        Record a duration.
+        :param value: Duration in nanoseconds (int).
+        """
+        if value < self._SUB_BUCKETS:
+            index = max(value, 0)
+        else:
+            exponent = value.bit_length() - self.SUB_BUCKET_BITS
+            index = min(self._SUB_BUCKETS + (exponent - 1) * self._HALF_SUB_BUCKETS +
+                        (value >> exponent) - self._HALF_SUB_BUCKETS, self.N_BUCKETS - 1)
+        self.counts[index] += 1
+
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+
+    def percentile(self, percentile):
+        """
+        Get the value below which the given percentage of the recorded values fall.
+        :param percentile: Percentage, e.g. 99.9.
+        :return: Value in nanoseconds (middle of the bucket) or None if no value was recorded.
+        """
+        if not self.count:
+            return None
+
+        target = max(1, -(-self.count * percentile // 100))
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return min(max(self._bucket_value(index), self.min), self.max)
+        return self.max
+
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+
+    def _bucket_value(self, index):
+        if index < self._SUB_BUCKETS:
+            return index
+
+        exponent = (index - self._SUB_BUCKETS) // self._HALF_SUB_BUCKETS + 1
+        mantissa = (index - self._SUB_BUCKETS) % self._HALF_SUB_BUCKETS + self._HALF_SUB_BUCKETS
+        return (mantissa << exponent) + (1 << (exponent - 1))
+
+
+
+class StageTimings:
+    """
+    Latency histograms of the stages of Stream.receive() - see Stream.enable_timing().
+    """
+    # receive: waiting for and receiving the first frame, header: decoding the header,
+    # decode: receiving the other frames and running the handler, process: time between receive calls.
+    STAGES = ("receive", "header", "decode", "process")
+    PERCENTILES = (50, 99, 99.9)
+
+    def __init__(self):
+        self.histograms = OrderedDict((stage, LatencyHistogram()) for stage in self.STAGES)
+        self._receive = self.histograms["receive"]
+        self._header = self.histograms["header"]
+        self._decode = self.histograms["decode"]
+        self._process = self.histograms["process"]
+
+        self._mark = None
+        self._last_end = None
+
+
+    def start(self):
+        now = time.perf_counter_ns()
+        if self._last_end is not None:
+            self._process.record(now - self._last_end)
+        self._mark = now
+
+
+    def header_received(self):
+        now = time.perf_counter_ns()
+        self._receive.record(now - self._mark)
+        self._mark = now
+
+
+    def header_decoded(self):
+        now = time.perf_counter_ns()
+        self._header.record(now - self._mark)
+        self._mark = now
+
+
+    def end(self, decoded=True):
+        now = time.perf_counter_ns()
+        if decoded:
+            self._decode.record(now - self._mark)
+        self._last_end = now
+
+
+    def get_percentiles(self, percentiles=PERCENTILES):
+        """
+        :param percentiles: Percentiles to compute.
+        :return: Dict stage -> dict percentile -> value in nanoseconds (None if nothing was recorded).
+        """
+        return OrderedDict((stage, OrderedDict((percentile, histogram.percentile(percentile))
+                                               for percentile in percentiles))
+                           for stage, histogram in self.histograms.items())
+
+
+    def reset(self):
+        """
+        Start a new interval.
+        """
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+
+
+# Header key of the hop stamps (see Stream.enable_stamps()) - list of [hop, clock, nanoseconds].
+STAMPS = "mflow_stamps"
+
+# Clocks of the hop stamps.
+MONOTONIC = "monotonic"  # CLOCK_MONOTONIC - exact, but only comparable on the same host.
+REALTIME = "realtime"    # CLOCK_REALTIME - comparable across hosts, as accurate as their clock synchronization.
+
+_stamp_clocks = {MONOTONIC: time.monotonic_ns, REALTIME: time.time_ns}
+
+
+class HopStamps:
+    """
+    Stamp the headers of sent messages and measure the latency of each hop of received messages from their stamps -
+    see Stream.enable_stamps().
+    """
+    PERCENTILES = (50, 99, 99.9)
+
+    def __init__(self, hop, clock=REALTIME):
+        """
+        :param hop: Name of this hop.
+        :param clock: Clock of the stamps - MONOTONIC or REALTIME.
+        """
+        if clock not in _stamp_clocks:
+            raise ValueError("Unsupported clock [%s] - supported: %s" % (clock, ", ".join(_stamp_clocks)))
+
+        self.hop = hop
+        self.clock = clock
+        self._now = _stamp_clocks[clock]
+
+        # LatencyHistogram of each hop ("sender -> receiver") and "total" (from the first stamp to this hop).
+        self.histograms = OrderedDict()
+        # Hops with a negative latency, i.e. clocks that are not synchronized - they are recorded as 0.
+        self.clock_skew = 0
+
+
+    def stamp(self, header):
+        """
+        Append the stamp of this hop to a header.
+        :param header: Header dict - modified in place, the list of stamps is copied.
+        :return: The header.
+        """
+        header[STAMPS] = list(header.get(STAMPS) or ()) + [[self.hop, self.clock, self._now()]]
+        return header
+
+
+    def record(self, header):
+        """
+        Record the latencies of the hops of a received message. Only stamps of the same clock are compared.
+        :param header: Header of the received message.
+        """
+        try:
+            stamps = header.get(STAMPS)
+            if not stamps:
+                return
+
+            received = {clock: _stamp_clocks[clock]() for _, clock, _ in stamps if clock in _stamp_clocks}
+            for (hop, clock, sent), (next_hop, next_clock, next_sent) in zip(stamps, stamps[1:]):
+                if clock == next_clock:
+                    self._record("%s -> %s" % (hop, next_hop), next_sent - sent)
+
+            hop, clock, sent = stamps[-1]
+            if clock in received:
+                self._record("%s -> %s" % (hop, self.hop), received[clock] - sent)
+
+            hop, clock, sent = stamps[0]
+            if clock in received:
+                self._record("total", received[clock] - sent)
+        except (AttributeError, TypeError, ValueError):
+            logger.debug("Invalid hop stamps - ignored", exc_info=True)
+
+
+    def _record(self, hop, latency):
+        histogram = self.histograms.get(hop)
+        if histogram is None:
+            histogram = self.histograms[hop] = LatencyHistogram()
+
+        if latency < 0:
+            self.clock_skew += 1
+            latency = 0
+        histogram.record(latency)
+
+
+    def get_percentiles(self, percentiles=PERCENTILES):
+        """
+        :param percentiles: Percentiles to compute.
+        :return: Dict hop -> dict percentile -> value in nanoseconds.
+        """
+        return OrderedDict((hop, OrderedDict((percentile, histogram.percentile(percentile))
+                                             for percentile in percentiles))
+                           for hop, histogram in self.histograms.items())
+
+
+    def reset(self):
+        """
+        Start a new interval.
+        """
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+
+
 class ThroughputStatisticsPrinter:
     """
     Wrapper to save and display the stream statistics.
     """
 
-    def __init__(self, sampling_interval=0.2):
+    def __init__(self, sampling_interval=0.2, timings=None):
         """
         Initiate the stream statistics printer.
         :param sampling_interval: Minimum sampling interval.
+        :param timings: StageTimings of the stream (see Stream.enable_timing()) or HopStamps (see
+                        Stream.enable_stamps()) to print the latencies of each interval.
         """
         self.statistics = ThroughputStatistics(sampling_interval=sampling_interval)
+        self.timings = timings
 
 
     def save_statistics(self, message_statistics):
         """
         Should be called at every message received.
         :param message_statistics: Statistics of the received message.
+        :return: True if the statistics of an interval were printed.
         """
         if self.statistics.save_statistics(message_statistics):
             self.print_statistics()
+            return True
+        return False
 
 
     def print_statistics(self):
@@ -251,6 +1038,30 @@ class ThroughputStatisticsPrinter:
 
         print(output)
 
+        if self.timings is not None:
+            self.print_timings()
+
+
+    def print_timings(self):
+        """
+        Print the latency percentiles of each stage in the last interval and start a new interval.
+        """
+        stages = self.timings.get_percentiles()
+        width = max([8] + [len(stage) + 1 for stage in stages])
+        for stage, percentiles in stages.items():
+            values = "".join("    p{}: {}".format(percentile, self._format_latency(value))
+                             for percentile, value in percentiles.items())
+            print("  {}{}".format(stage.ljust(width), values))
+
+        self.timings.reset()
+
+
+    @staticmethod
+    def _format_latency(value):
+        if value is None:
+            return "{: >10}   ".format("-")
+        return "{: >10.1f} us".format(value / 1000)
+
 
     def print_summary(self):
         """
@@ -269,6 +1080,17 @@ class ThroughputStatisticsPrinter:
                 statistics_summary["average_data_rate"] * self.statistics.MB_FACTOR))
             print("Messages received:    {: >10d} messages".format(statistics_summary["messages_received"]))
             print("Average message rate: {: >10.3f} Hz".format(statistics_summary["average_message_rate"]))
+
+            # Spread of the rates of the sampling intervals.
+            rolling = self.statistics.get_rolling_statistics(percentiles=(50, 99))
+            if rolling.get("intervals", 0) > 1:
+                print("Data rate min/p50/p99/max:    {:.3f} / {:.3f} / {:.3f} / {:.3f} MB/s".format(
+                    *(value * self.statistics.MB_FACTOR for value in (
+                        rolling["min_data_rate"], rolling["data_rate_percentiles"][50],
+                        rolling["data_rate_percentiles"][99], rolling["max_data_rate"]))))
+                print("Message rate min/p50/p99/max: {:.3f} / {:.3f} / {:.3f} / {:.3f} Hz".format(
+                    rolling["min_message_rate"], rolling["message_rate_percentiles"][50],
+                    rolling["message_rate_percentiles"][99], rolling["max_message_rate"]))
         # No messages were received.
         else:
             print("No messages received.")
@@ -17,6 +17,7 @@ setup(
     author="Paul Scherrer Institute",
     license="GNU GPLv3",
     install_requires=["numpy", "pyzmq"],
+    extras_require={"compression": ["lz4", "zstandard", "bitshuffle"]},
     packages=find_packages(),
     long_description=read('Readme.md'),
     long_description_content_type="text/markdown",
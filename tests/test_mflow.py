@@ -1,15 +1,35 @@
+import asyncio
+import contextlib
+import glob
+import io
 import json
 import logging
+import mmap
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
 import time
 import unittest
 from itertools import groupby
 from multiprocessing import Process, Queue
 
 import numpy as np
+import zmq
 
 import mflow
 import mflow.handlers.array_1_0
-from mflow.utils import ConnectionCountMonitor
+from mflow import hooks, recording, tracing
+from mflow.cli import generate, replay, split
+from mflow.handlers import array_1_0, dimage_1_0
+from mflow.pool import BufferPool, BufferPoolExhausted
+from mflow.registry import HandlerRegistry, HandlerView
+from mflow.rolling import RollingStatistics
+from mflow.utils import (GAP, LATE, ConnectionCountMonitor, LatencyHistogram, Merge, OrderedMerge, OrderEvent,
+                         HopStamps, PriorityStrategy, SequenceTracker, ThroughputStatistics,
+                         WeightedStrategy)
 
 
 logger = logging.getLogger("mflow.mflow")
@@ -317,3 +337,1041 @@ class BaseTests(unittest.TestCase):
 
 
 
+
+
+    def test_receive_batch(self):
+        socket_address = "tcp://127.0.0.1:9998"
+        n = 5
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL)
+
+        try:
+            data = np.arange(10, dtype=np.int32)
+            for i in range(n):
+                header = {"htype": "array-1.0", "type": "int32", "shape": [10, ], "frame": i}
+                sending_stream.send(json.dumps(header).encode("utf-8"), send_more=True)
+                sending_stream.send(data.tobytes())
+
+            messages = receiving_stream.receive_batch(max_messages=3, timeout=1000)
+            # Give the remaining messages time to arrive.
+            time.sleep(0.1)
+            messages += receiving_stream.receive_batch(max_messages=10, timeout=1000)
+
+            self.assertEqual([m.data["header"]["frame"] for m in messages], list(range(n)))
+            self.assertTrue(all((m.data["data"][0] == data).all() for m in messages))
+            self.assertEqual(messages[-1].statistics.messages_received, n)
+
+            # Nothing left in the queue.
+            self.assertEqual(receiving_stream.receive_batch(timeout=10), [])
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_header_decoded_once(self):
+        header = {"htype": "array-1.0", "type": "uint16", "shape": [2, 3], "frame": 0}
+        data = np.arange(6, dtype=np.uint16).reshape((2, 3))
+
+        receiver = mflow.FrameListReceiveHandler()
+        receiver.load([mflow.jsonapi.dumps(header), data.tobytes()])
+
+        parsed_header = receiver.header()
+        message = array_1_0.Handler.receive(receiver)
+
+        self.assertIs(message["header"], parsed_header, "Header decoded more than once.")
+        self.assertTrue((message["data"][0] == data).all())
+        self.assertIs(array_1_0.get_layout("uint16", [2, 3]),
+                      array_1_0.get_layout("uint16", [2, 3]), "Array layout not cached.")
+
+
+    def test_receive_buffer_pool(self):
+        socket_address = "tcp://127.0.0.1:9998"
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000, buffer_pool_size=1, buffer_pool_policy="drop")
+
+        def send(frame):
+            header = {"htype": "array-1.0", "type": "int32", "shape": [4, 1024], "frame": frame}
+            sending_stream.send(json.dumps(header).encode("utf-8"), send_more=True)
+            sending_stream.send(np.full((4, 1024), frame, dtype=np.int32).tobytes())
+
+        try:
+            send(0)
+            send(1)
+            send(2)
+
+            first = receiving_stream.receive()
+            array = first.data["data"][0]
+            self.assertTrue((array == 0).all())
+            self.assertEqual(array.ctypes.data % mmap.PAGESIZE, 0, "Buffer not page aligned.")
+
+            # The only buffer is still in use, so the second message is dropped.
+            self.assertIsNone(receiving_stream.receive())
+            first.release()
+
+            with receiving_stream.receive() as third:
+                self.assertIs(third.data["data"][0], array, "Buffer was not recycled.")
+                self.assertTrue((array == 2).all())
+
+            self.assertEqual(receiving_stream.receiver.buffer_pool.buffers_in_use, 0)
+            self.assertEqual(receiving_stream.receiver.buffer_pool.buffers_dropped, 1)
+
+            # A blocking pool does not wait forever for a message that is never released.
+            pool = BufferPool(1, "block", timeout=0.1)
+            pool.acquire(np.dtype(np.int32), (4, ))
+            with self.assertLogs("mflow.pool", logging.WARNING):
+                with self.assertRaises(BufferPoolExhausted):
+                    pool.acquire(np.dtype(np.int32), (4, ))
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_async_stream(self):
+        socket_address = "tcp://127.0.0.1:9998"
+        n = 3
+
+        async def run():
+            sending_stream = mflow.connect_async(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+            receiving_stream = mflow.connect_async(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                                   receive_timeout=1000)
+            try:
+                for i in range(n):
+                    await sending_stream.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10],
+                                                             "frame": i},
+                                                  "data": [np.full(10, i, dtype=np.int32)]})
+
+                messages = []
+                async for message in receiving_stream:
+                    messages.append(message)
+                    if len(messages) == n:
+                        break
+                return messages
+            finally:
+                receiving_stream.disconnect()
+                sending_stream.disconnect()
+
+        messages = asyncio.run(run())
+
+        self.assertEqual([m.data["header"]["frame"] for m in messages], list(range(n)))
+        self.assertTrue(all((m.data["data"][0] == i).all() for i, m in enumerate(messages)))
+        self.assertEqual(messages[-1].statistics.messages_received, n)
+
+
+    def test_prefetch(self):
+        socket_address = "tcp://127.0.0.1:9998"
+        n = 5
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000, prefetch_depth=2, prefetch_overflow="drop-newest")
+        try:
+            for i in range(n):
+                sending_stream.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10], "frame": i},
+                                        "data": [np.full(10, i, dtype=np.int32)]})
+            # Let the prefetch thread receive everything.
+            time.sleep(0.5)
+
+            messages = receiving_stream.receive_batch(timeout=0)
+            self.assertEqual([m.data["header"]["frame"] for m in messages], [0, 1])
+            self.assertIsNone(receiving_stream.receive(block=False))
+
+            statistics = receiving_stream.prefetch_statistics
+            self.assertEqual(statistics.messages_dropped, n - 2)
+            self.assertEqual(statistics.messages_delivered, 2)
+            self.assertEqual(statistics.max_queue_depth, 2)
+            self.assertGreater(statistics.average_time_in_queue, 0)
+
+            # The messages are already decoded by the prefetch thread, another handler cannot be applied.
+            with self.assertRaises(ValueError):
+                receiving_stream.receive_raw(block=False)
+            with self.assertRaises(ValueError):
+                receiving_stream.receive_batch(timeout=0, handler=mflow.mflow.receive_handlers["raw-1.0"])
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_merge(self):
+        addresses = ["tcp://127.0.0.1:9996", "tcp://127.0.0.1:9997"]
+
+        senders = [mflow.connect(address, conn_type=mflow.BIND, mode=mflow.PUSH) for address in addresses]
+        receivers = [mflow.connect(address, conn_type=mflow.CONNECT, mode=mflow.PULL) for address in addresses]
+        merge = Merge(*receivers, receive_strategy=PriorityStrategy([1, 0]), receive_timeout=1000)
+
+        try:
+            for source, sender in enumerate(senders):
+                for frame in range(2 + source):
+                    sender.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10],
+                                               "frame": frame, "source": source},
+                                    "data": [np.zeros(10, dtype=np.int32)]})
+            # Let all the messages arrive, so the priorities apply.
+            time.sleep(0.2)
+
+            messages = []
+            message = merge.receive()
+            while message is not None:
+                messages.append(message)
+                message = merge.receive(block=False)
+
+            self.assertEqual([(m.data["header"]["source"], m.data["header"]["frame"]) for m in messages],
+                             [(1, 0), (1, 1), (1, 2), (0, 0), (0, 1)])
+            self.assertEqual(merge.statistics.messages_received, 5)
+            self.assertEqual(merge.statistics.total_bytes_received,
+                             sum(s.total_bytes_received for s in merge.stream_statistics))
+            self.assertIs(messages[-1].statistics, merge.statistics)
+        finally:
+            merge.disconnect()
+            for sender in senders:
+                sender.disconnect()
+
+
+    def test_weighted_strategy(self):
+        strategy = WeightedStrategy([3, 1])
+        selected = [strategy.select([0, 1]) for _ in range(8)]
+        self.assertEqual(selected.count(0), 6)
+        self.assertEqual(strategy.select([1]), 1)
+
+
+    def test_ordered_merge(self):
+        addresses = ["tcp://127.0.0.1:9996", "tcp://127.0.0.1:9997"]
+
+        senders = [mflow.connect(address, conn_type=mflow.BIND, mode=mflow.PUSH) for address in addresses]
+        receivers = [mflow.connect(address, conn_type=mflow.CONNECT, mode=mflow.PULL) for address in addresses]
+        events = []
+        merge = OrderedMerge(*receivers, window=10, timeout=200, receive_timeout=1000, event_callback=events.append,
+                             first=0)
+
+        def send(sender, frame):
+            sender.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10], "frame": frame},
+                            "data": [np.zeros(10, dtype=np.int32)]})
+
+        try:
+            # Frame 4 never arrives, frame 1 arrives twice.
+            for frame in [2, 5, 0]:
+                send(senders[0], frame)
+            for frame in [3, 1]:
+                send(senders[1], frame)
+
+            frames = []
+            for _ in range(5):
+                frames.append(merge.receive().data["header"]["frame"])
+
+            send(senders[1], 1)
+            time.sleep(0.1)
+            self.assertIsNone(merge.receive(block=False))
+
+            self.assertEqual(frames, [0, 1, 2, 3, 5])
+            self.assertEqual(events, [OrderEvent(GAP, 4, 1), OrderEvent(LATE, 1, 1)])
+            self.assertEqual(merge.messages_missing, 1)
+            self.assertEqual(merge.reorder_depth, 0)
+            self.assertGreaterEqual(merge.max_reorder_depth, 1)
+        finally:
+            merge.disconnect()
+            for sender in senders:
+                sender.disconnect()
+
+
+    def test_ordered_merge_series_restart(self):
+        sender = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiver = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.CONNECT, mode=mflow.PULL)
+        events = []
+        merge = OrderedMerge(receiver, window=10, timeout=200, receive_timeout=1000, event_callback=events.append,
+                             first=0)
+
+        def send(series, frame):
+            sender.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10], "series": series,
+                                       "frame": frame},
+                            "data": [np.zeros(10, dtype=np.int32)]})
+
+        try:
+            # Frame 2 of series 0 is held back waiting for frame 1, until the series ends.
+            send(0, 0)
+            send(0, 2)
+            sender.forward({"header": {"htype": "dseries_end-1.0", "series": 0}})
+            # The frame numbers start over with every series.
+            for frame in [1, 0, 2]:
+                send(1, frame)
+            send(2, 0)
+
+            received = []
+            for _ in range(7):
+                header = merge.receive().data["header"]
+                received.append((header["htype"][:3], header["series"], header.get("frame")))
+
+            self.assertEqual(received, [("arr", 0, 0), ("arr", 0, 2), ("dse", 0, None),
+                                        ("arr", 1, 0), ("arr", 1, 1), ("arr", 1, 2), ("arr", 2, 0)])
+            self.assertEqual(events, [OrderEvent(GAP, 1, 1)])
+            self.assertEqual(merge.messages_late, 0)
+        finally:
+            merge.disconnect()
+            sender.disconnect()
+
+
+    def test_latency_histogram(self):
+        histogram = LatencyHistogram()
+        for value in range(1, 100001):
+            histogram.record(value * 1000)
+
+        self.assertEqual(histogram.count, 100000)
+        self.assertEqual((histogram.min, histogram.max), (1000, 100000000))
+        for percentile in (50, 99, 99.9):
+            expected = percentile * 1000000
+            self.assertAlmostEqual(histogram.percentile(percentile) / expected, 1, delta=0.03)
+
+        histogram.reset()
+        self.assertIsNone(histogram.percentile(50))
+
+
+    def test_sequence_tracker(self):
+        tracker = SequenceTracker()
+        for frame in [0, 1, 4, 2, 2, 5, 8]:
+            tracker.update({"htype": "array-1.0", "source": "a", "frame": frame}, nbytes=10, now=frame)
+        # A new series restarts the frame numbers, messages without frame number are only counted.
+        for frame in [0, 1]:
+            tracker.update({"htype": "dimage-1.0", "source": "b", "series": frame, "frame": 0}, now=8)
+        tracker.update({"htype": "dseries_end-1.0", "source": "b", "series": 1}, now=8)
+
+        statistics = tracker.get_statistics()
+        self.assertEqual([(sequence["source"], sequence["htype"]) for sequence in statistics],
+                         [("a", "array-1.0"), ("b", "dimage-1.0"), ("b", "dseries_end-1.0")])
+        # 3 was lost, 2 arrived late (and then again), 6 and 7 were lost.
+        self.assertEqual([statistics[0][key] for key in ("messages_received", "messages_lost", "messages_duplicated",
+                                                         "messages_out_of_order", "gaps", "max_gap")],
+                         [7, 3, 1, 1, 2, 2])
+        self.assertEqual(statistics[1]["messages_lost"] + statistics[1]["messages_duplicated"], 0)
+        self.assertEqual(tracker.messages_lost, 3)
+
+        rates = tracker.get_statistics(now=10)[0]
+        self.assertEqual((rates["message_rate"], rates["data_rate"]), (0.7, 7.0))
+
+
+    def test_rolling_statistics(self):
+        rolling = RollingStatistics(size=4, half_life=1.0)
+        self.assertEqual(rolling.add(0.0, 0, 0), (None, None))
+        # Rates of 100, 300, 200 and 200 bytes/s (1, 3, 2 and 2 messages/s) - the first sample drops out of the ring.
+        for timestamp, nbytes, messages in ((1.0, 100, 1), (2.0, 400, 4), (3.0, 600, 6)):
+            rolling.add(timestamp, nbytes, messages)
+        self.assertEqual(rolling.add(4.0, 800, 8), (200.0, 2.0))
+        self.assertEqual(len(rolling), 4)
+
+        statistics = rolling.get_statistics(percentiles=(50, ))
+        self.assertEqual((statistics["window"], statistics["intervals"], statistics["data_rate"]), (3.0, 3, 700 / 3))
+        self.assertEqual((statistics["min_data_rate"], statistics["max_data_rate"]), (200.0, 300.0))
+        self.assertEqual(statistics["message_rate_percentiles"], {50: 2.0})
+        # Halved weight of the older rates every second: 100 -> 200 -> 200 -> 200
+        self.assertEqual(statistics["ewma_data_rate"], 200.0)
+        self.assertIs(type(statistics["ewma_message_rate"]), float)
+
+        self.assertEqual(rolling.get_statistics(window=1.5)["data_rate"], 200.0)
+        self.assertEqual(rolling.get_statistics(window=0), {})
+
+        throughput = ThroughputStatistics(sampling_interval=60)
+        message_statistics = mflow.Statistics()
+        message_statistics.total_bytes_received = 1000
+        message_statistics.messages_received = 10
+        self.assertFalse(throughput.save_statistics(message_statistics))
+        # The times of the namespace are epoch times.
+        self.assertAlmostEqual(throughput.n.initial_time, time.time(), delta=10)
+        self.assertEqual(throughput.n.last_received_statistics["messages_received"], 10)
+        self.assertGreaterEqual(throughput.n.last_received_statistics["time"], throughput.n.initial_time)
+        self.assertTrue(throughput.flush())
+        self.assertEqual(throughput.n.last_sampled_statistics, throughput.n.last_received_statistics)
+        self.assertEqual(throughput.get_statistics()["average_message_size"], 100)
+        self.assertGreater(throughput.get_last_sampled_statistics()["data_rate"], 0)
+        self.assertEqual(throughput.get_rolling_statistics()["intervals"], 1)
+
+
+    def test_receive_timing(self):
+        socket_address = "tcp://127.0.0.1:9998"
+        n = 3
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000)
+        timings = receiving_stream.enable_timing()
+        try:
+            for i in range(n):
+                sending_stream.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10], "frame": i},
+                                        "data": [np.zeros(10, dtype=np.int32)]})
+
+            frames = [receiving_stream.receive().data["header"]["frame"] for _ in range(n)]
+            self.assertEqual(frames, list(range(n)))
+
+            counts = {stage: histogram.count for stage, histogram in timings.histograms.items()}
+            self.assertEqual(counts, {"receive": n, "header": n, "decode": n, "process": n - 1})
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_flight_recorder(self):
+        socket_address = "tcp://127.0.0.1:9998"
+        n = 5
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=100)
+        recorder = receiving_stream.enable_flight_recorder(size=4)
+        try:
+            for i in range(n):
+                sending_stream.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10], "frame": i},
+                                        "data": [np.zeros(10, dtype=np.int32)]})
+            for _ in range(n):
+                receiving_stream.receive()
+            self.assertIsNone(receiving_stream.receive())
+
+            with tempfile.TemporaryDirectory() as folder:
+                filename = os.path.join(folder, "trace.bin")
+                self.assertEqual(recorder.dump(filename), 4)
+                records, offset = tracing.read(filename)
+
+            # The ring keeps the last 4 receive calls, oldest first.
+            self.assertEqual([record.sequence for record in records], [2, 3, 4, 5])
+            self.assertEqual([record.message for record in records], [3, 4, 5, 5])
+            self.assertEqual([record.status for record in records[:3]], [tracing.OK] * 3)
+            self.assertEqual(records[3].status, tracing.TIMEOUT)
+            self.assertEqual((records[0].frames, records[0].bytes, records[3].frames), (2, 40 + len(
+                mflow.jsonapi.dumps({"htype": "array-1.0", "type": "int32", "shape": [10], "frame": 2})), 0))
+            self.assertTrue(all(record.start <= record.decoded <= record.flushed for record in records[:3]))
+            self.assertLess(abs(records[0].start + offset - time.time_ns()), 60 * 10**9)
+
+            lines = tracing.format_timeline(records, offset, stall=50)
+            self.assertEqual(len(lines), 5)
+            self.assertTrue(lines[4].endswith("timeout  STALL"))
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_hooks(self):
+        socket_address = "tcp://127.0.0.1:9998"
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=100)
+        events = []
+        try:
+            self.assertIsNone(receiving_stream.hooks)
+            for event in hooks.EVENTS:
+                receiving_stream.add_hook(event, lambda stream, *args, event=event: events.append(event))
+            sending_stream.add_hook(hooks.POST_SEND, lambda stream, data: events.append(type(data)))
+            with self.assertRaises(ValueError):
+                receiving_stream.add_hook("post_everything", print)
+            profile = hooks.ProfileHook().attach(receiving_stream, sending_stream)
+
+            sending_stream.forward({"header": {"htype": "array-1.0", "type": "int32", "shape": [10]},
+                                    "data": [np.zeros(10, dtype=np.int32)]})
+            sending_stream.send(b"not json")
+            self.assertIsNotNone(receiving_stream.receive())
+            self.assertIsNone(receiving_stream.receive())
+            self.assertIsNone(receiving_stream.receive())
+
+            self.assertEqual(events, [list, bytes,
+                                      "pre_receive", "post_header", "post_decode", "post_flush",
+                                      "pre_receive", "decode_error", "post_flush",
+                                      "pre_receive", "post_flush"])
+            self.assertIn("array_1_0.py", "".join(key[0] for key in profile.get_stats().stats))
+
+            # Python 3.12+ allows only one active profiler - the hook falls back to a single profiler.
+            class ActiveProfiler:
+                def enable(self):
+                    raise ValueError("Another profiling tool is already active")
+
+            single_profile = hooks.ProfileHook()
+            single_profile._local.profiler = ActiveProfiler()
+            with self.assertLogs("mflow.hooks", logging.WARNING):
+                single_profile.enter(None)
+            single_profile.enter(None)
+            mflow.jsonapi.dumps({})
+            single_profile.exit(None)
+            single_profile.exit(None)
+            self.assertEqual(single_profile._single_depth, 0)
+            self.assertIn("dumps", "".join(key[2] for key in single_profile.get_stats().stats))
+
+            profile.detach()
+            for event in hooks.EVENTS:
+                receiving_stream.remove_hook(event, receiving_stream.hooks.callbacks[event][0])
+            self.assertIsNone(receiving_stream.hooks)
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_handler_registry(self):
+        registry = HandlerRegistry()
+        receive_handlers = HandlerView(registry, "receive")
+
+        # Nothing is loaded up front.
+        self.assertEqual(len(registry), 0)
+        self.assertIn("raw-1.0", registry)
+        self.assertIn("raw-1.0", registry.available())
+
+        self.assertIs(receive_handlers["array-1.0"], array_1_0.Handler.receive)
+        self.assertEqual(list(registry), ["array-1.0"])
+
+        with self.assertRaises(KeyError):
+            receive_handlers["unknown-1.0"]
+
+        receive_handlers["custom-1.0"] = len
+        self.assertIs(receive_handlers["custom-1.0"], len)
+
+        # Importing mflow must not import numpy or the utils.
+        result = subprocess.run([sys.executable, "-c", "import sys, mflow; "
+                                                       "print('numpy' in sys.modules, 'mflow.utils' in sys.modules)"],
+                                stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        self.assertEqual(result.stdout.split(), ["False", "False"])
+
+
+    def test_forward_multipart(self):
+        socket_address = "tcp://127.0.0.1:9998"
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH, copy=False,
+                                       copy_threshold=1024)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000)
+
+        try:
+            data = np.arange(64 * 64, dtype=np.float32).reshape((64, 64))
+            transposed = data.T
+            header = {"htype": "array-1.0", "type": "float32", "shape": [64, 64], "frame": 0}
+
+            frames = array_1_0.Handler.frames({"header": header, "data": [data, transposed]})
+            self.assertIs(frames[1], data, "Contiguous array was copied.")
+            self.assertTrue(frames[2].flags.c_contiguous)
+
+            sending_stream.forward({"header": header, "data": [data, transposed]})
+            message = receiving_stream.receive()
+            self.assertEqual(message.data["header"], header)
+            self.assertTrue((message.data["data"][0] == data).all())
+            self.assertTrue((message.data["data"][1] == transposed).all())
+
+            # The last frame is tracked, as it is above the copy threshold.
+            tracker = sending_stream.send_multipart([mflow.jsonapi.dumps(header), data])
+            self.assertIsNotNone(tracker)
+            self.assertEqual(receiving_stream.receive().data["header"]["frame"], 0)
+            tracker.wait(1)
+            self.assertTrue(tracker.done)
+
+            # Messages sent with the raw handler keep all their segments.
+            raw = {"header": {"htype": "raw-1.0"}, "data": [b"1", b"2"]}
+            sending_stream.forward(raw)
+            self.assertEqual([bytes(segment) for segment in receiving_stream.receive().data["data"]], [b"1", b"2"])
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_send_buffer_pool(self):
+        socket_address = "tcp://127.0.0.1:9998"
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH, copy=False)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000)
+        pool = mflow.SendBufferPool(size=2, timeout=1)
+
+        try:
+            header = {"htype": "array-1.0", "type": "int32", "shape": [256, 1024]}
+            buffers = set()
+            for frame in range(5):
+                data = pool.acquire("int32", (256, 1024))
+                buffers.add(id(data))
+                data.fill(frame)
+
+                header["frame"] = frame
+                pool.track(sending_stream.send_multipart([mflow.jsonapi.dumps(header), data]), data)
+
+                message = receiving_stream.receive()
+                self.assertEqual(message.data["header"]["frame"], frame)
+                self.assertTrue((message.data["data"][0] == frame).all())
+
+            self.assertLessEqual(len(buffers), 2, "Buffers were not recycled.")
+            self.assertEqual(pool.acquisitions, 5)
+            self.assertEqual(pool.buffers_in_use, 0)
+
+            # Buffers that were not sent are handed back right away.
+            a = pool.acquire("int32", (256, 1024))
+            pool.acquire("int32", (256, 1024))
+            pool.release(a)
+            self.assertIs(pool.acquire("int32", (256, 1024)), a)
+
+            # The tracker covers the data, even if the last frame is small and copied.
+            context = zmq.Context()
+            held_back_sender = mflow.Stream()
+            held_back_sender.connect("inproc://held_back", conn_type=mflow.BIND, mode=mflow.PUSH, context=context,
+                                     copy=False)
+            idle_receiver = context.socket(zmq.PULL)
+            idle_receiver.connect("inproc://held_back")
+            try:
+                tracker = held_back_sender.send_multipart([b"header", np.zeros(1024 * 1024, dtype=np.uint8), b"{}"])
+                time.sleep(0.1)
+                self.assertFalse(tracker.done)
+                idle_receiver.recv_multipart()
+                tracker.wait(1)
+            finally:
+                idle_receiver.close(linger=0)
+                held_back_sender.disconnect()
+                context.term()
+
+            drop_pool = mflow.SendBufferPool(size=1, policy="drop")
+            drop_pool.acquire("uint8", (16, ))
+            with self.assertRaises(mflow.BufferPoolExhausted):
+                drop_pool.acquire("uint8", (16, ))
+            self.assertEqual(drop_pool.buffers_dropped, 1)
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_compression(self):
+        socket_address = "tcp://127.0.0.1:9998"
+
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000, buffer_pool_size=2)
+
+        try:
+            # Two large segments are compressed on the thread pool.
+            data = [np.full((512, 512), i, dtype=np.uint32) for i in range(2)]
+            for encoding in ("zlib", "lzma"):
+                header = {"htype": "array-1.0", "type": "uint32", "shape": [512, 512], "encoding": encoding}
+
+                frames = array_1_0.Handler.frames({"header": header, "data": data})
+                self.assertLess(len(frames[1]), data[0].nbytes)
+                self.assertTrue((array_1_0.get_array(frames[2], "uint32", [512, 512], encoding) == 1).all())
+
+                sending_stream.forward({"header": header, "data": data})
+                with receiving_stream.receive() as message:
+                    self.assertEqual(message.data["header"]["encoding"], encoding)
+                    self.assertTrue(all((received == sent).all()
+                                        for received, sent in zip(message.data["data"], data)))
+
+            image = np.arange(6, dtype=np.uint16).reshape((2, 3))
+            dimage = {"part_3_raw": mflow.compression.compress(image, "zlib"),
+                      "part_2": {"htype": "dimage_d-1.0", "shape": [3, 2], "type": "uint16", "encoding": "zlib"}}
+            self.assertTrue((dimage_1_0.get_image(dimage) == image).all())
+
+            # The image is compressed according to the image header (part_2), not the dconfig part (part_4).
+            image = np.arange(512 * 256, dtype=np.uint16).reshape((256, 512))
+            dimage = {"header": {"htype": "dimage-1.0", "series": 0, "frame": 0, "hash": ""},
+                      "part_2": {"htype": "dimage_d-1.0", "shape": [512, 256], "type": "uint16", "encoding": "zlib"},
+                      "part_3_raw": image,
+                      "part_4": {"htype": "dconfig-1.0", "start_time": 0, "stop_time": 0, "real_time": 0}}
+            frames = dimage_1_0.Handler.frames(dimage)
+            self.assertLess(len(frames[2]), image.nbytes)
+
+            sending_stream.send_multipart(frames)
+            with receiving_stream.receive() as message:
+                self.assertTrue((dimage_1_0.get_image(message.data) == image).all())
+
+            with self.assertRaises(ValueError):
+                mflow.compression.get_codec("unknown")
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_recording_writer(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with recording.Writer(folder, max_segment_size=200) as writer:
+                for frame in range(3):
+                    header = mflow.jsonapi.dumps({"htype": "array-1.0", "type": "uint8", "shape": [64], "frame": frame})
+                    writer.write([header, np.full(64, frame, dtype=np.uint8)], timestamp=frame)
+
+            self.assertEqual(writer.messages_written, 3)
+            # The first two messages fill the first segment.
+            self.assertEqual(sorted(os.listdir(folder)),
+                             ["recording_000000.dat", "recording_000000.frm", "recording_000000.idx",
+                              "recording_000001.dat", "recording_000001.frm", "recording_000001.idx"])
+
+            with open(os.path.join(folder, "recording_000000.idx"), "rb") as index_file:
+                magic, version, record_size = recording.FILE_HEADER.unpack(index_file.read(recording.FILE_HEADER.size))
+                self.assertEqual((magic, version, record_size), (recording.INDEX_MAGIC, 1, recording.INDEX_RECORD.size))
+                records = list(recording.INDEX_RECORD.iter_unpack(index_file.read()))
+            self.assertEqual(records[1], (1, 1, 1, 2, 2, b"array-1.0".ljust(20, b"\0")))
+
+            with open(os.path.join(folder, "recording_000000.frm"), "rb") as frames_file:
+                frames_file.seek(recording.FILE_HEADER.size)
+                offset, length = list(recording.FRAME_RECORD.iter_unpack(frames_file.read()))[3]
+            with open(os.path.join(folder, "recording_000000.dat"), "rb") as data_file:
+                data_file.seek(offset)
+                self.assertEqual(data_file.read(length), bytes([1] * 64))
+
+
+    def test_recording_reader(self):
+        with tempfile.TemporaryDirectory() as folder:
+            with recording.Writer(folder, max_segment_size=1000) as writer:
+                for frame in range(10):
+                    header = {"htype": "array-1.0", "type": "uint16", "shape": [4, 8], "frame": 100 + frame}
+                    writer.write(array_1_0.Handler.frames({"header": header,
+                                                           "data": [np.full((4, 8), frame, dtype=np.uint16)]}))
+                writer.write([mflow.jsonapi.dumps({"htype": "dseries_end-1.0"})])
+
+            with recording.Reader(folder) as reader:
+                self.assertEqual(len(reader), 11)
+                self.assertGreater(writer.segments_written, 1)
+
+                messages = list(reader)
+                self.assertEqual([m.data["header"].get("frame") for m in messages], list(range(100, 110)) + [None])
+                self.assertTrue((messages[3].data["data"][0] == 3).all())
+                self.assertFalse(messages[3].data["data"][0].flags.writeable, "Array is not a view.")
+
+                self.assertEqual(reader[-1].data["header"]["htype"], "dseries_end-1.0")
+                self.assertEqual([m.data["header"]["frame"] for m in reader[2:8:3]], [102, 105])
+                self.assertTrue((reader.by_frame(107).data["data"][0] == 7).all())
+                with self.assertRaises(KeyError):
+                    reader.by_frame(5)
+                with self.assertRaises(IndexError):
+                    reader[11]
+
+                self.assertEqual(len(reader.frames(0)), 2)
+                self.assertEqual(reader.statistics.messages_received, 15)
+
+        # An htype too long for the index is read from the header frame instead of being truncated.
+        htype = "a_rather_long_custom_htype-1.0"
+        mflow.mflow.receive_handlers[htype] = mflow.mflow.receive_handlers["raw-1.0"]
+        try:
+            with tempfile.TemporaryDirectory() as folder:
+                with recording.Writer(folder) as writer:
+                    writer.write([mflow.jsonapi.dumps({"htype": htype}), b"data"])
+
+                with recording.Reader(folder) as reader:
+                    self.assertEqual(reader.index["htype"][0], b"")
+                    self.assertEqual(reader[0].data["header"]["htype"], htype)
+
+                # Files of other versions are rejected, with the version found.
+                filename = glob.glob(os.path.join(folder, "*.idx"))[0]
+                with open(filename, "r+b") as file_handle:
+                    file_handle.seek(8)
+                    file_handle.write((7).to_bytes(4, "little"))
+                with self.assertRaisesRegex(ValueError, "Unsupported version 7"):
+                    recording.Reader(folder)
+        finally:
+            del mflow.mflow.receive_handlers[htype]
+
+
+    def test_dump_recording_timestamps(self):
+        socket_address = "tcp://127.0.0.1:9998"
+        sending_stream = mflow.connect(socket_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+
+        with tempfile.TemporaryDirectory() as folder:
+            dumper = subprocess.Popen([sys.executable, "-m", "mflow.cli.dump", socket_address, folder, "-f", "segments"],
+                                      cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            try:
+                # The dumper is waiting for the first message well before it is sent.
+                time.sleep(1.5)
+                first_send_time = time.time_ns()
+                sending_stream.send(mflow.jsonapi.dumps({"htype": "raw-1.0", "frame": 0}))
+                time.sleep(0.5)
+                sending_stream.send(mflow.jsonapi.dumps({"htype": "raw-1.0", "frame": 1}))
+                time.sleep(0.2)
+            finally:
+                dumper.send_signal(signal.SIGINT)
+                dumper.wait(10)
+                sending_stream.disconnect()
+
+            with recording.Reader(folder) as reader:
+                timestamps = reader.index["timestamp"]
+                self.assertEqual(len(timestamps), 2)
+                # The pause is between the two messages, not before the first one.
+                self.assertGreaterEqual(timestamps[0], first_send_time)
+                self.assertGreaterEqual(timestamps[1] - timestamps[0], 0.4 * 10**9)
+
+
+    def test_replay_recording(self):
+        socket_address = "tcp://127.0.0.1:9998"
+        n = 5
+
+        with tempfile.TemporaryDirectory() as folder:
+            with recording.Writer(folder) as writer:
+                for frame in range(n):
+                    header = {"htype": "array-1.0", "type": "int32", "shape": [16], "frame": frame}
+                    # Recorded 40 ms apart.
+                    writer.write(array_1_0.Handler.frames({"header": header, "data": [np.arange(16, dtype=np.int32)]}),
+                                 timestamp=frame * 40 * 10**6)
+
+            receiving_stream = mflow.connect(socket_address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                             receive_timeout=2000)
+            result = Queue()
+
+            def run(**kwargs):
+                result.put(replay.replay_recording([socket_address], folder, mflow.PUSH, report_interval=None,
+                                                   **kwargs))
+
+            try:
+                for kwargs in ({"timing": replay.ORIGINAL, "speed": 2}, {"timing": replay.RATE, "rate": 50}):
+                    thread = threading.Thread(target=run, kwargs=kwargs)
+                    thread.start()
+
+                    frames = [receiving_stream.receive().data["header"]["frame"] for _ in range(n)]
+                    thread.join()
+                    statistics = result.get()
+
+                    self.assertEqual(frames, list(range(n)))
+                    self.assertEqual(statistics.messages_sent, n)
+                    # 4 intervals of 20 ms at double speed, or of 20 ms at 50 Hz.
+                    self.assertAlmostEqual(statistics.target_rate, 50, delta=0.1)
+                    self.assertGreater(statistics.elapsed_time, 0.075)
+            finally:
+                receiving_stream.disconnect()
+
+
+    def test_generate(self):
+        sending_stream = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.BIND, mode=mflow.PUSH, copy=False)
+        receiving_stream = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000)
+
+        try:
+            generator = generate.MessageGenerator(generate.SERIES, "uint16", (4, 6), generate.RAMP, series_length=2)
+            statistics = mflow.Statistics()
+            generate.send(sending_stream, generator, rate=1000, count=5, statistics=statistics)
+            self.assertEqual(statistics.messages_received, 5)
+
+            htypes = ["dheader-1.0", "dimage-1.0", "dimage-1.0", "dseries_end-1.0", "dheader-1.0"]
+            for sequence, htype in enumerate(htypes):
+                message = receiving_stream.receive()
+                header = message.data["header"]
+                self.assertEqual((header["htype"], header["sequence"]), (htype, sequence))
+                if htype == "dimage-1.0":
+                    expected = np.arange(24).reshape((4, 6)) + header["frame"]
+                    self.assertTrue((dimage_1_0.get_image(message.data) == expected).all())
+            self.assertEqual(message.data["header"]["series"], 1)
+
+            generator = generate.MessageGenerator(generate.ARRAY, "float32", (8, ), generate.COUNTER)
+            generate.send(sending_stream, generator, count=2)
+            for frame in range(2):
+                message = receiving_stream.receive()
+                self.assertEqual(message.data["header"]["frame"], frame)
+                self.assertTrue((message.data["data"][0] == np.full(8, frame, dtype=np.float32)).all())
+
+            # The image buffer is not reused while the image is still queued, although the last frame is copied.
+            context = zmq.Context()
+            held_back_sender = mflow.Stream()
+            held_back_sender.connect("inproc://held_back", conn_type=mflow.BIND, mode=mflow.PUSH, context=context,
+                                     copy=False)
+            idle_receiver = context.socket(zmq.PULL)
+            idle_receiver.connect("inproc://held_back")
+            try:
+                generator = generate.MessageGenerator(generate.SERIES, "uint16", (512, 1024), series_length=2,
+                                                      buffers=1)
+                generator.buffer_pool.timeout = 0.1
+                generate.send(held_back_sender, generator, count=2)
+                time.sleep(0.1)
+                self.assertEqual(generator.buffer_pool.buffers_in_flight, 1)
+                with self.assertRaises(mflow.BufferPoolExhausted):
+                    generator.next()
+
+                for _ in range(2):
+                    idle_receiver.recv_multipart()
+                generator.buffer_pool.timeout = 1
+                frames, data = generator.next()
+                self.assertTrue((data == 1).all())
+            finally:
+                idle_receiver.close(linger=0)
+                held_back_sender.disconnect()
+                context.term()
+
+            with self.assertRaises(ValueError):
+                generate.MessageGenerator(generate.SERIES, shape=(16, ))
+        finally:
+            receiving_stream.disconnect()
+            sending_stream.disconnect()
+
+
+    def test_split(self):
+        input_address = "tcp://127.0.0.1:9998"
+        output_addresses = ["tcp://127.0.0.1:9996", "tcp://127.0.0.1:9997"]
+
+        sending_stream = mflow.connect(input_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        input_stream = mflow.connect(input_address, conn_type=mflow.CONNECT, mode=mflow.PULL, copy=False,
+                                     receive_timeout=1000)
+        output_streams = [mflow.connect(address, conn_type=mflow.BIND, mode=mflow.PUSH) for address in output_addresses]
+        receiving_streams = [mflow.connect(address, conn_type=mflow.CONNECT, mode=mflow.PULL, receive_timeout=1000)
+                             for address in output_addresses]
+
+        try:
+            splitter = split.FilterSplitter(output_streams, [None, split.ModuloFilter(2)])
+            data = np.arange(1024, dtype=np.uint32)
+            for frame in range(4):
+                header = {"htype": "array-1.0", "type": "uint32", "shape": [1024], "frame": frame}
+                sending_stream.forward({"header": header, "data": [data]})
+                frames = input_stream.receive(handler=splitter.receive).data
+                self.assertIsInstance(frames[1], zmq.Frame)
+
+            for receiving_stream, expected_frames in zip(receiving_streams, ([0, 1, 2, 3], [1, 3])):
+                for frame in expected_frames:
+                    message = receiving_stream.receive()
+                    self.assertEqual(message.data["header"]["frame"], frame)
+                    self.assertTrue((message.data["data"][0] == data).all(), "Message was cut.")
+
+            self.assertEqual([statistics.messages_received for statistics in splitter.output_statistics], [4, 2])
+            self.assertEqual(splitter.output_statistics[1].total_bytes_received,
+                             input_stream.receiver.statistics.total_bytes_received / 2)
+        finally:
+            for stream in [sending_stream, input_stream] + output_streams + receiving_streams:
+                stream.disconnect()
+
+
+    def test_split_routing(self):
+        route = split.compile_route({"htype": "array-1.0", "frames": [[0, 1], [10, None]], "tags": ["preview"],
+                                     "keys": {"type": "uint16"}})
+        header = {"htype": "array-1.0", "frame": 11, "tags": ["preview", "dark"], "type": "uint16"}
+        self.assertTrue(route(header))
+        self.assertFalse(route(dict(header, frame=5)))
+        self.assertFalse(route(dict(header, tags=["dark"])))
+        self.assertFalse(route(dict(header, type="uint32")))
+        self.assertFalse(route({}))
+        self.assertTrue(split.compile_route({"source": ["a", "b"]})({"source": "b"}))
+        with self.assertRaises(ValueError):
+            split.compile_route({"unknown": 1})
+
+        input_address = "tcp://127.0.0.1:9998"
+        output_addresses = ["tcp://127.0.0.1:9996", "tcp://127.0.0.1:9997"]
+
+        sending_stream = mflow.connect(input_address, conn_type=mflow.BIND, mode=mflow.PUSH)
+        input_stream = mflow.connect(input_address, conn_type=mflow.CONNECT, mode=mflow.PULL, copy=False,
+                                     receive_timeout=1000)
+        output_streams = [mflow.connect(address, conn_type=mflow.BIND, mode=mflow.PUSH) for address in output_addresses]
+        receiving_streams = [mflow.connect(address, conn_type=mflow.CONNECT, mode=mflow.PULL, receive_timeout=1000)
+                             for address in output_addresses]
+
+        try:
+            # Odd frames of source "b" to the second output - the modulo counts only the routed messages.
+            splitter = split.FilterSplitter(output_streams, [None, split.ModuloFilter(2)],
+                                            output_routes=[split.compile_route({"source": "a"}),
+                                                           split.compile_route({"source": "b"})])
+            sending_stream.forward({"header": {"htype": "dheader-1.0", "header_detail": "none", "series": 1},
+                                    "data": {}})
+            input_stream.receive(handler=splitter.receive)
+            for frame in range(6):
+                header = {"htype": "raw-1.0", "source": "a" if frame < 2 else "b", "frame": frame}
+                sending_stream.forward({"header": header, "data": [b"data"]})
+                input_stream.receive(handler=splitter.receive)
+
+            for receiving_stream, expected_frames in zip(receiving_streams, ([None, 0, 1], [None, 3, 5])):
+                for frame in expected_frames:
+                    header = mflow.jsonapi.loads(receiving_stream.socket.recv_multipart()[0])
+                    self.assertEqual(header.get("frame"), frame)
+
+            self.assertEqual([statistics.messages_received for statistics in splitter.output_statistics], [3, 3])
+        finally:
+            for stream in [sending_stream, input_stream] + output_streams + receiving_streams:
+                stream.disconnect()
+
+
+    def test_split_raw(self):
+        sending_stream = mflow.connect("tcp://127.0.0.1:9998", conn_type=mflow.BIND, mode=mflow.PUSH)
+        outputs = [split.Endpoint(address, mflow.BIND, mflow.PUSH, 100)
+                   for address in ("tcp://127.0.0.1:9996", "tcp://127.0.0.1:9997")]
+        receiving_streams = [mflow.connect(output.address, conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                           receive_timeout=1000) for output in outputs]
+        splitter = split.RawSplitter(split.Endpoint("tcp://127.0.0.1:9998", mflow.CONNECT, mflow.PULL, 100), outputs)
+
+        try:
+            splitter.start()
+            data = np.arange(1024, dtype=np.uint32)
+            for frame in range(4):
+                header = {"htype": "array-1.0", "type": "uint32", "shape": [1024], "frame": frame}
+                sending_stream.forward({"header": header, "data": [data]})
+
+            for receiving_stream in receiving_streams:
+                for frame in range(4):
+                    message = receiving_stream.receive()
+                    self.assertEqual(message.data["header"]["frame"], frame)
+                    self.assertTrue((message.data["data"][0] == data).all(), "Message was cut.")
+
+            # The statistics are counted on a separate thread.
+            for _ in range(100):
+                if all(statistics.messages_received == 4 for statistics in splitter.output_statistics):
+                    break
+                time.sleep(0.01)
+            self.assertEqual([statistics.messages_received for statistics in splitter.output_statistics], [4, 4])
+            self.assertEqual(splitter.input_statistics.total_bytes_received,
+                             receiving_streams[0].receiver.statistics.total_bytes_received)
+        finally:
+            splitter.stop()
+            for stream in [sending_stream] + receiving_streams:
+                stream.disconnect()
+
+
+    def test_hop_stamps(self):
+        sending_stream = mflow.connect("tcp://127.0.0.1:9998", conn_type=mflow.BIND, mode=mflow.PUSH)
+        input_stream = mflow.connect("tcp://127.0.0.1:9998", conn_type=mflow.CONNECT, mode=mflow.PULL, copy=False,
+                                     receive_timeout=1000)
+        output_stream = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.BIND, mode=mflow.PUSH)
+        receiving_stream = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                         receive_timeout=1000)
+
+        try:
+            sending_stream.enable_stamps("sender", "monotonic")
+            splitter = split.Splitter([output_stream], stamps=HopStamps("split", "monotonic"))
+            stamps = receiving_stream.enable_stamps("receiver")
+
+            header = {"htype": "array-1.0", "type": "uint8", "shape": [4], "frame": 0}
+            sending_stream.forward({"header": header, "data": [np.zeros(4, dtype=np.uint8)]})
+            self.assertNotIn("mflow_stamps", header)
+            input_stream.receive(handler=splitter.receive)
+
+            message = receiving_stream.receive()
+            self.assertEqual([stamp[0] for stamp in message.data["header"]["mflow_stamps"]], ["sender", "split"])
+            self.assertEqual(list(message.statistics.latencies), ["sender -> split", "split -> receiver", "total"])
+            self.assertTrue(all(histogram.count == 1 for histogram in message.statistics.latencies.values()))
+            self.assertGreaterEqual(message.statistics.latencies["total"].min,
+                                    message.statistics.latencies["split -> receiver"].min)
+
+            # Stamps of the future (clocks out of sync) are counted, stamps of other clocks are not compared.
+            stamps.record({"mflow_stamps": [["a", "realtime", time.time_ns() + 10**9], ["b", "monotonic", 0]]})
+            self.assertEqual(stamps.clock_skew, 1)
+            self.assertNotIn("a -> b", stamps.histograms)
+        finally:
+            for stream in [sending_stream, input_stream, output_stream, receiving_stream]:
+                stream.disconnect()
+
+
+    def test_split_policies(self):
+        # Without a connected client, a PUSH socket cannot take any message.
+        output_stream = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.BIND, mode=mflow.PUSH)
+        frames = [mflow.jsonapi.dumps({"htype": "raw-1.0"}), b"data"]
+
+        sends = []
+        output_stream.add_hook(hooks.PRE_SEND, lambda stream, data: sends.append(data))
+
+        try:
+            drop = split.create_policy(split.DROP_NEWEST)
+            self.assertFalse(drop.send(output_stream, frames))
+            self.assertEqual(drop.messages_dropped, 1)
+            # The non-blocking sends go through the stream, so its hooks see them.
+            self.assertEqual(sends, [frames])
+
+            adaptive = split.create_policy(split.ADAPTIVE, max_modulo=4, recovery_time=0)
+            for _ in range(8):
+                adaptive.send(output_stream, frames)
+            # Sending messages 1, 3 and 7 failed, raising the modulo up to the maximum.
+            self.assertEqual(adaptive.modulo, 4)
+            self.assertEqual((adaptive.messages_dropped, adaptive.messages_decimated), (3, 5))
+
+            printer = split.OutputStatisticsPrinter(split.Splitter([output_stream], [adaptive]))
+            with contextlib.redirect_stdout(io.StringIO()) as output:
+                printer.close()
+            self.assertIn("no messages sent, 3 dropped, 5 decimated", output.getvalue())
+
+            receiving_stream = mflow.connect("tcp://127.0.0.1:9996", conn_type=mflow.CONNECT, mode=mflow.PULL,
+                                             receive_timeout=1000)
+            try:
+                # The modulo is lowered again while the output keeps up.
+                for _ in range(20):
+                    while not adaptive.send(output_stream, frames):
+                        time.sleep(0.01)
+                    self.assertEqual(receiving_stream.receive().data["data"], [b"data"])
+                    if adaptive.modulo == 1:
+                        break
+                self.assertEqual(adaptive.modulo, 1)
+            finally:
+                receiving_stream.disconnect()
+
+            with self.assertRaises(ValueError):
+                split.create_policy("unknown")
+        finally:
+            output_stream.disconnect()